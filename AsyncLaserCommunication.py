@@ -0,0 +1,175 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import asyncio
+from collections import deque
+from time import monotonic
+
+from .LaserProtocol import is_single_line, LaserTimeout, LaserDisconnected
+from .LaserCommunication import RECONNECT_DELAY
+
+class AsyncLaserCommunication:
+    """
+    asyncio counterpart of LaserCommunication, using asyncio.open_connection.
+
+    Commands are written as soon as they are issued and a single reader task hands the replies back in order,
+    so any number of concurrent callers share the connection without threads or locks.
+
+    As in LaserCommunication a timeout closes the connection (the replies can't be matched to the commands anymore), and
+    the next command after a lost connection reconnects, backing off up to max_backoff s after failed attempts."""
+
+    def __init__(self,ip,port,timeout,debug_mode = False,max_backoff = 1.):
+        """
+        Stores the connection parameters, the connection itself is opened by `connect`.
+        """
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.debug_mode = debug_mode
+        self.max_backoff = max_backoff
+
+        ## Time (time.monotonic) of the last complete response from the laser, used to tell when the link is idle.
+        self.last_exchange = None
+
+        self.reader = None
+        self.writer = None
+        self.__pending = deque()
+        self.__reader_task = None
+
+        ## Time.monotonic() before which no new connection attempt is made, after a failed one.
+        self.next_attempt = 0.
+        self.__backoff = 0.
+        self.__connect_lock = None
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    async def connect(self):
+        """
+        Opens the connection and tests it, the laser should always respond to STATE.
+        Raises LaserDisconnected if that fails, immediately while backing off from a failed attempt.
+        """
+        if self.__connect_lock is None:
+            self.__connect_lock = asyncio.Lock()
+        async with self.__connect_lock:
+            if self.writer is not None:
+                return
+            now = monotonic()
+            if now < self.next_attempt:
+                raise LaserDisconnected(f"Unable to connect to laser, next attempt in {self.next_attempt - now:.3f} s.")
+            try:
+                self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.ip,self.port),self.timeout)
+                self.__reader_task = asyncio.get_running_loop().create_task(self.__reader_loop())
+                await self.send_and_recv("STATE")
+            except Exception as e:
+                await self.close()
+                self.__backoff = min(max(2*self.__backoff,RECONNECT_DELAY),self.max_backoff)
+                self.next_attempt = monotonic() + self.__backoff
+                raise LaserDisconnected(f"Unable to connect to laser: {e}") from e
+            self.__backoff = 0.
+            self.next_attempt = 0.
+
+    async def close(self):
+        if self.__reader_task is not None:
+            self.__reader_task.cancel()
+            self.__reader_task = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+            self.writer = None
+        self.__fail_pending(LaserDisconnected("Connection to laser closed."))
+
+    def __fail_pending(self,exception):
+        while self.__pending:
+            future = self.__pending.popleft()
+            if not future.done():
+                future.set_exception(exception)
+
+    async def __recv_message(self):
+        """Same framing as LaserCommunication: one line for ERROR/OK replies, two lines otherwise."""
+        message = await self.reader.readuntil(b"\n")
+
+        if self.debug_mode:
+            print(message)
+
+        if not is_single_line(message):
+            message += await self.reader.readuntil(b"\n")
+
+        return message.decode("ascii")
+
+    async def __reader_loop(self):
+        try:
+            while True:
+                message = await self.__recv_message()
+                self.last_exchange = monotonic()
+                future = self.__pending.popleft()
+                ## A caller that timed out has cancelled its future, the reply is still consumed to keep the order.
+                if not future.done():
+                    future.set_result(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            ## The next command reconnects.
+            self.__reader_task = None
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            self.__fail_pending(LaserDisconnected(f"Connection to laser lost: {e}"))
+
+    def __send_messages(self,messages):
+        if self.writer is None:
+            raise LaserDisconnected("Not connected to laser.")
+
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for message in messages]
+        ## No await between queueing the futures and writing, so the order on the wire matches the queue.
+        self.__pending.extend(futures)
+        self.writer.write("".join(message+"\n" for message in messages).encode("ascii"))
+        return futures
+
+    @staticmethod
+    def __strip(message,include_status):
+        if include_status:
+            return message
+        else:
+            return message.split("\n")[0]
+
+    async def __reconnect(self):
+        """Reopen a connection that was lost (not one that was never opened, that is up to connect)."""
+        if self.writer is None and self.last_exchange is not None:
+            await self.connect()
+
+    async def __drain(self):
+        try:
+            await self.writer.drain()
+        except OSError as e:
+            await self.close()
+            raise LaserDisconnected(f"Connection to laser lost: {e}") from e
+
+    async def __wait(self,awaitable):
+        try:
+            return await asyncio.wait_for(awaitable,self.timeout)
+        except asyncio.TimeoutError:
+            ## A reply that never comes would shift every later reply onto the wrong command.
+            await self.close()
+            raise LaserTimeout(f"No reply from the laser within {self.timeout} s.") from None
+
+    async def send_and_recv(self,message,include_status=False):
+        await self.__reconnect()
+        future, = self.__send_messages([message])
+        await self.__drain()
+        return self.__strip(await self.__wait(future),include_status)
+
+    async def send_and_recv_many(self,messages,include_status=False):
+        """Sends a batch of commands in a single write and returns the responses in the same order."""
+        if not messages:
+            return []
+
+        await self.__reconnect()
+        futures = self.__send_messages(messages)
+        await self.__drain()
+        responses = await self.__wait(asyncio.gather(*futures))
+        return [self.__strip(message,include_status) for message in responses]
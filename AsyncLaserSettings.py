@@ -0,0 +1,296 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import asyncio
+from time import monotonic
+
+from .AsyncLaserCommunication import AsyncLaserCommunication
+from .LaserProtocol import state_dict, REGISTERS, SNAPSHOT_REGISTERS, MODE_REGISTERS, LaserError, LaserTimeout, LaserDisconnected, command_error, plan_writes, rollback_error
+from .LaserProtocol import LaserStatus, parse_status, register_name, decode_registers, trigger_name, trigger_value, trigger_command, mode_from_qspar, qspar_from_mode, mode_kwargs_from_dict, snapshot_to_dict
+
+# asyncio counterpart of LaserSettings. Properties can't be awaited on assignment, so every property of
+# LaserSettings is exposed as a get_*/set_* coroutine pair instead. The keep alive runs as a task on the event loop.
+# Construction doesn't touch the network, use `async with AsyncLaserSettings(...) as laser:` or connect()/close().
+
+class AsyncLaserSettings:
+    def __init__(self,admin_mode = False,ip="169.254.0.1",port=10001,timeout=3,keep_alive=3,decode_status=False):
+        """decode_status: see LaserSettings."""
+        self.lasercommunication = AsyncLaserCommunication(ip,port,timeout)
+        self.admin_mode = admin_mode
+        self.decode_status = decode_status
+
+        self.keep_alive_time = keep_alive
+        self.keep_alive_task = None
+        self.__latest_status = None
+
+    async def connect(self):
+        """Open the connection to the laser and start the keep alive task."""
+        await self.lasercommunication.connect()
+        self.keep_alive_task = asyncio.get_running_loop().create_task(self.keep_alive_loop())
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self,exc_type,exc_value,traceback):
+        await self.close()
+
+    async def close(self):
+        """Stop the keep alive task and close the connection."""
+        if self.keep_alive_task is not None:
+            self.keep_alive_task.cancel()
+            try:
+                await self.keep_alive_task
+            except asyncio.CancelledError:
+                pass
+            self.keep_alive_task = None
+        await self.lasercommunication.close()
+
+    async def keep_alive_loop(self):
+        # Any exchange keeps the connection alive, so we only ping when the link has been idle.
+        # A ping on a lost connection reconnects, failed attempts are retried as soon as the backoff allows.
+        while True:
+            idle = monotonic() - self.lasercommunication.last_exchange
+            if idle >= self.keep_alive_time or not self.lasercommunication.connected:
+                try:
+                    await self.__keep_alive_ping()
+                except (LaserTimeout,LaserDisconnected):
+                    await asyncio.sleep(max(self.lasercommunication.next_attempt - monotonic(),self.keep_alive_time/100))
+                    continue
+                except (LaserError,ValueError):
+                    ## A reply we don't understand still came over a working link, the task must outlive it.
+                    pass
+                idle = 0
+            await asyncio.sleep(self.keep_alive_time - idle)
+
+    async def __keep_alive_ping(self):
+        full_response = await self.__get("STATUS")
+        ## As in LaserSettings, an ERROR reply to the ping still shows the link is up.
+        if "ERROR" not in full_response:
+            self.__publish_status(full_response)
+
+    def __publish_status(self,status):
+        try:
+            parsed = parse_status(status,self.decode_status)
+        except ValueError:
+            parsed = LaserStatus(None,None,None,None,None,status)
+        self.__latest_status = (monotonic(),parsed)
+
+    @property
+    def latest_status(self):
+        """Latest STATUS read from the laser as a (time.monotonic() timestamp, LaserStatus) tuple, or None. Does not talk to the laser."""
+        return self.__latest_status
+
+    async def ready_for_flashlamp(self):
+        if not self.decode_status:
+            return await self.get_state() == 2
+        ready = (await self.get_parsed_status()).ready_for_flashlamp
+        if ready is None:
+            return await self.get_state() == 2
+        return ready
+
+    async def ready_for_qswitch(self):
+        if not self.decode_status:
+            return await self.get_state() == 5
+        ready = (await self.get_parsed_status()).ready_for_qswitch
+        if ready is None:
+            return await self.get_state() == 5
+        return ready
+
+    async def to_dict(self):
+        """Return a description of the object as a dictionary."""
+        return snapshot_to_dict(await self.__read_many(SNAPSHOT_REGISTERS))
+
+    async def settings_from_dict(self,_dict,admin=False):
+        """
+        Set settings from dict, will not set the "admin" settings unless specified.
+
+        As LaserSettings.settings_from_dict: only the registers that differ are written, as one transaction.
+        Returns the changes as {register: (old, new)}.
+        """
+        target = dict()
+
+        if "flashlamp_trigger" in _dict and "qswitch_trigger" in _dict:
+            target["TRIG"] = trigger_value(_dict["flashlamp_trigger"],_dict["qswitch_trigger"])
+        elif "flashlamp_trigger" in _dict or "qswitch_trigger" in _dict:
+            ## The other trigger keeps its current setting.
+            current = await self.read_register("TRIG")
+            target["TRIG"] = trigger_value(_dict.get("flashlamp_trigger",trigger_name(current[0])),
+                                           _dict.get("qswitch_trigger",trigger_name(current[1])))
+
+        if "mode" in _dict:
+            target.update(zip(MODE_REGISTERS,qspar_from_mode(_dict["mode"],mode_kwargs_from_dict(_dict))))
+
+        changes = await self.write_registers(target)
+
+        if admin:
+            raise Exception("This feature has not yet been implemented.")
+
+        return changes
+
+    async def get_state(self,code=True,string=False,from_status=False):
+        state = (await self.get_parsed_status()).state if from_status else None
+        if state is None:
+            state = await self.read_register("STATE")
+        if code and string:
+            return (state,state_dict[state])
+        elif string:
+            return state_dict[state]
+        else:
+            return state
+
+    async def get_state_str(self):
+        """Returns state of the laser as a string."""
+        return await self.get_state(code=False,string=True)
+
+    async def enable_flash(self):
+        return await self.__set("RUN")
+
+    async def disable_flash(self):
+        return await self.__set("STOP")
+
+    async def enable_qsw(self):
+        return await self.__set("QSW 1")
+
+    async def disable_qsw(self):
+        return await self.__set("QSW 0")
+
+    async def get_flashlamp_trigger(self):
+        """Flashlamp trigger mode."""
+        return trigger_name((await self.read_register("TRIG"))[0])
+
+    async def get_qswitch_trigger(self):
+        """QSwitch trigger mode."""
+        return trigger_name((await self.read_register("TRIG"))[1])
+
+    async def set_both_triggers(self,flashlamp_trig,qswitch_trig):
+        return await self.__set(trigger_command(flashlamp_trig,qswitch_trig))
+
+    async def set_flashlamp_trigger(self,trig):
+        if trig == "Internal" or trig == "External":
+            return await self.set_both_triggers(trig,await self.get_qswitch_trigger())
+        else:
+            raise ValueError('Value must be "Internal" or "External".')
+
+    async def set_qswitch_trigger(self,trig):
+        if trig == "Internal" or trig == "External":
+            return await self.set_both_triggers(await self.get_flashlamp_trigger(),trig)
+        else:
+            raise ValueError('Value must be "Internal" or "External".')
+
+    async def get_mode(self):
+        """Returns the mode in which the laser is operating, see LaserSettings.mode."""
+        return mode_from_qspar(*await self.__read_many(MODE_REGISTERS))
+
+    async def set_mode(self,mode,**mode_kwargs):
+        """See LaserSettings.set_mode."""
+        return await self.write_registers(dict(zip(MODE_REGISTERS,qspar_from_mode(mode,mode_kwargs))))
+
+    async def get_status(self):
+        """Returns the status string."""
+        full_response = await self.__get("STATUS")
+        if "ERROR" in full_response:
+            raise command_error("STATUS",full_response)
+        self.__publish_status(full_response)
+        return full_response
+
+    async def get_parsed_status(self):
+        """Reads STATUS and returns it decoded as a LaserStatus."""
+        await self.get_status()
+        return self.__latest_status[1]
+
+    async def transfer_control_to_QTouch(self):
+        await self.__set("SSWITCH 1")
+        await self.close()
+
+    async def read_register(self,name):
+        """Read one register of LaserProtocol.REGISTERS, converted to its type."""
+        if not REGISTERS[name].readable:
+            raise ValueError(f"{name} can't be read.")
+        return REGISTERS[name].decode(await self.__get(name))
+
+    async def write_register(self,name,value):
+        """Write one register of LaserProtocol.REGISTERS, after checking the type, range and admin mode."""
+        return await self.__set(REGISTERS[name].encode(value,self.admin_mode))
+
+    async def write_registers(self,values):
+        """
+        Write several registers ({register: value}) as one transaction, see LaserSettings.write_registers.
+        Returns the changes as {register: (old, new)}.
+        """
+        for name in values:
+            if not REGISTERS[name].readable:
+                raise ValueError(f"{name} can't be read, so it can't be restored and can't be part of a transaction.")
+        names = list(values)
+        changes, commands, undo = plan_writes(dict(zip(names,await self.__read_many(names))),values,self.admin_mode)
+        if not changes:
+            return changes
+
+        try:
+            responses = await self.lasercommunication.send_and_recv_many(commands)
+        except (LaserTimeout,LaserDisconnected) as e:
+            await self.__roll_back(undo,e)
+            raise
+
+        refused = [(command, response) for command, response in zip(commands,responses) if "ERROR" in response]
+        if refused:
+            error = command_error(*refused[0])
+            await self.__roll_back([restore for restore, response in zip(undo,responses) if "ERROR" not in response],error)
+            raise error
+        return changes
+
+    async def __roll_back(self,undo,error):
+        if not undo:
+            return
+        try:
+            responses = await self.lasercommunication.send_and_recv_many(undo)
+        except LaserError as e:
+            raise rollback_error(error,e) from error
+        refused = [(command, response) for command, response in zip(undo,responses) if "ERROR" in response]
+        if refused:
+            raise rollback_error(error,command_error(*refused[0])) from error
+
+    ## Communication commands.
+    async def __get(self,command):
+        return (await self.__get_many([command]))[0]
+
+    async def __get_many(self,commands):
+        """Send queries in one batch. As in LaserSettings, a connection the laser closed while idle costs one retry."""
+        connected = self.lasercommunication.connected
+        try:
+            return await self.lasercommunication.send_and_recv_many(commands)
+        except LaserDisconnected:
+            if not connected:
+                raise
+            return await self.lasercommunication.send_and_recv_many(commands)
+
+    async def __read_many(self,registers):
+        responses = await self.__get_many([register_name(register) for register in registers])
+        return decode_registers(registers,responses)
+
+    async def __set(self,command):
+        response = await self.lasercommunication.send_and_recv(command)
+
+        if "ERROR" not in response:
+            return 0
+        else:
+            raise command_error(command,response)
+
+
+def register_coroutines(register):
+    """get_*/set_* coroutines for a register of the table."""
+    async def get(self):
+        return await self.read_register(register.name)
+    get.__doc__ = register.doc
+
+    async def set(self,value):
+        return await self.write_register(register.name,value)
+
+    return get, set
+
+## Accessors of the registers in the table, e.g. get_flashlamp_voltage/set_flashlamp_voltage for CAPVSET.
+for register in REGISTERS.values():
+    if register.attribute is not None:
+        getter, setter = register_coroutines(register)
+        setattr(AsyncLaserSettings,"get_"+register.attribute,getter)
+        if register.writable:
+            setattr(AsyncLaserSettings,"set_"+register.attribute,setter)
@@ -0,0 +1,152 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import argparse
+import json
+import sys
+from itertools import cycle
+from threading import Thread, Event
+from time import perf_counter, monotonic
+
+from .LaserScheduler import PRIORITY_KEEP_ALIVE
+from .LaserSettings import LaserSettings
+from .LaserSimulator import LaserSimulator
+
+# Benchmarks of the hot paths against a LaserSimulator with a controllable round trip time.
+# Run with `python -m QSmartControl.LaserBenchmark --output results.json [--baseline baseline.json]`.
+# All times are in seconds. Metrics ending in _qps are rates (higher is better), everything else is a duration (lower is better).
+
+BURST = {"mode": "Burst", "cycles": 2, "total_length": 10, "shots": 5}
+SCAN = {"mode": "Scan", "total_length": 10, "shots": 5}
+FN = {"mode": "F/N Mode", "divider": 2}
+## Second setting of every mode, the write benchmarks alternate between the two so every call really writes.
+BURST_OTHER = {"mode": "Burst", "cycles": 3, "total_length": 12, "shots": 4}
+SCAN_OTHER = {"mode": "Scan", "total_length": 12, "shots": 4}
+FN_OTHER = {"mode": "F/N Mode", "divider": 3}
+
+def percentile(samples,fraction):
+    samples = sorted(samples)
+    return samples[min(int(fraction*len(samples)),len(samples)-1)]
+
+def timed(function,repeat):
+    """Run function repeat times, returns the individual durations."""
+    durations = []
+    for i in range(repeat):
+        start = perf_counter()
+        function()
+        durations.append(perf_counter() - start)
+    return durations
+
+def alternating(function,*arguments):
+    """Function calling function(argument) with each of arguments in turn."""
+    arguments = cycle(arguments)
+    return lambda: function(next(arguments))
+
+def summarize(results,name,durations):
+    results[f"{name}_p50"] = percentile(durations,0.5)
+    results[f"{name}_p99"] = percentile(durations,0.99)
+
+def ping_loop(laser,stop):
+    """Keep a keep alive ping queued or on the wire until stop is set."""
+    while not stop.is_set():
+        laser.scheduler.submit(["STATUS"],PRIORITY_KEEP_ALIVE).result()
+
+def run_benchmarks(rtt=0.001,jitter=0.,repeat=200,duration=2.):
+    """Run all benchmarks against a fresh simulator, returns a dictionary of metrics."""
+    simulator = LaserSimulator(latency=rtt,jitter=jitter,seed=0).start()
+    results = {"rtt": rtt, "jitter": jitter}
+    try:
+        laser = LaserSettings(ip="127.0.0.1",port=simulator.port,cache=False,start_keep_alive=False)
+        communication = laser.lasercommunication
+
+        summarize(results,"send_and_recv",timed(lambda: communication.send_and_recv("STATE"),repeat))
+        summarize(results,"to_dict",timed(laser.to_dict,repeat//4))
+
+        ## Writes: registers that already hold their value are skipped, so alternate between two configurations.
+        snapshot = laser.to_dict()
+        configurations = (dict(snapshot,flashlamp_trigger="Internal",**SCAN),dict(snapshot,flashlamp_trigger="External",**BURST))
+        summarize(results,"settings_from_dict",timed(alternating(laser.settings_from_dict,*configurations),repeat//4))
+        for name, settings in (("burst",(BURST,BURST_OTHER)),("scan",(SCAN,SCAN_OTHER)),("fn",(FN,FN_OTHER))):
+            set_mode = lambda settings: laser.set_mode(**settings)
+            summarize(results,f"set_mode_{name}",timed(alternating(set_mode,*settings),repeat//4))
+
+        ## Sustained rate of single queries, one after the other.
+        count = 0
+        end = monotonic() + duration
+        while monotonic() < end:
+            communication.send_and_recv("STATE")
+            count += 1
+        results["sequential_qps"] = count/duration
+
+        ## Sustained rate of queries in batches of ten.
+        count = 0
+        end = monotonic() + duration
+        while monotonic() < end:
+            communication.send_and_recv_many(["STATE"]*10)
+            count += 10
+        results["pipelined_qps"] = count/duration
+        laser.close()
+
+        ## Keep alive interference: user commands with and without a stream of keep alive pings on the same link.
+        ## The keep alive itself doesn't ping while there is traffic, so the pings are forced from a second thread.
+        laser = LaserSettings(ip="127.0.0.1",port=simulator.port,cache=False,start_keep_alive=False)
+        summarize(results,"keep_alive_quiet",timed(lambda: laser.flashlamp_voltage,repeat))
+        stop = Event()
+        pinger = Thread(target=ping_loop,args=(laser,stop),daemon=True)
+        pinger.start()
+        try:
+            summarize(results,"keep_alive_interference",timed(lambda: laser.flashlamp_voltage,repeat))
+        finally:
+            stop.set()
+            pinger.join()
+        laser.close()
+        results["keep_alive_interference_extra_p99"] = results["keep_alive_interference_p99"] - results["keep_alive_quiet_p99"]
+    finally:
+        simulator.stop()
+    return results
+
+def compare(results,baseline,tolerance):
+    """
+    List the metrics that are more than tolerance (a fraction) worse than the baseline.
+    Only medians and throughputs are compared, a 99th percentile of a few hundred samples is too noisy to gate on.
+    """
+    regressions = []
+    for name, reference in baseline.items():
+        if name not in results or name in ("rtt","jitter") or name.endswith("_p99") or not reference:
+            continue
+        if name.endswith("_qps"):
+            worse = results[name] < reference*(1-tolerance)
+        else:
+            worse = results[name] > reference*(1+tolerance)
+        if worse:
+            regressions.append(f"{name}: {results[name]:.6g} vs baseline {reference:.6g}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark QSmartControl against a simulated laser.")
+    parser.add_argument("--rtt",type=float,default=0.001,help="Round trip time of the simulated laser in s.")
+    parser.add_argument("--jitter",type=float,default=0.)
+    parser.add_argument("--repeat",type=int,default=200,help="Number of samples per latency metric.")
+    parser.add_argument("--duration",type=float,default=2.,help="Duration of the throughput measurements in s.")
+    parser.add_argument("--output",help="Write the results to this JSON file.")
+    parser.add_argument("--baseline",help="Compare against the results in this JSON file, exit with 1 on a regression.")
+    parser.add_argument("--tolerance",type=float,default=0.2,help="Allowed relative regression against the baseline.")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.rtt,args.jitter,args.repeat,args.duration)
+    for name, value in results.items():
+        print(f"{name:40s} {value:.6g}")
+
+    if args.output:
+        with open(args.output,"w") as output:
+            json.dump(results,output,indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            baseline = json.load(baseline)
+        if baseline.get("rtt") != results["rtt"] or baseline.get("jitter") != results["jitter"]:
+            print("WARNING: the baseline was measured with a different rtt/jitter.")
+        regressions = compare(results,baseline,args.tolerance)
+        for regression in regressions:
+            print("REGRESSION",regression)
+        if regressions:
+            sys.exit(1)
@@ -1,58 +1,323 @@
 # QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
 
-import telnetlib
+import socket
+from time import monotonic, perf_counter
+
+from .LaserProtocol import frame_end, command_name, CONTROL_COMMANDS, LaserTimeout, LaserDisconnected
+from .LaserRecording import RECEIVED
+
+## Size of a single socket read, a full snapshot of replies fits comfortably.
+RECV_SIZE = 4096
+
+## Wait before the first reconnect attempt after a failed one, in s. Every further failure doubles it, up to max_backoff.
+RECONNECT_DELAY = 0.05
+
+## Read timeouts derived from the round trip time are never shorter than this (in s), a slow reply costs a reconnect.
+MIN_READ_TIMEOUT = 0.2
+
+class RttEstimator:
+    """
+    Smoothed round trip time and its variation, updated like TCP does (RFC 6298) with the first reply of every batch.
+
+    timeout: the read timeout derived from it, srtt + 4*rttvar within [min_timeout, max_timeout]. It stays at max_timeout
+    until warmup samples are in, or for good without adaptive. After a timeout it doubles until the next sample.
+    """
+
+    def __init__(self,max_timeout,min_timeout=MIN_READ_TIMEOUT,warmup=8,adaptive=False):
+        self.max_timeout = max_timeout
+        self.min_timeout = min(min_timeout,max_timeout)
+        self.warmup = warmup
+        self.adaptive = adaptive
+
+        ## Estimates in s, None before the first sample.
+        self.srtt = None
+        self.rttvar = None
+        self.min_rtt = None
+        self.samples = 0
+        self.timeout = max_timeout
+
+    def add(self,rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt/2
+            self.min_rtt = rtt
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar)/4
+            self.srtt += (rtt - self.srtt)/8
+            self.min_rtt = min(self.min_rtt,rtt)
+        self.samples += 1
+        if self.adaptive and self.samples >= self.warmup:
+            self.timeout = min(max(self.srtt + 4*self.rttvar,self.min_timeout),self.max_timeout)
+
+    def timed_out(self):
+        self.timeout = min(2*self.timeout,self.max_timeout)
+
+    def to_dict(self):
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "min_rtt": self.min_rtt, "samples": self.samples, "timeout": self.timeout}
 
 class LaserCommunication:
     """
-    Class to manage communication to a QSmart laser using the telnet protocol.
+    Class to manage communication to a QSmart laser over its telnet port.
+
+    This class was designed with the QSmart 450 in mind, but might work for other lasers.
+    The laser doesn't negotiate any telnet options, so we use a plain TCP socket with our own receive buffer.
 
-    This class was designed with the QSmart 450 in mind, but might work for other lasers."""
+    A failed exchange (LaserTimeout, LaserDisconnected) closes the connection, as a late reply would otherwise be taken for
+    the answer to the next command. The next command reconnects. Failed connection attempts back off exponentially up to
+    max_backoff s, commands sent in between fail right away instead of waiting for another connect timeout."""
 
-    def __init__(self,ip,port,timeout,debug_mode = False):
+    def __init__(self,ip,port,timeout,debug_mode = False,lazy = False,metrics = None,recorder = None,max_backoff = 1.,adaptive_timeout = False,min_timeout = MIN_READ_TIMEOUT):
         """
-        Initializes the telnet connection. Takes ip, port and timeout keywords to be passed to telnet.
+        Initializes the connection. Takes ip, port and timeout (in s, for connecting and the longest wait for a reply).
+        With lazy the connection is opened by `connect` or by the first command instead.
+        metrics: a LaserMetrics recording every exchange, None to disable.
+        recorder: a SessionRecorder (see LaserRecording) that logs every command and reply, None to disable.
+        max_backoff: longest wait between reconnect attempts in s, keep it well below the idle shutdown of the laser.
+        adaptive_timeout: wait for replies only as long as the measured round trip times suggest (see self.rtt), but at
+        least min_timeout s, so a lost reply is noticed in a fraction of a second on a fast link. timeout stays the upper
+        limit. Batches with RUN/STOP/QSW (LaserProtocol.CONTROL_COMMANDS) always get the full timeout, the laser can take
+        a while to switch.
         """
         
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.max_backoff = max_backoff
         self.debug_mode = debug_mode
+        self.metrics = metrics
+        self.recorder = recorder
+
+        ## Total number of bytes received, for the metrics.
+        self.bytes_received = 0
+
+        ## Time (time.monotonic) of the last complete response from the laser, used to tell when the link is idle.
+        self.last_exchange = None
+
+        ## Number of successful connects, and the time.monotonic() before which no new attempt is made (after a failed one).
+        self.connections = 0
+        self.next_attempt = 0.
+        self.__backoff = 0.
+
+        ## Estimate of the round trip time, and the read timeout currently set on the socket.
+        self.rtt = RttEstimator(timeout,min_timeout,adaptive=adaptive_timeout)
+        self.__read_timeout = timeout
+
+        ## Received bytes that are not returned yet start at __start in __buffer.
+        self.__buffer = bytearray()
+        self.__start = 0
+        self.__chunk = bytearray(RECV_SIZE)
+        self.__chunk_view = memoryview(self.__chunk)
 
-        ## Initialize the telnet object
-        self.tn = telnetlib.Telnet(ip,port,timeout)
+        self.sock = None
+        if not lazy:
+            self.connect()
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def connect(self,deadline=None):
+        """
+        Open the connection if it isn't open yet, within deadline (a time.monotonic()) if given.
+        Raises LaserDisconnected if it can't be opened, immediately while backing off from a failed attempt.
+        """
+        if self.sock is not None:
+            return
+        now = monotonic()
+        if now < self.next_attempt:
+            raise LaserDisconnected(f"Unable to connect to laser, next attempt in {self.next_attempt - now:.3f} s.")
 
-        ## Test the connection, the laser should always respond to STATE
         try:
-            self.send_and_recv("STATE")
+            timeout = self.timeout if deadline is None else max(min(self.timeout,deadline - now),0.001)
+            self.sock = socket.create_connection((self.ip,self.port),timeout)
+            self.__read_timeout = self.rtt.timeout
+            self.sock.settimeout(self.__read_timeout)
+            ## Without Nagle's algorithm our short commands leave immediately.
+            self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            self.__detect_dead_links()
+
+            ## Test the connection, the laser should always respond to STATE
+            self.send_and_recv_many(["STATE"],deadline=deadline)
         except Exception as e:
-            raise IOError("Unable to connect to laser:",e)
+            self.close()
+            self.__backoff = min(max(2*self.__backoff,RECONNECT_DELAY),self.max_backoff)
+            self.next_attempt = monotonic() + self.__backoff
+            raise LaserDisconnected(f"Unable to connect to laser: {e}") from e
+
+        self.__backoff = 0.
+        self.next_attempt = 0.
+        self.connections += 1
+
+    def __detect_dead_links(self):
+        """Let the kernel notice a vanished laser within seconds, where the platform allows it."""
+        self.sock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+        for option, value in (("TCP_KEEPIDLE",1),("TCP_KEEPINTVL",1),("TCP_KEEPCNT",3),
+                              ("TCP_USER_TIMEOUT",int(1000*self.timeout))):
+            if hasattr(socket,option):
+                self.sock.setsockopt(socket.IPPROTO_TCP,getattr(socket,option),value)
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.flush()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.__buffer.clear()
+        self.__start = 0
 
     def __send_message(self,message):
-        self.tn.write(message.encode("ascii")+b'\n')
+        if self.recorder is not None:
+            self.recorder.record_sent(monotonic(),[message])
+        self.sock.sendall(message.encode("ascii")+b'\n')
+
+    def __fill(self,deadline=None):
+        """Append whatever the laser has sent to the buffer, blocking until there is at least one byte."""
+        if deadline is not None:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise LaserTimeout("Deadline passed while waiting for the laser.")
+            self.sock.settimeout(min(self.__read_timeout,remaining))
+        received = self.sock.recv_into(self.__chunk)
+        if received == 0:
+            raise LaserDisconnected("Connection closed by the laser.")
+        self.bytes_received += received
+        if self.__start:
+            ## Drop what was consumed already, at most a partial reply is left to move.
+            del self.__buffer[:self.__start]
+            self.__start = 0
+        self.__buffer += self.__chunk_view[:received]
     
-    def __recv_message(self,include_status=False):
+    def __recv_message(self,include_status=False,deadline=None):
         """Message receiver
 
-        Problem occurs that messages are read too quickly, so we always want to be sure we read something.
+        Replies may arrive split over several packets, or several replies in one packet, so we frame them from our own buffer.
 
-        We read up to the first line break. If the message doesn't contain "ERROR", we have to read to another line break."""
-        message = self.tn.read_until(b"\n")
-        
-        if self.debug_mode:
-            print(message)
+        A reply ends at the first line break if it contains "ERROR" or "OK", otherwise the status code follows on a second line."""
+        end = frame_end(self.__buffer,self.__start)
+        while end < 0:
+            self.__fill(deadline)
+            end = frame_end(self.__buffer,self.__start)
 
-        if b"ERROR" in message or b"OK" in message:
-            ## If there is an error in the message, we can only read one line.
-            pass
-        else:
-            ## If there is no error in the message, the status code will also be passed to us, so we read another line.
-            message += self.tn.read_until(b"\n")
+        start = self.__start
+        self.__start = end
+        self.last_exchange = monotonic()
 
-        message = message.decode("ascii")
-        if include_status:
-            return message
-        else:
-            message_parts = message.split("\n")
-            return message_parts[0]
+        frame = memoryview(self.__buffer)[start:end]
+        try:
+            if self.debug_mode:
+                print(bytes(frame))
+            if self.recorder is not None:
+                self.recorder.record(RECEIVED,self.last_exchange,frame)
+
+            if include_status:
+                return str(frame,"ascii")
+            else:
+                return str(frame[:self.__buffer.find(b"\n",start,end)-start],"ascii")
+        finally:
+            ## The buffer can't be resized while a view on it exists.
+            frame.release()
 
         
-    def send_and_recv(self,message,include_status=False):
-        self.__send_message(message)
-        return self.__recv_message(include_status)
+    def send_and_recv(self,message,include_status=False,deadline=None):
+        if self.metrics is not None or deadline is not None or self.rtt.adaptive:
+            return self.send_and_recv_many([message],include_status,deadline)[0]
+        self.connect()
+        try:
+            sent = monotonic()
+            self.__send_message(message)
+            response = self.__recv_message(include_status)
+        except Exception as e:
+            raise self.__failed(e)
+        self.__sample(self.last_exchange - sent)
+        return response
+
+    def send_and_recv_many(self,messages,include_status=False,deadline=None):
+        """
+        Sends a batch of commands in a single write and returns the responses in the same order.
+
+        The laser answers commands in the order they arrive, so the replies can be read back one by one with the
+        same framing rules as send_and_recv. This costs roughly one round trip instead of one per command.
+        deadline: time.monotonic() by which all replies must be in (LaserTimeout otherwise), on top of the timeout per read.
+        """
+        self.connect(deadline)
+        if not messages:
+            return []
+
+        data = "".join(message+"\n" for message in messages).encode("ascii")
+        if self.recorder is not None:
+            self.recorder.record_sent(monotonic(),messages)
+
+        ## Switching the laser on or off takes longer than a query, so those batches wait the full timeout and their
+        ## replies don't count as round trips.
+        read_timeout = self.__read_timeout
+        slow = self.rtt.adaptive and not CONTROL_COMMANDS.isdisjoint(map(command_name,messages))
+        if slow:
+            self.__read_timeout = self.timeout
+            self.sock.settimeout(self.timeout)
+        try:
+            if self.metrics is not None:
+                return self.__send_and_recv_measured(messages,data,include_status,deadline,not slow)
+            sent = monotonic()
+            self.sock.sendall(data)
+            ## The first reply measures the round trip, the later ones mostly how fast the laser works through the batch.
+            responses = [self.__recv_message(include_status,deadline)]
+            if not slow:
+                self.__sample(self.last_exchange - sent)
+            responses += [self.__recv_message(include_status,deadline) for message in messages[1:]]
+            return responses
+        except Exception as e:
+            raise self.__failed(e,deadline)
+        finally:
+            if slow:
+                self.__read_timeout = read_timeout
+            if (deadline is not None or slow) and self.sock is not None:
+                self.sock.settimeout(self.__read_timeout)
+
+    def __sample(self,rtt):
+        """Add a round trip time to the estimate and follow the derived read timeout once it moved by more than a quarter."""
+        self.rtt.add(rtt)
+        timeout = self.rtt.timeout
+        if abs(timeout - self.__read_timeout) > self.__read_timeout/4 and self.sock is not None:
+            self.__read_timeout = timeout
+            self.sock.settimeout(timeout)
+
+    def __failed(self,error,deadline=None):
+        """
+        Close the connection after a failed exchange, returns the exception to raise.
+        Replies may still be on their way and the buffer may hold part of one, so the stream can't be trusted anymore.
+        """
+        self.close()
+        if isinstance(error,(LaserTimeout,LaserDisconnected)):
+            return error
+        if isinstance(error,socket.timeout) and deadline is not None and monotonic() >= deadline:
+            return LaserTimeout("Deadline passed while waiting for the laser.")
+        if isinstance(error,socket.timeout):
+            ## The estimate may have been too tight, the next connection waits longer until replies come in again.
+            self.rtt.timed_out()
+            return LaserTimeout(f"No reply from the laser within {self.__read_timeout:.3f} s.")
+        if isinstance(error,OSError):
+            return LaserDisconnected(f"Connection to the laser lost: {error}")
+        return error
+
+    def __send_and_recv_measured(self,messages,data,include_status,deadline,sample=True):
+        """send_and_recv_many, timing every reply for the metrics."""
+        metrics = self.metrics
+        metrics.before(messages)
+        received = self.bytes_received
+        responses = []
+        latencies = []
+        error = None
+        start = perf_counter()
+        try:
+            self.sock.sendall(data)
+            for message in messages:
+                responses.append(self.__recv_message(include_status,deadline))
+                latencies.append(perf_counter() - start)
+            if sample:
+                self.__sample(latencies[0])
+            return responses
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            metrics.after(messages,responses,latencies,error,len(data),self.bytes_received - received)
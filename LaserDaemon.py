@@ -0,0 +1,232 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import argparse
+import builtins
+import json
+import os
+import socket
+import socketserver
+import struct
+from threading import Lock
+
+from .LaserProtocol import REGISTERS, ADMIN_ERROR, LaserStatus, LaserError, LaserTimeout, LaserDisconnected, LaserCommandError
+from .LaserScheduler import DeadlineExceeded
+from .LaserSettings import LaserSettings
+
+# The laser accepts one controlling connection and turns off when it isn't kept alive, so only one process can own it.
+# LaserDaemon owns that connection (with its keep alive and cache) and serves any number of local processes over a Unix
+# domain socket. LaserClient mirrors the LaserSettings API on the other side.
+#
+# Protocol: one JSON object per line in each direction.
+#   {"get": "cooling_temp"}                         -> {"value": 24.1}
+#   {"set": "qswitch_delay", "value": 150}          -> {"value": null}
+#   {"call": "set_mode", "args": ["Scan"], "kwargs": {"shots": 2, "total_length": 4}}
+#   failures                                        -> {"error": "ValueError", "message": "..."}
+# Reads are answered through the cache of the daemon's LaserSettings, so many clients reading the same value cost one query.
+# Writes are serialized, and writes of admin registers are only accepted from the users in admin_uids.
+
+## Properties clients can read, and the ones they can also set.
+PROPERTIES = frozenset([register.attribute for register in REGISTERS.values() if register.attribute is not None]
+                       + ["state","state_str","flashlamp_trigger","qswitch_trigger","mode","status","parsed_status",
+                          "latest_status","ready_for_flashlamp","ready_for_qswitch","admin_mode"])
+SETTABLE = frozenset([register.attribute for register in REGISTERS.values() if register.attribute is not None and register.writable]
+                     + ["flashlamp_trigger","qswitch_trigger"])
+
+## Methods clients can call, the writes among them are serialized.
+READ_METHODS = frozenset(["to_dict","get_state","get_cooling_temp","read_register","read_registers","wait_for_state","refresh"])
+WRITE_METHODS = frozenset(["settings_from_dict","set_mode","enable_flash","disable_flash","enable_qsw","disable_qsw",
+                           "set_both_triggers","write_register"])
+
+## Exceptions that are raised again as themselves in the client, anything else becomes an OSError.
+ERRORS = {name: getattr(builtins,name) for name in ("ValueError","RuntimeError","TimeoutError","AttributeError","KeyError",
+                                                    "TypeError","OSError","ConnectionError","NotImplementedError")}
+ERRORS.update((error.__name__,error) for error in (LaserError,LaserTimeout,LaserDisconnected,LaserCommandError,DeadlineExceeded))
+
+_peercred = struct.Struct("3i")
+
+def peer_uid(connection):
+    """User id of the process on the other end of a Unix socket, None where SO_PEERCRED is not available."""
+    if not hasattr(socket,"SO_PEERCRED"):
+        return None
+    pid, uid, gid = _peercred.unpack(connection.getsockopt(socket.SOL_SOCKET,socket.SO_PEERCRED,_peercred.size))
+    return uid
+
+class LaserDaemon:
+    """
+    Serves a LaserSettings to local clients on the Unix socket path.
+
+    admin_uids: user ids allowed to write admin registers (only if the laser is in admin mode), by default the daemon's own user.
+    mode: permissions of the socket file, which decide who can connect at all.
+    """
+
+    def __init__(self,laser,path,admin_uids=None,mode=0o660):
+        self.laser = laser
+        self.path = path
+        self.admin_uids = {os.getuid()} if admin_uids is None else set(admin_uids)
+        self.write_lock = Lock()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                admin = peer_uid(self.connection) in daemon.admin_uids
+                for line in self.rfile:
+                    self.wfile.write(daemon.handle_request(line,admin))
+                    self.wfile.flush()
+
+        ## The socket file gets its permissions when it is bound, a chmod afterwards would leave a window in which
+        ## anyone allowed by the default umask could connect. The umask is per process, so it is restored right away.
+        umask = os.umask(0o777 & ~mode)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(path,Handler)
+        finally:
+            os.umask(umask)
+        self.server.daemon_threads = True
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """Stop serving, from another thread. The laser is left to the owner of the LaserSettings."""
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __check_admin(self,admin,register):
+        if register is not None and REGISTERS[register].admin and not admin:
+            raise RuntimeError(ADMIN_ERROR)
+
+    def handle_request(self,line,admin=False):
+        """Answer one request line, returns the response line."""
+        try:
+            request = json.loads(line)
+            if "get" in request:
+                if request["get"] not in PROPERTIES:
+                    raise AttributeError(f"Unknown property {request['get']!r}.")
+                value = getattr(self.laser,request["get"])
+            elif "set" in request:
+                name = request["set"]
+                if name not in SETTABLE:
+                    raise AttributeError(f"Property {name!r} can't be set.")
+                self.__check_admin(admin,next((register.name for register in REGISTERS.values() if register.attribute == name),None))
+                with self.write_lock:
+                    setattr(self.laser,name,request["value"])
+                value = None
+            else:
+                name = request["call"]
+                args = request.get("args",[])
+                kwargs = request.get("kwargs",{})
+                if name in READ_METHODS:
+                    value = getattr(self.laser,name)(*args,**kwargs)
+                elif name in WRITE_METHODS:
+                    if name == "write_register":
+                        self.__check_admin(admin,args[0] if args else kwargs.get("name"))
+                    if name == "settings_from_dict" and (kwargs.get("admin") or args[1:2] == [True]) and not admin:
+                        raise RuntimeError(ADMIN_ERROR)
+                    with self.write_lock:
+                        value = getattr(self.laser,name)(*args,**kwargs)
+                else:
+                    raise AttributeError(f"Unknown method {name!r}.")
+            return json.dumps({"value": value},separators=(",",":")).encode("utf-8") + b"\n"
+        except Exception as e:
+            return json.dumps({"error": type(e).__name__, "message": str(e)},separators=(",",":")).encode("utf-8") + b"\n"
+
+class LaserClient:
+    """
+    Talks to a LaserDaemon, with the same properties and methods as LaserSettings.
+
+    client = LaserClient("/run/qsmart.sock")
+    client.cooling_temp
+    client.set_mode("Scan",shots=2,total_length=4)
+    """
+
+    def __init__(self,path,timeout=None):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.file = self.sock.makefile("rwb")
+        self.lock = Lock()
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def request(self,request):
+        with self.lock:
+            self.file.write(json.dumps(request,separators=(",",":")).encode("utf-8") + b"\n")
+            self.file.flush()
+            line = self.file.readline()
+        if not line:
+            raise ConnectionError("The laser daemon closed the connection.")
+        response = json.loads(line)
+        if "error" in response:
+            raise ERRORS.get(response["error"],OSError)(response["message"])
+        return response["value"]
+
+    def call(self,name,*args,**kwargs):
+        return self.request({"call": name, "args": args, "kwargs": kwargs})
+
+    @property
+    def parsed_status(self):
+        return LaserStatus(*self.request({"get": "parsed_status"}))
+
+    @property
+    def latest_status(self):
+        latest = self.request({"get": "latest_status"})
+        return None if latest is None else (latest[0],LaserStatus(*latest[1]))
+
+    def get_state(self,code=True,string=False,from_status=False):
+        out = self.call("get_state",code,string,from_status)
+        return tuple(out) if isinstance(out,list) else out
+
+def client_property(name):
+    def get(self):
+        return self.request({"get": name})
+
+    def set(self,value):
+        self.request({"set": name, "value": value})
+
+    return property(get,set if name in SETTABLE else None)
+
+def client_method(name):
+    def method(self,*args,**kwargs):
+        return self.call(name,*args,**kwargs)
+    method.__name__ = name
+    return method
+
+for name in PROPERTIES:
+    if not hasattr(LaserClient,name):
+        setattr(LaserClient,name,client_property(name))
+for name in READ_METHODS | WRITE_METHODS:
+    if not hasattr(LaserClient,name):
+        setattr(LaserClient,name,client_method(name))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Own the connection to a Q-Smart laser and serve it to local processes.")
+    parser.add_argument("--ip",default="169.254.0.1")
+    parser.add_argument("--port",type=int,default=10001)
+    parser.add_argument("--socket",default="/tmp/qsmart.sock",help="Path of the Unix domain socket to serve on.")
+    parser.add_argument("--admin",action="store_true",help="Put the laser in admin mode (admin writes still need an admin uid).")
+    parser.add_argument("--admin-uid",type=int,action="append",help="User id allowed admin writes, may be repeated.")
+    args = parser.parse_args()
+
+    with LaserSettings(args.admin,args.ip,args.port) as laser:
+        daemon = LaserDaemon(laser,args.socket,args.admin_uid)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daemon.server.server_close()
+            if os.path.exists(args.socket):
+                os.unlink(args.socket)
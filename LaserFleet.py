@@ -0,0 +1,148 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+from .LaserSettings import LaserSettings
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from threading import Thread, Lock, Event
+from time import monotonic
+
+# Controlling a rack of lasers: every LaserSettings would open its connection one after the other and start its own
+# keep alive thread. LaserFleet connects to all lasers in parallel, keeps them alive from a single scheduler thread and
+# runs operations on all of them concurrently, so the wall time is set by the slowest laser instead of the sum.
+
+def endpoint_name(endpoint):
+    """Normalize an endpoint ("ip", "ip:port" or (ip, port)) to an "ip:port" string."""
+    if isinstance(endpoint,tuple):
+        ip, port = endpoint
+    elif ":" in endpoint:
+        ip, port = endpoint.rsplit(":",1)
+    else:
+        ip, port = endpoint, 10001
+    return f"{ip}:{int(port)}"
+
+class LaserFleet:
+    """
+    Set of lasers controlled together.
+
+    endpoints: iterable of "ip", "ip:port" or (ip, port). Lasers are identified by their "ip:port" name in all results.
+    The other keywords are passed to every LaserSettings.
+
+    Operations return a (results, errors) tuple of dictionaries keyed by laser name, a failure on one laser doesn't stop the others.
+    Lasers that could not be connected to are left out of the fleet and listed in connection_errors.
+    """
+
+    def __init__(self,endpoints,admin_mode = False,timeout=3,keep_alive=3,max_workers=None,**laser_kwargs):
+        endpoints = [endpoint_name(endpoint) for endpoint in endpoints]
+        self.keep_alive_time = keep_alive
+        self.executor = ThreadPoolExecutor(max_workers or max(len(endpoints),1))
+        ## Pings get their own threads, a long broadcast on the executor would otherwise hold them back past the idle shutdown.
+        self.ping_executor = ThreadPoolExecutor(max(len(endpoints),1))
+
+        def connect(endpoint):
+            ip, port = endpoint.rsplit(":",1)
+            return LaserSettings(admin_mode,ip,int(port),timeout,keep_alive,start_keep_alive=False,**laser_kwargs)
+
+        self.lasers = dict()
+        self.connection_errors = dict()
+        results, errors = self.__run_all({endpoint: partial(connect,endpoint) for endpoint in endpoints})
+        for endpoint in endpoints:
+            if endpoint in results:
+                self.lasers[endpoint] = results[endpoint]
+            else:
+                self.connection_errors[endpoint] = errors[endpoint]
+
+        # One keep alive scheduler for the whole fleet, the pings themselves run on the ping executor.
+        self.__stop = Event()
+        self.__schedule_lock = Lock()
+        self.__next_ping = dict.fromkeys(self.lasers,monotonic())
+        self.__pinging = set()
+        self.keep_alive_thread = Thread(target=self.keep_alive_loop,daemon=True)
+        self.keep_alive_thread.start()
+
+    def __run_all(self,calls):
+        """Runs {name: function} concurrently, returns ({name: result}, {name: exception})."""
+        futures = {name: self.executor.submit(call) for name, call in calls.items()}
+        wait(futures.values())
+
+        results = dict()
+        errors = dict()
+        for name, future in futures.items():
+            exception = future.exception()
+            if exception is None:
+                results[name] = future.result()
+            else:
+                errors[name] = exception
+        return results, errors
+
+    def run(self,function,*args,lasers=None,**kwargs):
+        """Call function(laser, *args, **kwargs) for every laser (or the named ones) concurrently."""
+        names = self.lasers if lasers is None else [endpoint_name(laser) for laser in lasers]
+        return self.__run_all({name: partial(function,self.lasers[name],*args,**kwargs) for name in names})
+
+    ## Keep alive
+    def keep_alive_loop(self):
+        while not self.__stop.is_set():
+            now = monotonic()
+            with self.__schedule_lock:
+                due = [name for name, when in self.__next_ping.items() if when <= now and name not in self.__pinging]
+                self.__pinging.update(due)
+            for name in due:
+                self.ping_executor.submit(self.__keep_alive_once,name)
+
+            with self.__schedule_lock:
+                waiting = [when for name, when in self.__next_ping.items() if name not in self.__pinging]
+            self.__stop.wait(max(min(waiting,default=now+self.keep_alive_time) - monotonic(),self.keep_alive_time/100))
+
+    def __keep_alive_once(self,name):
+        try:
+            delay = self.lasers[name].keep_alive_once()
+        except Exception:
+            ## The laser is unreachable, keep trying at the normal rate.
+            delay = self.keep_alive_time
+        with self.__schedule_lock:
+            self.__next_ping[name] = monotonic() + delay
+            self.__pinging.discard(name)
+
+    def close(self):
+        """Stop the keep alive scheduler and the worker threads and close every laser."""
+        self.__stop.set()
+        self.keep_alive_thread.join()
+        ## Waits for pings still running, so none of them reopens a connection that is closed below.
+        self.ping_executor.shutdown()
+        self.executor.shutdown()
+        for laser in self.lasers.values():
+            laser.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    ## Broadcast operations
+    def to_dict(self):
+        return self.run(LaserSettings.to_dict)
+
+    def settings_from_dict(self,_dict,admin=False):
+        """Apply the same settings to every laser."""
+        return self.run(LaserSettings.settings_from_dict,_dict,admin)
+
+    def settings_from_dicts(self,dicts,admin=False):
+        """Apply different settings per laser, dicts maps laser names to settings dictionaries."""
+        return self.__run_all({endpoint_name(name): partial(self.lasers[endpoint_name(name)].settings_from_dict,_dict,admin)
+                               for name, _dict in dicts.items()})
+
+    def set_mode(self,mode,**mode_kwargs):
+        return self.run(LaserSettings.set_mode,mode,**mode_kwargs)
+
+    def enable_flash(self):
+        return self.run(LaserSettings.enable_flash)
+
+    def disable_flash(self):
+        return self.run(LaserSettings.disable_flash)
+
+    def enable_qsw(self):
+        return self.run(LaserSettings.enable_qsw)
+
+    def disable_qsw(self):
+        return self.run(LaserSettings.disable_qsw)
@@ -0,0 +1,204 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import socket
+from bisect import bisect_left
+from threading import Lock
+
+from .LaserProtocol import command_name
+
+# Instrumentation of the traffic to a laser: per-command counters and latency histograms, time spent queued before a
+# command gets the connection, bytes on the wire, timeouts and ERROR replies. Pass a LaserMetrics to LaserSettings
+# (or LaserCommunication) to enable it, without one the I/O path only checks for None.
+
+## Upper bounds (in s) of the latency histogram buckets, the last bucket (+Inf) is implicit.
+LATENCY_BUCKETS = (0.0005,0.001,0.002,0.005,0.01,0.02,0.05,0.1,0.2,0.5,1.,2.,5.)
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum, like a Prometheus histogram."""
+
+    def __init__(self,buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets)+1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self,value):
+        self.counts[bisect_left(self.buckets,value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(upper bound, number of observations <= bound) pairs, ending with +Inf."""
+        total = 0
+        out = []
+        for bound, count in zip(self.buckets+(float("inf"),),self.counts):
+            total += count
+            out.append((bound,total))
+        return out
+
+    def quantile(self,fraction):
+        """Upper bound of the bucket holding the given quantile, None without observations."""
+        if not self.count:
+            return None
+        for bound, total in self.cumulative():
+            if total >= fraction*self.count:
+                return bound
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "buckets": {str(bound): total for bound, total in self.cumulative()}}
+
+class CommandMetrics:
+    """Counters of one command name."""
+
+    def __init__(self,buckets):
+        self.count = 0
+        self.errors = 0
+        self.latency = Histogram(buckets)
+
+class LaserMetrics:
+    """
+    Metrics of one (or several, if shared) laser connections.
+
+    Hooks: before(commands) is called before a batch is sent, after(commands, responses, latencies, error) when it is
+    complete or failed; latencies are the times (in s) from sending the batch to each reply, error is the exception or None.
+    Hooks run on the I/O thread, so they should be quick.
+    """
+
+    def __init__(self,buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = Lock()
+        self.commands = dict()
+        self.queue_wait = dict()
+        self.timeouts = 0
+        self.connection_errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.keep_alive_pings = 0
+        self.keep_alive_skipped = 0
+
+        ## (name, function, help, labels) of values kept elsewhere, e.g. the round trip estimate of LaserCommunication.
+        self.gauges = []
+
+        self.before_hooks = []
+        self.after_hooks = []
+
+    def add_hook(self,before=None,after=None):
+        if before is not None:
+            self.before_hooks.append(before)
+        if after is not None:
+            self.after_hooks.append(after)
+
+    def add_gauge(self,name,function,help,labels=None):
+        """Export function() (None while unknown) under name, LaserSettings adds its link estimates this way."""
+        with self.lock:
+            self.gauges.append((name,function,help,dict(labels or dict())))
+
+    ## Recording, called by LaserCommunication, LaserScheduler and LaserSettings.
+    def before(self,commands):
+        for hook in self.before_hooks:
+            hook(commands)
+
+    def after(self,commands,responses,latencies,error,bytes_sent,bytes_received):
+        with self.lock:
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+            for command, response, latency in zip(commands,responses,latencies):
+                name = command_name(command)
+                metrics = self.commands.get(name)
+                if metrics is None:
+                    metrics = self.commands[name] = CommandMetrics(self.buckets)
+                metrics.count += 1
+                metrics.latency.observe(latency)
+                if "ERROR" in response:
+                    metrics.errors += 1
+            if isinstance(error,socket.timeout):
+                self.timeouts += 1
+            elif error is not None:
+                self.connection_errors += 1
+
+        for hook in self.after_hooks:
+            hook(commands,responses,latencies,error)
+
+    def waited(self,priority,seconds):
+        """Time a batch spent queued (see LaserScheduler) before it got the connection."""
+        with self.lock:
+            histogram = self.queue_wait.get(priority)
+            if histogram is None:
+                histogram = self.queue_wait[priority] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def keep_alive(self,sent):
+        """A keep alive ping was sent, or skipped because other traffic had the link."""
+        with self.lock:
+            if sent:
+                self.keep_alive_pings += 1
+            else:
+                self.keep_alive_skipped += 1
+
+    ## Export
+    def to_dict(self):
+        with self.lock:
+            return {"commands": {name: {"count": metrics.count, "errors": metrics.errors, "latency": metrics.latency.to_dict()}
+                                 for name, metrics in self.commands.items()},
+                    "queue_wait": {priority: histogram.to_dict() for priority, histogram in self.queue_wait.items()},
+                    "timeouts": self.timeouts,
+                    "connection_errors": self.connection_errors,
+                    "bytes_sent": self.bytes_sent,
+                    "bytes_received": self.bytes_received,
+                    "keep_alive_pings": self.keep_alive_pings,
+                    "keep_alive_skipped": self.keep_alive_skipped,
+                    "gauges": [{"name": name, "labels": labels, "value": function()} for name, function, help, labels in self.gauges]}
+
+    def to_prometheus(self,prefix="qsmart",labels=None):
+        """Metrics in the Prometheus text exposition format, labels (e.g. {"laser": "10.0.0.2:10001"}) are added to every sample."""
+        base = "".join(f'{key}="{value}",' for key, value in (labels or dict()).items())
+        lines = []
+
+        def header(name,kind,help):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        def sample(name,value,extra=""):
+            label = (base+extra).rstrip(",")
+            lines.append(f"{prefix}_{name}{{{label}}} {value}" if label else f"{prefix}_{name} {value}")
+
+        def histogram(name,histogram,extra):
+            for bound, total in histogram.cumulative():
+                sample(f"{name}_bucket",total,f'{extra}le="{"+Inf" if bound == float("inf") else bound}",')
+            sample(f"{name}_sum",histogram.sum,extra)
+            sample(f"{name}_count",histogram.count,extra)
+
+        with self.lock:
+            header("commands_total","counter","Commands sent to the laser.")
+            for name, metrics in self.commands.items():
+                sample("commands_total",metrics.count,f'command="{name}",')
+            header("command_errors_total","counter","Commands answered with ERROR.")
+            for name, metrics in self.commands.items():
+                sample("command_errors_total",metrics.errors,f'command="{name}",')
+            header("command_latency_seconds","histogram","Time from sending a command to its reply.")
+            for name, metrics in self.commands.items():
+                histogram("command_latency_seconds",metrics.latency,f'command="{name}",')
+            header("queue_wait_seconds","histogram","Time commands spent queued before they got the connection.")
+            for priority, wait in self.queue_wait.items():
+                histogram("queue_wait_seconds",wait,f'priority="{priority}",')
+
+            for name, value, help in (("timeouts_total",self.timeouts,"Exchanges that timed out."),
+                                      ("connection_errors_total",self.connection_errors,"Exchanges that failed otherwise."),
+                                      ("bytes_sent_total",self.bytes_sent,"Bytes sent to the laser."),
+                                      ("bytes_received_total",self.bytes_received,"Bytes received from the laser."),
+                                      ("keep_alive_pings_total",self.keep_alive_pings,"Keep alive pings sent."),
+                                      ("keep_alive_skipped_total",self.keep_alive_skipped,"Keep alive pings skipped because of other traffic.")):
+                header(name,"counter",help)
+                sample(name,value)
+
+            ## Samples of one metric have to be together, also when several lasers share these metrics.
+            described = set()
+            for name, function, help, labels in sorted(self.gauges,key=lambda gauge: gauge[0]):
+                value = function()
+                if value is None:
+                    continue
+                if name not in described:
+                    described.add(name)
+                    header(name,"gauge",help)
+                sample(name,value,"".join(f'{key}="{label}",' for key, label in labels.items()))
+        return "\n".join(lines) + "\n"
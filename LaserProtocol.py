@@ -0,0 +1,486 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+# Pieces of the Q-Smart protocol that do not depend on how we talk to the laser.
+# Both the blocking (LaserSettings) and the asyncio (AsyncLaserSettings) interface are built on top of these.
+
+import re
+from collections import namedtuple
+
+state_dict = {\
+              0: "Boot Fault",
+              1: "Warm up",\
+              2: "Laser ready for RUN command",\
+              3: "Flashing -- lamp disabled",\
+              4: "Flashing -- awaiting for shutter to be opened",\
+              5: "Flashing -- Pulse enabled",\
+              6: "Pulsed Laser ON, NLO warm up",\
+              7: "Harmonic generator thermally stabilized",\
+              8: "NLO Optimization",\
+              9: "APM ok : NLO ready"\
+              }
+
+## States the laser leaves on its own within seconds, while flashing starts and the Q-switch opens.
+TRANSIENT_STATES = frozenset((3,4,6,7,8))
+
+## How long (in seconds) a value read from the laser may be reused before it is read again.
+## Firmware versions never change, configuration registers only change when we write them ourselves (the setters
+## invalidate them), live values get a short lifetime.
+CACHE_FOREVER = float("inf")
+
+ADMIN_ERROR = "Trying to access a protected function while LaserSettings is not in admin mode."
+
+## Errors talking to the laser. They are OSErrors, so code written against the plain IOError/OSError still catches them.
+class LaserError(IOError):
+    """Base class of the errors talking to the laser, also used for replies that don't follow the protocol."""
+
+class LaserTimeout(LaserError,TimeoutError):
+    """No complete reply within the timeout or deadline."""
+
+class LaserDisconnected(LaserError,ConnectionError):
+    """The connection could not be opened, or was lost."""
+
+class LaserCommandError(LaserError):
+    """The laser answered ERROR. command and response are the offending command and the reply, where known."""
+
+    def __init__(self,message,command=None,response=None):
+        super().__init__(message)
+        self.command = command
+        self.response = response
+
+def command_error(command,response):
+    return LaserCommandError(f"The laser answered {response.strip()!r} to {command!r}.",command,response)
+
+## Conversion of the text after "NAME = " for the register types that need more than calling the type.
+_decoders = {str: str.strip, bool: lambda text: bool(int(text))}
+
+class Register:
+    """
+    One register of the laser, see REGISTERS.
+
+    name: register name on the wire. attribute: name of the accessor generated on LaserSettings (get_/set_ coroutines on
+    AsyncLaserSettings), None for registers without one. type: int, float, str or bool. unit: unit of the value, for the docs.
+    readable/writable: what the laser allows. admin: writing requires admin mode. range: inclusive (low, high) for writes.
+    scale: raw values are multiplied by this to get the value in unit. ttl: cache lifetime in s, 0 to never cache.
+    separator: between the name and the value in a write, "NAME value" for most registers.
+    """
+    __slots__ = ("name","attribute","type","unit","readable","writable","admin","range","scale","ttl","doc","separator","prefix","decode")
+
+    def __init__(self,name,attribute=None,type=int,unit=None,readable=True,writable=False,admin=False,range=None,scale=None,ttl=0,doc=None,separator=" "):
+        self.name = name
+        self.attribute = attribute
+        self.type = type
+        self.unit = unit
+        self.readable = readable
+        self.writable = writable
+        self.admin = admin
+        self.range = range
+        self.scale = scale
+        self.ttl = ttl
+        self.doc = doc if unit is None else f"{doc} in {unit}"
+        self.separator = separator
+        self.prefix = f"{name} = "
+        self.decode = self.__compile()
+
+    def __repr__(self):
+        return f"Register({self.name!r})"
+
+    def __compile(self):
+        """Build the response parser once, a read then costs a prefix check, one slice and the conversion."""
+        name = self.name
+        prefix = self.prefix
+        start = len(prefix)
+        convert = _decoders.get(self.type,self.type)
+        scale = self.scale
+
+        def decode(full_response):
+            """Convert a "NAME = value" response to a value, raises LaserCommandError if the laser answered with an error."""
+            ## Comparing a slice is cheaper than str.startswith or splitting.
+            if full_response[:start] == prefix:
+                return convert(full_response[start:])
+            if "ERROR" in full_response:
+                raise command_error(name,full_response)
+            index = full_response.find(prefix)
+            if index < 0:
+                raise LaserError(f"Unexpected response to {name}: {full_response!r}")
+            return convert(full_response[index+start:])
+
+        if scale is None:
+            return decode
+        return lambda full_response: decode(full_response)*scale
+
+    def encode(self,value,admin_mode=False):
+        """Validate a value for this register and return the command writing it."""
+        if not self.writable:
+            raise ValueError(f"{self.name} can't be written.")
+        if self.type is int and not isinstance(value,int):
+            raise ValueError("Value must be an integer.")
+        if self.type is float and not isinstance(value,(int,float)):
+            raise ValueError("Value must be a number.")
+        if self.type is str and not isinstance(value,str):
+            raise ValueError("Value must be a string.")
+        if self.range is not None and not self.range[0] <= value <= self.range[1]:
+            raise ValueError(f"Value must be between {self.range[0]} and {self.range[1]}.")
+        if self.admin and not admin_mode:
+            raise RuntimeError(ADMIN_ERROR)
+        if self.scale is not None:
+            value = value/self.scale
+            if self.type is int:
+                value = round(value)
+        return f"{self.name}{self.separator}{value}"
+
+## The registers of the laser. Accessors, response parsing, caching and write validation are all derived from this table.
+REGISTERS = {register.name: register for register in [
+    Register("STATE",type=int,ttl=0.1),
+    Register("STATUS",type=str),
+    Register("QSW","qsw",bool,ttl=0.1,doc="Status of the qswitch."),
+    Register("PSVERS","powersupply_version",float,ttl=CACHE_FOREVER,doc="Version of the powersupply."),
+    Register("LVERS","laserbrain_version",float,ttl=CACHE_FOREVER,doc="Version of the laser firmware board(?)"),
+    Register("UIVERS","ui_version",float,ttl=CACHE_FOREVER,doc="Version of the user interface firmware."),
+    Register("CGTEMP","cooling_temp",float,"degC",ttl=1.,doc="Temperature of the cooling water"),
+    Register("CHKSERIAL",type=int,writable=True),
+    Register("ECHO",type=int,readable=False,writable=True,admin=True),
+    ## The original driver writes these two as "NAME = value", unlike the other registers. Kept as is, as it is known to work.
+    Register("CAPVSET","flashlamp_voltage",int,"V",writable=True,admin=True,ttl=CACHE_FOREVER,doc="Flash Lamp voltage",separator=" = "),
+    Register("LPW","flashlamp_pulse_width",int,"us",writable=True,admin=True,ttl=CACHE_FOREVER,doc="Flash Lamp Pulse Width",separator=" = "),
+    Register("SSHOT","flashlamp_shots",int,ttl=0.1,doc="Number of shots of the flashlamp, system-tracked."),
+    Register("USHOT","user_shots",int,writable=True,admin=True,range=(0,0),ttl=0.1,doc="Number of shots of the flashlamp since the user counter was reset (set to 0)."),
+    Register("TRIG",type=str,writable=True,ttl=CACHE_FOREVER),
+    Register("QSPAR1",type=int,writable=True,ttl=CACHE_FOREVER),
+    Register("QSPAR2",type=int,writable=True,ttl=CACHE_FOREVER),
+    Register("QSPAR3",type=int,writable=True,ttl=CACHE_FOREVER),
+    Register("QDLY","qswitch_delay",int,"ns",writable=True,admin=True,range=(0,254),ttl=CACHE_FOREVER,doc="Q-Switch delay"),
+    Register("QDLYO","qswitch_sync_delay",int,"ns",writable=True,range=(-500,500),ttl=CACHE_FOREVER,doc="Q-Switch sync output delay"),
+    ]}
+
+## Registers read for a full snapshot (see to_dict), in the order they are sent.
+SNAPSHOT_REGISTERS = ["CGTEMP","PSVERS","LVERS","CAPVSET","LPW","TRIG","QSPAR1","QSPAR2","QSPAR3","QDLY","QDLYO"]
+
+## The QSPAR registers, which together define the mode.
+MODE_REGISTERS = ["QSPAR1","QSPAR2","QSPAR3"]
+
+## Cache lifetimes by register, registers that are not listed (e.g. STATUS) are never cached.
+CACHE_TTL = {register.name: register.ttl for register in REGISTERS.values() if register.ttl}
+
+## Registers whose cached value is no longer valid after a command, by command name.
+## Commands not listed here invalidate the register with their own name, None means everything.
+CACHE_INVALIDATES = {"RUN": ("STATE","QSW"),
+                     "STOP": ("STATE","QSW"),
+                     "QSW": ("STATE","QSW"),
+                     "SSWITCH": None}
+
+## STATUS decoding.
+## The Q-Smart family answers STATUS in one of two ways, depending on the firmware:
+##  - a list of fields, e.g. "STATUS = STATE:5 ILK:1 SHUT:1 FL:1 QS:0" (separators and field names vary, see STATUS_FIELDS)
+##  - a single number (decimal or 0x-hexadecimal) with the fields packed as bits, see STATUS_BITS
+## Fields that a firmware does not report are None in the parsed record.
+## The field names and the bit layout are not from the laser manual, so STATE stays the authority for the state checks
+## and the numeric variant is only decoded on request (parse_status(..., numeric=True), LaserSettings(decode_status=True)).
+STATUS_FIELDS = {"STATE": "state", "ST": "state",
+                 "ILK": "interlock", "INTERLOCK": "interlock", "INTLK": "interlock",
+                 "SHUT": "shutter", "SHUTTER": "shutter", "SH": "shutter",
+                 "FL": "flashlamp", "FLASH": "flashlamp", "LAMP": "flashlamp", "FLASHLAMP": "flashlamp",
+                 "QS": "qswitch", "QSW": "qswitch", "QSWITCH": "qswitch"}
+STATUS_TRUE = frozenset(("1","ON","OPEN","Y","YES","TRUE"))
+
+## Bit layout of the numeric variant: interlock satisfied, shutter open, flashlamp on, Q-switch on, state in the high nibble.
+STATUS_BITS = {"interlock": 0x01, "shutter": 0x02, "flashlamp": 0x04, "qswitch": 0x08}
+STATUS_STATE_SHIFT = 4
+
+_status_field = re.compile(r"([A-Za-z]+)\s*[:=]\s*([A-Za-z0-9]+)")
+_status_number = re.compile(r"\s*(?:0[xX]([0-9A-Fa-f]+)|(\d+))\s*$")
+
+class LaserStatus(namedtuple("LaserStatus",["state","interlock","shutter","flashlamp","qswitch","raw"])):
+    """
+    Decoded STATUS reply.
+
+    state is the numeric state (see state_dict), interlock is True when the interlock allows firing, shutter is True when
+    open, flashlamp and qswitch are True when running. Fields the firmware did not report are None.
+    """
+    __slots__ = ()
+
+    @property
+    def ready_for_flashlamp(self):
+        """True/False, or None if the state was not reported."""
+        if self.state is None:
+            return None
+        return self.state == 2 and self.interlock is not False
+
+    @property
+    def ready_for_qswitch(self):
+        """True/False, or None if the state was not reported."""
+        if self.state is None:
+            return None
+        return self.state == 5 and self.interlock is not False
+
+def parse_status(full_response,numeric=False):
+    """
+    Decode a STATUS reply (with or without the "STATUS = " prefix) into a LaserStatus.
+    A numeric reply is only unpacked (as STATUS_BITS) with numeric=True, otherwise all its fields are None.
+    Fields that are missing or have a value that isn't understood are None, only an ERROR reply raises.
+    """
+    if "ERROR" in full_response:
+        raise command_error("STATUS",full_response)
+    body = full_response[9:] if full_response.startswith("STATUS = ") else full_response
+
+    number = _status_number.match(body) if numeric else None
+    if number is not None:
+        hex_digits, digits = number.groups()
+        bits = int(hex_digits,16) if hex_digits else int(digits)
+        return LaserStatus(bits >> STATUS_STATE_SHIFT,
+                           bool(bits & STATUS_BITS["interlock"]),
+                           bool(bits & STATUS_BITS["shutter"]),
+                           bool(bits & STATUS_BITS["flashlamp"]),
+                           bool(bits & STATUS_BITS["qswitch"]),
+                           full_response)
+
+    fields = dict()
+    for key, value in _status_field.findall(body):
+        field = STATUS_FIELDS.get(key.upper())
+        if field == "state":
+            ## A state the firmware reports as a word instead of a number is left as None.
+            if value.isdigit():
+                fields["state"] = int(value)
+        elif field is not None:
+            fields[field] = value.upper() in STATUS_TRUE
+    return LaserStatus(fields.get("state"),fields.get("interlock"),fields.get("shutter"),
+                       fields.get("flashlamp"),fields.get("qswitch"),full_response)
+
+## Commands that switch the laser on or off, they go ahead of everything else (see LaserScheduler).
+CONTROL_COMMANDS = frozenset(("RUN","STOP","QSW"))
+
+
+def command_name(command):
+    """Name of the register or command in a command string, e.g. "QSPAR1" for "QSPAR1 10"."""
+    return command.replace("="," ").split(" ",1)[0]
+
+def is_single_line(line):
+    """
+    Framing rule of the laser: replies containing ERROR or OK are one line long,
+    anything else is followed by a second line with the status code.
+    """
+    return b"ERROR" in line or b"OK" in line
+
+def frame_end(buffer,start=0):
+    """
+    Index just past the first complete response in buffer[start:], or -1 if it hasn't been received completely yet.
+    Same rule as is_single_line, but works in place on a receive buffer without copying.
+    """
+    first = buffer.find(b"\n",start)
+    if first < 0:
+        return -1
+    if buffer.find(b"ERROR",start,first) >= 0 or buffer.find(b"OK",start,first) >= 0:
+        return first + 1
+    second = buffer.find(b"\n",first + 1)
+    if second < 0:
+        return -1
+    return second + 1
+
+def parse_value(full_response,name,convert=None):
+    """
+    Convert a "NAME = value" response to a value, raises LaserCommandError if the laser answered with an error.
+    Without convert the codec of the register in REGISTERS is used.
+    """
+    if convert is None:
+        return REGISTERS[name].decode(full_response)
+    if "ERROR" in full_response:
+        raise command_error(name,full_response)
+    return convert(full_response.split(f"{name} = ")[1])
+
+def register_name(register):
+    """Register name of a read_registers item, which is either a name or a (name, convert) tuple."""
+    return register if isinstance(register,str) else register[0]
+
+def decode_registers(registers,responses):
+    """Convert the responses to a batch of reads, registers are names or (name, convert) tuples."""
+    return [REGISTERS[register].decode(full_response) if isinstance(register,str) else parse_value(full_response,*register)
+            for register, full_response in zip(registers,responses)]
+
+def plan_writes(current,target,admin_mode=False):
+    """
+    Plan a transaction: the registers of target ({register: value}) whose value differs from current ({register: value}).
+    Returns the changes as {register: (old, new)}, the commands writing them and the commands restoring the old values.
+    Raises ValueError before anything is sent if a new value is invalid, or an old value can't be written back.
+    """
+    changes = {name: (current[name],value) for name, value in target.items() if current[name] != value}
+    commands = [REGISTERS[name].encode(new,admin_mode) for name, (old, new) in changes.items()]
+    undo = []
+    for name, (old, new) in changes.items():
+        try:
+            undo.append(REGISTERS[name].encode(old,admin_mode))
+        except ValueError as e:
+            raise ValueError(f"{name} can't be changed in a transaction, its current value {old!r} can't be restored: {e}") from None
+    return changes, commands, undo
+
+def rollback_error(error,failure):
+    """
+    The error to raise when a transaction failed with error and restoring the old values failed with failure.
+    It has the class of failure (so a timeout stays a LaserTimeout), raise it from error.
+    """
+    message = f"{error} Rolling back failed as well ({failure}), the laser is left partly changed."
+    if isinstance(failure,LaserCommandError):
+        return type(failure)(message,failure.command,failure.response)
+    return type(failure)(message)
+
+def trigger_name(trig):
+    """Translate one character of the TRIG register to a trigger mode."""
+    if trig == "I":
+        return "Internal"
+    else:
+        return "External"
+
+def trigger_value(flashlamp_trig,qswitch_trig):
+    """Value of the TRIG register for the given trigger modes ("Internal" or "External"), e.g. "IE"."""
+    value = ""
+    for trig in (flashlamp_trig,qswitch_trig):
+        if trig == "Internal":
+            value += "I"
+        elif trig == "External":
+            value += "E"
+        else:
+            raise ValueError('Value must be "Internal" or "External".')
+    return value
+
+def trigger_command(flashlamp_trig,qswitch_trig):
+    """Build the TRIG command for the given trigger modes ("Internal" or "External")."""
+    return "TRIG " + trigger_value(flashlamp_trig,qswitch_trig)
+
+def mode_from_qspar(qs1,qs2,qs3):
+    """
+    Determine the mode from the values of QSPAR1-3:
+    - In Burst Mode when QSPAR1 != 0
+    - In F/N mode when QSPAR3 == 1
+    - In Scan mode otherwise
+    """
+    if qs1 != 0:
+        return "Burst"
+    elif qs3 == 1:
+        return "F/N Mode"
+    else:
+        return "Scan"
+
+def qspar_from_mode(mode,mode_kwargs):
+    """Validate the arguments of set_mode and return the values of (QSPAR1, QSPAR2, QSPAR3) to write."""
+    if mode == "Burst":
+        if len(mode_kwargs) != 3:
+            raise ValueError("Setting mode to Burst requires 3 options. ('cycles','shots','total_length')")
+        if "cycles" not in mode_kwargs:
+            raise ValueError("Must set number of cycles ('cycles') in Burst mode.")
+        if "shots" not in mode_kwargs:
+            raise ValueError("Must set number of shots ('shots') in Burst mode.")
+        if "total_length" not in mode_kwargs:
+            raise ValueError("Must set total length of cycle ('total_length') in Burst mode.")
+
+        cycles       = mode_kwargs["cycles"]
+        shots        = mode_kwargs["shots"]
+        total_length = mode_kwargs["total_length"]
+
+        if not isinstance(cycles,int):
+            raise ValueError("Value must be integer. ('cycles')")
+        if not isinstance(shots,int):
+            raise ValueError("Value must be integer. ('shots')")
+        if not isinstance(total_length,int):
+            raise ValueError("Value must be integer. ('total_length')")
+
+        idle_shots = total_length-shots
+
+        if idle_shots < 0:
+            raise ValueError("Value of 'total_length' must be >= 'shots'.")
+
+        return (cycles, total_length, shots)
+
+    elif mode == "F/N Mode":
+        if len(mode_kwargs) != 1:
+            raise ValueError("Setting mode to F/N requires 1 option. ('divider')")
+        if "divider" not in mode_kwargs:
+            raise ValueError("Must set number of shots ('divider') in F/N mode.")
+
+        divider      = mode_kwargs["divider"]
+
+        if not isinstance(divider,int):
+            raise ValueError("Value must be integer. ('shots')")
+
+        if divider < 1:
+            raise ValueError("Value of 'divider' must be >= '1'.")
+
+        return (0, divider, 1)
+
+    elif mode == "Scan":
+        if len(mode_kwargs) != 2:
+            raise ValueError("Setting mode to Burst requires 2 options. ('shots','total_length')")
+        if "shots" not in mode_kwargs:
+            raise ValueError("Must set number of shots ('shots') in Burst mode.")
+        if "total_length" not in mode_kwargs:
+            raise ValueError("Must set total length of cycle ('total_length') in Burst mode.")
+
+        shots        = mode_kwargs["shots"]
+        total_length = mode_kwargs["total_length"]
+
+        if not isinstance(shots,int):
+            raise ValueError("Value must be integer. ('shots')")
+        if not isinstance(total_length,int):
+            raise ValueError("Value must be integer. ('total_length')")
+
+        idle_shots = total_length-shots
+
+        if idle_shots < 0:
+            raise ValueError("Value of 'total_length' must be >= 'shots'.")
+
+        return (0, total_length, shots)
+    else:
+        raise ValueError('Value of "mode" must be "Burst", "F/N Mode" or "Scan".')
+
+def mode_kwargs_from_dict(_dict):
+    """Extract the set_mode arguments from a settings dictionary (see settings_from_dict)."""
+    if _dict["mode"] == "Burst":
+        try:
+            return {"cycles": int(_dict["cycles"]),
+                    "total_length": int(_dict["total_length"]),
+                    "shots": int(_dict["shots"])}
+        except:
+            raise ValueError("Error setting mode to Burst, missing parameters. (Required cycles, total_length, shots.)")
+
+    elif _dict["mode"] == "Scan":
+        try:
+            return {"total_length": int(_dict["total_length"]),
+                    "shots": int(_dict["shots"])}
+        except:
+            raise ValueError("Error setting mode to Scan, missing parameters. (Required total_length, shots.)")
+
+    elif _dict["mode"] == "F/N Mode":
+        try:
+            return {"divider": int(_dict["divider"])}
+        except:
+            raise ValueError("Error setting mode to F/N Mode, missing parameters. (Required divider.)")
+
+    else:
+        raise ValueError('Value of "mode" must be "Burst", "F/N Mode" or "Scan".')
+
+def snapshot_to_dict(values):
+    """Build the to_dict description from the values of SNAPSHOT_REGISTERS."""
+    (cooling_temp, powersupply_version, laserbrain_version, flashlamp_voltage, flashlamp_pulse_width,
+     trig, qs1, qs2, qs3, qswitch_delay, qswitch_sync_delay) = values
+    mode = mode_from_qspar(qs1,qs2,qs3)
+
+    _dict = dict()
+
+    _dict["cooling_temp"] = cooling_temp
+    _dict["powersupply_version"] = powersupply_version
+    _dict["laserbrain_version"] = laserbrain_version
+    _dict["flashlamp_voltage"] = flashlamp_voltage
+    _dict["flashlamp_pulse_width"] = flashlamp_pulse_width
+    _dict["flashlamp_trigger"] = trigger_name(trig[0])
+    _dict["qswitch_trigger"] = trigger_name(trig[1])
+    _dict["mode"] = mode
+    if mode == "Burst":
+        _dict["cycles"] = qs1
+        _dict["total_length"] = qs2
+        _dict["shots"]  = qs3
+    elif mode == "F/N Mode":
+        _dict["divider"] = qs2
+    else: #Scan
+        _dict["total_length"] = qs2
+        _dict["shots"] = qs3
+    _dict["qswitch_delay"] = qswitch_delay
+    _dict["qswitch_sync_delay"] = qswitch_sync_delay
+
+    return _dict
@@ -0,0 +1,194 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import mmap
+import struct
+from collections import deque, defaultdict
+from threading import Lock
+from time import monotonic, sleep
+
+from .LaserProtocol import command_name, LaserError, LaserTimeout
+
+# Recording of the traffic on a laser connection and replaying it without the laser.
+# A recording is an append-only binary log: a magic header followed by records of
+#   timestamp (float64, time.monotonic()), direction (uint8, SENT or RECEIVED), length (uint32), payload
+# with one record per command line sent and one per complete reply (including its status line) received.
+# Recordings are read through mmap, so even long sessions are not loaded into memory.
+
+MAGIC = b"QSREC01\n"
+RECORD = struct.Struct("<dBI")
+SENT = 0
+RECEIVED = 1
+
+class SessionRecorder:
+    """Writes a recording, pass it to LaserCommunication (or the path to LaserSettings(record=...))."""
+
+    def __init__(self,path):
+        self.path = path
+        self.file = open(path,"wb")
+        self.file.write(MAGIC)
+        self.lock = Lock()
+
+    def record(self,direction,timestamp,payload):
+        with self.lock:
+            self.file.write(RECORD.pack(timestamp,direction,len(payload)))
+            self.file.write(payload)
+
+    def record_sent(self,timestamp,messages):
+        with self.lock:
+            for message in messages:
+                payload = message.encode("ascii")
+                self.file.write(RECORD.pack(timestamp,SENT,len(payload)))
+                self.file.write(payload)
+
+    def flush(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class SessionLog:
+    """Read access to a recording through mmap."""
+
+    def __init__(self,path):
+        self.path = path
+        with open(path,"rb") as file:
+            self.map = mmap.mmap(file.fileno(),0,access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a QSmartControl recording.")
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def __iter__(self):
+        """(timestamp, direction, payload) of every record, payload as bytes."""
+        offset = len(MAGIC)
+        end = len(self.map)
+        while offset + RECORD.size <= end:
+            timestamp, direction, length = RECORD.unpack_from(self.map,offset)
+            offset += RECORD.size
+            if offset + length > end:
+                ## The recorder was interrupted in the middle of a record.
+                return
+            yield timestamp, direction, self.map[offset:offset+length]
+            offset += length
+
+    def exchanges(self):
+        """
+        (sent timestamp, command, received timestamp, response) of every answered command, in order.
+        The laser answers in order, so the n-th reply belongs to the n-th command.
+        """
+        pending = deque()
+        for timestamp, direction, payload in self:
+            if direction == SENT:
+                pending.append((timestamp,payload.decode("ascii")))
+            elif pending:
+                sent, command = pending.popleft()
+                yield sent, command, timestamp, payload.decode("ascii")
+
+class ReplayCommunication:
+    """
+    Stand-in for LaserCommunication that answers from a recording, e.g. LaserSettings(communication=ReplayCommunication(path)).
+
+    realtime: wait as long as the laser took to answer each command, otherwise replies are returned immediately.
+    strict: every command must be the next recorded one (LaserError otherwise). Without it each command gets the next
+    recorded reply to the same command, so e.g. keep alive pings that happened at different moments don't matter.
+    metrics: a LaserMetrics recording every exchange with its recorded latency, as LaserCommunication does.
+    """
+
+    def __init__(self,path,realtime=False,strict=True,lazy=False,metrics=None):
+        with SessionLog(path) as log:
+            self.__exchanges = deque((command,response,received-sent) for sent, command, received, response in log.exchanges())
+        self.realtime = realtime
+        self.strict = strict
+        self.__by_command = None
+        if not strict:
+            self.__by_command = defaultdict(deque)
+            for exchange in self.__exchanges:
+                self.__by_command[exchange[0]].append(exchange)
+
+        self.metrics = metrics
+        self.last_exchange = None
+        self.bytes_received = 0
+        self.connected = False
+        self.connections = 0
+        self.next_attempt = 0.
+        if not lazy:
+            self.connect()
+
+    def connect(self):
+        """Replays the STATE handshake of LaserCommunication."""
+        if not self.connected:
+            self.connected = True
+            self.connections += 1
+            self.send_and_recv("STATE")
+
+    def close(self):
+        self.connected = False
+
+    @property
+    def remaining(self):
+        """Number of recorded exchanges that have not been replayed yet."""
+        if self.strict:
+            return len(self.__exchanges)
+        return sum(len(exchanges) for exchanges in self.__by_command.values())
+
+    def __next_exchange(self,message):
+        if self.strict:
+            if not self.__exchanges:
+                raise LaserError(f"Replay: {message!r} was sent after the end of the recording.")
+            command, response, latency = self.__exchanges.popleft()
+            if command != message:
+                raise LaserError(f"Replay: {message!r} was sent where the recording has {command!r}.")
+        else:
+            exchanges = self.__by_command.get(message)
+            if not exchanges:
+                raise LaserError(f"Replay: no (more) recorded replies to {message!r} ({command_name(message)}).")
+            command, response, latency = exchanges.popleft()
+        return response, latency
+
+    def send_and_recv(self,message,include_status=False,deadline=None):
+        return self.send_and_recv_many([message],include_status,deadline)[0]
+
+    def send_and_recv_many(self,messages,include_status=False,deadline=None):
+        """Like LaserCommunication.send_and_recv_many, the deadline only matters in realtime."""
+        self.connected = True
+        if self.metrics is not None:
+            self.metrics.before(messages)
+        replies = []
+        error = None
+        try:
+            for message in messages:
+                replies.append(self.__next_exchange(message))
+            if self.realtime and replies:
+                ## A pipelined batch takes as long as its slowest reply.
+                latency = max(latency for response, latency in replies)
+                if deadline is not None and monotonic() + latency > deadline:
+                    sleep(max(deadline - monotonic(),0))
+                    raise LaserTimeout("Deadline passed while waiting for the (replayed) laser.")
+                sleep(latency)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if self.metrics is not None:
+                ## On a timeout nothing was received, as with the laser.
+                received = [] if isinstance(error,LaserTimeout) else replies
+                self.metrics.after(messages,[response for response, latency in received],[latency for response, latency in received],
+                                   error,sum(len(message) + 1 for message in messages),sum(len(response) for response, latency in received))
+        self.last_exchange = monotonic()
+
+        responses = []
+        for response, latency in replies:
+            self.bytes_received += len(response)
+            responses.append(response if include_status else response.split("\n",1)[0])
+        return responses
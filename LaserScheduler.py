@@ -0,0 +1,113 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import heapq
+from concurrent.futures import Future
+from itertools import count
+from threading import Thread, Lock, Condition
+from time import monotonic
+
+from .LaserProtocol import LaserTimeout
+
+# All traffic to a laser goes through one worker thread that owns the connection. Callers queue commands with a
+# priority and get a Future back, the worker always sends the most urgent command next. A STOP therefore never
+# waits behind a queue of telemetry polls, at most behind the one exchange that is already on the wire.
+
+## Priorities, lower goes first.
+PRIORITY_CONTROL = 0    # RUN/STOP, Q-switch on/off
+PRIORITY_USER = 1       # Regular reads and writes
+PRIORITY_TELEMETRY = 2  # Background polling
+PRIORITY_KEEP_ALIVE = 3 # Keep alive pings
+
+class DeadlineExceeded(LaserTimeout):
+    """The command was still queued when its deadline passed, it has not been sent."""
+
+class LaserScheduler:
+    """
+    Priority queue of commands in front of a LaserCommunication, served by a single worker thread.
+
+    lock: held by the worker during every exchange, so code that uses the connection directly can synchronize with it.
+    metrics: a LaserMetrics that records how long batches were queued, per priority.
+    """
+
+    def __init__(self,lasercommunication,lock=None,metrics=None):
+        self.lasercommunication = lasercommunication
+        self.lock = Lock() if lock is None else lock
+        self.metrics = metrics
+
+        self.__queue = []
+        self.__order = count()
+        self.__condition = Condition()
+        self.__busy = False
+        self.__running = True
+
+        self.worker = Thread(target=self.__work,daemon=True)
+        self.worker.start()
+
+    @property
+    def idle(self):
+        """True if nothing is queued or on the wire."""
+        with self.__condition:
+            return not self.__queue and not self.__busy
+
+    def submit(self,commands,priority=PRIORITY_USER,deadline=None,callback=None,reply_deadline=None):
+        """
+        Queue a batch of commands to be sent back to back, returns a Future of the list of responses.
+
+        deadline: time.monotonic() after which the batch is dropped (DeadlineExceeded) if it hasn't been sent yet.
+        reply_deadline: time.monotonic() by which all replies must be in, the exchange fails with LaserTimeout otherwise.
+        callback: called with the responses on the worker thread before the next exchange starts, e.g. to update caches.
+        Queued batches can be cancelled with Future.cancel().
+        """
+        future = Future()
+        with self.__condition:
+            if not self.__running:
+                raise RuntimeError("The scheduler has been stopped.")
+            heapq.heappush(self.__queue,(priority,next(self.__order),list(commands),future,deadline,callback,
+                                        reply_deadline,monotonic()))
+            self.__condition.notify()
+        return future
+
+    def stop(self):
+        """Stop the worker after the current exchange, queued commands are cancelled."""
+        with self.__condition:
+            self.__running = False
+            for item in self.__queue:
+                item[3].cancel()
+            self.__queue.clear()
+            self.__condition.notify()
+        self.worker.join()
+
+    def __work(self):
+        while True:
+            with self.__condition:
+                while self.__running and not self.__queue:
+                    self.__condition.wait()
+                if not self.__running:
+                    return
+                priority, order, commands, future, deadline, callback, reply_deadline, submitted = heapq.heappop(self.__queue)
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.__busy = True
+
+            try:
+                if deadline is not None and monotonic() > deadline:
+                    future.set_exception(DeadlineExceeded("Deadline passed before the command could be sent."))
+                    continue
+
+                try:
+                    with self.lock:
+                        if self.metrics is not None:
+                            self.metrics.waited(priority,monotonic() - submitted)
+                        if reply_deadline is None:
+                            responses = self.lasercommunication.send_and_recv_many(commands)
+                        else:
+                            responses = self.lasercommunication.send_and_recv_many(commands,deadline=reply_deadline)
+                        if callback is not None:
+                            callback(responses)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(responses)
+            finally:
+                with self.__condition:
+                    self.__busy = False
@@ -0,0 +1,179 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+from collections import namedtuple
+from threading import Event
+from time import monotonic
+
+from .LaserProtocol import REGISTERS, MODE_REGISTERS, trigger_command, qspar_from_mode, command_error
+from .LaserScheduler import PRIORITY_CONTROL
+
+# Timed sequences of laser actions, e.g. set the mode, start flashing, open the Q-switch after 2 s and close it 10 s later.
+# All commands are validated and encoded when the sequence is built, so nothing can fail on a typo halfway through a run.
+# Steps are sent at control priority on a monotonic clock: a coarse wait until just before the target time, then a short
+# spin, which keeps the jitter at the level of the link instead of the sleep granularity.
+
+## The last part of every wait is spent spinning instead of sleeping, in s.
+SPIN_TIME = 0.002
+
+## Commands sent when a sequence fails or is cancelled, so the laser isn't left running.
+ABORT_COMMANDS = ("QSW 0","STOP")
+
+class StepResult(namedtuple("StepResult",["name","planned","sent","completed","responses","error"])):
+    """
+    Outcome of one step. planned, sent and completed are in s since the start of the sequence, sent/completed are None
+    for steps that were not sent. error is the exception that stopped the sequence at this step, or None.
+    """
+    __slots__ = ()
+
+    @property
+    def lateness(self):
+        """How much later than planned the step was sent, in s."""
+        return None if self.sent is None else self.sent - self.planned
+
+class LaserSequence:
+    """
+    Schedule of laser actions at times (in s) relative to the start of the run.
+
+    sequence = LaserSequence(laser)
+    sequence.set_mode(0,"Burst",cycles=2,total_length=10,shots=5)
+    sequence.enable_flash(0)
+    sequence.enable_qsw(2)
+    sequence.disable_qsw(12)
+    results = sequence.run()
+
+    max_lateness: a step that can't be sent within this many s of its time fails the sequence (None to never fail on time).
+    abort_on_error: send ABORT_COMMANDS when a step fails or the run is cancelled.
+    """
+
+    def __init__(self,laser,max_lateness=0.1,abort_on_error=True):
+        self.laser = laser
+        self.max_lateness = max_lateness
+        self.abort_on_error = abort_on_error
+        self.steps = []
+        self.__cancel = Event()
+
+    ## Building the schedule. Every method validates its arguments right away.
+    def add(self,time,name,commands):
+        """Add a step sending raw commands at time."""
+        if time < 0:
+            raise ValueError("Step times must be >= 0.")
+        self.steps.append((time,len(self.steps),name,list(commands)))
+        return self
+
+    def enable_flash(self,time):
+        return self.add(time,"enable_flash",["RUN"])
+
+    def disable_flash(self,time):
+        return self.add(time,"disable_flash",["STOP"])
+
+    def enable_qsw(self,time):
+        return self.add(time,"enable_qsw",["QSW 1"])
+
+    def disable_qsw(self,time):
+        return self.add(time,"disable_qsw",["QSW 0"])
+
+    def set_mode(self,time,mode,**mode_kwargs):
+        """All three QSPAR registers are written in one batch."""
+        values = qspar_from_mode(mode,mode_kwargs)
+        return self.add(time,f"set_mode {mode}",[REGISTERS[name].encode(value) for name, value in zip(MODE_REGISTERS,values)])
+
+    def set_triggers(self,time,flashlamp_trig,qswitch_trig):
+        return self.add(time,"set_triggers",[trigger_command(flashlamp_trig,qswitch_trig)])
+
+    def write(self,time,register,value):
+        """Write any register of LaserProtocol.REGISTERS, checked against the admin mode of the laser."""
+        return self.add(time,f"write {register}",[REGISTERS[register].encode(value,self.laser.admin_mode)])
+
+    ## Running
+    def cancel(self):
+        """Stop a running sequence (from another thread) before its next step."""
+        self.__cancel.set()
+
+    def __wait_until(self,target):
+        """Wait for monotonic() >= target, False if cancelled meanwhile."""
+        remaining = target - monotonic() - SPIN_TIME
+        if remaining > 0 and self.__cancel.wait(remaining):
+            return False
+        while monotonic() < target:
+            pass
+        return not self.__cancel.is_set()
+
+    def run(self,delay=0.):
+        """
+        Run the sequence, starting delay s from now. Returns a StepResult per step, in time order.
+        Steps with the same time are sent together in one pipelined batch.
+        When ABORT_COMMANDS were sent, an "abort" StepResult follows the step that failed, with the abort's own error if it failed too.
+        """
+        self.__cancel.clear()
+        groups = []
+        for step in sorted(self.steps):
+            if groups and groups[-1][0][0] == step[0]:
+                groups[-1].append(step)
+            else:
+                groups.append([step])
+
+        start = monotonic() + delay
+        results = []
+        failed = False
+        aborted = False
+
+        for group in groups:
+            time = group[0][0]
+            if failed:
+                results.extend(StepResult(name,time,None,None,None,None) for time, order, name, commands in group)
+                continue
+
+            target = start + time
+            if not self.__wait_until(target):
+                cancelled = RuntimeError("The sequence was cancelled.")
+                results.extend(StepResult(name,time,None,None,None,cancelled) for time, order, name, commands in group)
+                failed = True
+            else:
+                deadline = None if self.max_lateness is None else target + self.max_lateness
+                sent = monotonic()
+                try:
+                    responses = self.laser.submit([command for step in group for command in step[3]],PRIORITY_CONTROL,deadline).result()
+                    error = None
+                except Exception as e:
+                    responses = None
+                    error = e
+                completed = monotonic()
+
+                index = 0
+                for time, order, name, commands in group:
+                    step_responses = None if responses is None else responses[index:index+len(commands)]
+                    index += len(commands)
+                    step_error = error
+                    refused = [(command, response) for command, response in zip(commands,step_responses or ()) if "ERROR" in response]
+                    if refused:
+                        step_error = command_error(*refused[0])
+                    failed = failed or step_error is not None
+                    results.append(StepResult(name,time,sent - start,None if responses is None else completed - start,
+                                              step_responses,step_error))
+
+            if failed and self.abort_on_error and not aborted:
+                results.append(self.__abort(start,time))
+                aborted = True
+        return results
+
+    def __abort(self,start,time):
+        """Send ABORT_COMMANDS, returns their StepResult. A failure is recorded there, the results of the run still count."""
+        sent = monotonic()
+        try:
+            responses = self.laser.submit(ABORT_COMMANDS,PRIORITY_CONTROL).result()
+        except Exception as e:
+            return StepResult("abort",time,sent - start,None,None,e)
+        refused = [(command, response) for command, response in zip(ABORT_COMMANDS,responses) if "ERROR" in response]
+        return StepResult("abort",time,sent - start,monotonic() - start,responses,command_error(*refused[0]) if refused else None)
+
+def report(results):
+    """Table of planned vs actual times of a run, in ms."""
+    lines = [f"{'step':24s} {'planned':>10s} {'sent':>10s} {'late':>8s} {'took':>8s}"]
+    for result in results:
+        if result.sent is None:
+            lines.append(f"{result.name:24s} {1000*result.planned:10.1f} {'-':>10s} {'-':>8s} {'-':>8s}")
+            continue
+        took = "-" if result.completed is None else f"{1000*(result.completed-result.sent):8.2f}"
+        lines.append(f"{result.name:24s} {1000*result.planned:10.1f} {1000*result.sent:10.2f} {1000*result.lateness:8.2f} {took:>8s}"
+                     + ("" if result.error is None else f"  {result.error!r}"))
+    return "\n".join(lines)
@@ -1,164 +1,396 @@
 # QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
 
-from .LaserCommunication import LaserCommunication
-from threading import Thread, Lock
-from time import sleep
+from .LaserCommunication import LaserCommunication, MIN_READ_TIMEOUT
+from .LaserProtocol import state_dict, REGISTERS, SNAPSHOT_REGISTERS, MODE_REGISTERS, CACHE_TTL, CACHE_INVALIDATES, CONTROL_COMMANDS, command_name
+from .LaserProtocol import LaserError, LaserTimeout, LaserDisconnected, command_error, plan_writes, rollback_error
+from .LaserProtocol import LaserStatus, parse_status, register_name, decode_registers, trigger_name, trigger_value, trigger_command, mode_from_qspar, qspar_from_mode, mode_kwargs_from_dict, snapshot_to_dict
+from .LaserScheduler import LaserScheduler, PRIORITY_CONTROL, PRIORITY_USER, PRIORITY_KEEP_ALIVE
+from .LaserMetrics import LaserMetrics
+from .LaserRecording import SessionRecorder
+from .LaserWatcher import LaserWatcher
+from .LaserTransaction import LaserTransaction
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from threading import Thread, Lock, Event, local
+from time import monotonic
 
 # It seems an undocumented feature of the laser is that it will turn off when the connection is not kept alive.
-# We will just make a "keep alive" thread, and to make sure that it doesn't interfere with other I/O, a mutex to go with it.
-
-state_dict = {\
-              0: "Boot Fault",
-              1: "Warm up",\
-              2: "Laser ready for RUN command",\
-              3: "Flashing -- lamp disabled",\
-              4: "Flashing -- awaiting for shutter to be opened",\
-              5: "Flashing -- Pulse enabled",\
-              6: "Pulsed Laser ON, NLO warm up",\
-              7: "Harmonic generator thermally stabilized",\
-              8: "NLO Optimization",\
-              9: "APM ok : NLO ready"\
-              }
+# We will just make a "keep alive" thread, and to make sure that it doesn't interfere with other I/O, all I/O goes through
+# a LaserScheduler that sends control commands (RUN/STOP/QSW) first and keep alive pings last.
+# Any exchange with the laser keeps the connection alive, so the thread only pings when the link has been idle.
+# When the connection is lost the thread reopens it (with the backoff of LaserCommunication), well before the laser gives up.
 
 class LaserSettings:
-    def __init__(self,admin_mode = False,ip="169.254.0.1",port=10001,timeout=3,keep_alive=3):
-        self.lasercommunication = LaserCommunication(ip,port,timeout)
+    def __init__(self,admin_mode = False,ip="169.254.0.1",port=10001,timeout=3,keep_alive=3,cache=True,cache_ttl=None,start_keep_alive=True,lazy=False,metrics=None,record=None,communication=None,idle_shutdown=None,idle_margin=1.,decode_status=False,adaptive_timeout=False,min_timeout=MIN_READ_TIMEOUT):
+        """
+        timeout: longest wait (in s) for a reply.
+        adaptive_timeout: wait for replies only as long as the measured round trip times suggest (see link), but at least
+        min_timeout s. RUN/STOP/QSW always get the full timeout. See LaserCommunication.
+        keep_alive: ping the laser after this many s without traffic.
+        idle_shutdown: seconds without traffic after which the laser turns itself off. If given, the keep alive interval
+        follows from it instead: as long as possible, while leaving idle_margin s and time for a failed ping and a retry.
+        start_keep_alive: start the keep alive thread. Without it, keep_alive_once has to be called regularly (see LaserFleet).
+        cache: reuse values read from the laser for as long as their time-to-live allows, see LaserProtocol.CACHE_TTL.
+        cache_ttl: dictionary overriding the time-to-live (in s) of individual registers, 0 disables caching for it.
+        lazy: return immediately and connect on the first command, or in the background with connect(wait=False).
+        metrics: True or a (possibly shared) LaserMetrics to record latencies, errors and traffic, see self.metrics.
+        record: path of a file to record all commands and replies to, see LaserRecording.
+        communication: use this transport instead of connecting to ip:port, e.g. a LaserRecording.ReplayCommunication.
+        decode_status: also unpack numeric STATUS replies and answer ready_for_flashlamp/ready_for_qswitch from STATUS,
+        including the interlock. Only for firmware whose STATUS matches LaserProtocol.STATUS_FIELDS/STATUS_BITS.
+
+        Use as `with LaserSettings(...) as laser:` to stop the keep alive and close the connection afterwards.
+        """
+        self.metrics = LaserMetrics() if metrics is True else metrics or None
+        self.recorder = SessionRecorder(record) if record is not None else None
+        if communication is None:
+            communication = LaserCommunication(ip,port,timeout,lazy=lazy,metrics=self.metrics,recorder=self.recorder,
+                                               adaptive_timeout=adaptive_timeout,min_timeout=min_timeout)
+        elif self.metrics is not None and communication.metrics is None:
+            ## E.g. a ReplayCommunication, so the replayed exchanges show up in self.metrics.
+            communication.metrics = self.metrics
+        self.lasercommunication = communication
         self.admin_mode = admin_mode
+        self.decode_status = decode_status
+
+        # Cache of raw responses, register name -> (time of the query, response)
+        self.cache = cache
+        self.cache_ttl = dict(CACHE_TTL)
+        if cache_ttl is not None:
+            self.cache_ttl.update(cache_ttl)
+        self.__cache = dict()
+        ## Number of the connection the cached values were read on, see __cached.
+        self.__cache_connection = getattr(communication,"connections",0)
+
+        # Queries in flight, register name -> (future, index in its batch, priority, deadline), see __get_many.
+        self.__inflight = dict()
+        self.__inflight_lock = Lock()
+
+        # End (time.monotonic()) of the budget of the current thread, see budget.
+        self.__budget = local()
 
         # Threading/keep alive stuff
-        self.__running = True
+        self.__stop = Event()
+        self.__latest_status = None
 
         self.mutex = Lock()
+        self.__watcher = None
+        self.__watcher_lock = Lock()
+        self.scheduler = LaserScheduler(self.lasercommunication,self.mutex,self.metrics)
         self.keep_alive_time = keep_alive
-        self.keep_alive_thread = Thread(target=self.keep_alive_loop)
-        self.keep_alive_thread.start()
+        self.idle_shutdown = idle_shutdown
+        self.idle_margin = idle_margin
+        if self.metrics is not None and hasattr(self.lasercommunication,"rtt"):
+            self.__add_link_gauges()
+        self.keep_alive_thread = None
+        if start_keep_alive:
+            ## A daemon, so a script that forgets to close doesn't hang at exit (the laser then turns itself off).
+            self.keep_alive_thread = Thread(target=self.keep_alive_loop,daemon=True)
+            self.keep_alive_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def connect(self,wait=True):
+        """
+        Open the connection of a lazy LaserSettings now. With wait=False this returns a Future right away,
+        so connecting overlaps with whatever the caller does next.
+        """
+        ## An empty batch only makes sure the connection is open.
+        future = self.scheduler.submit([],PRIORITY_CONTROL)
+        if wait:
+            self.__result(future)
+        return future
+
+    def close(self):
+        """Stop the keep alive and the scheduler and close the connection."""
+        if self.__watcher is not None:
+            self.__watcher.stop()
+        self.join_keep_alive_thread()
+        self.scheduler.stop()
+        self.lasercommunication.close()
+        if self.recorder is not None:
+            self.recorder.close()
 
     def join_keep_alive_thread(self):
-        self.__running = False
-        self.keep_alive_thread.join()
+        self.__stop.set()
+        if self.keep_alive_thread is not None:
+            self.keep_alive_thread.join()
+            self.keep_alive_thread = None
 
     def keep_alive_loop(self):
-        while self.__running:
-            self.status 
-            sleep(self.keep_alive_time)
+        while not self.__stop.is_set():
+            self.__stop.wait(self.keep_alive_once())
+
+    @property
+    def keep_alive_interval(self):
+        """
+        Time (in s) the link may be idle before a ping: keep_alive, or with idle_shutdown what is left of it after
+        idle_margin and twice the current read timeout (a ping that times out, then the reconnect and its handshake).
+        """
+        rtt = getattr(self.lasercommunication,"rtt",None)
+        if self.idle_shutdown is None or rtt is None:
+            return self.keep_alive_time
+        return max(self.idle_shutdown - self.idle_margin - 2*rtt.timeout,self.idle_shutdown/10)
+
+    @property
+    def link(self):
+        """
+        Estimates of the link for monitoring, in s: smoothed round trip time (srtt), its variation (rttvar), the shortest
+        one seen (min_rtt), the read timeout derived from them and the keep alive interval.
+        """
+        rtt = getattr(self.lasercommunication,"rtt",None)
+        estimates = dict() if rtt is None else rtt.to_dict()
+        estimates["keep_alive_interval"] = self.keep_alive_interval
+        return estimates
+
+    def __add_link_gauges(self):
+        labels = {"laser": f"{self.lasercommunication.ip}:{self.lasercommunication.port}"}
+        rtt = self.lasercommunication.rtt
+        self.metrics.add_gauge("rtt_seconds",lambda: rtt.srtt,"Smoothed round trip time to the laser.",labels)
+        self.metrics.add_gauge("rtt_variation_seconds",lambda: rtt.rttvar,"Variation of the round trip time.",labels)
+        self.metrics.add_gauge("read_timeout_seconds",lambda: rtt.timeout,"Read timeout derived from the round trip time.",labels)
+        self.metrics.add_gauge("keep_alive_interval_seconds",lambda: self.keep_alive_interval,"Idle time before a keep alive ping.",labels)
+
+    def keep_alive_once(self):
+        """
+        Ping the laser if the link has been idle for keep_alive_interval, or reconnect if the connection was lost.
+        Returns the time (in s) until the next ping or reconnect attempt is due.
+        """
+        interval = self.keep_alive_interval
+        last_exchange = self.lasercommunication.last_exchange
+        if last_exchange is None:
+            ## Nothing to keep alive before a lazy connection is opened.
+            return interval
+        if not self.lasercommunication.connected:
+            return self.__reconnect()
+        idle = monotonic() - last_exchange
+        if idle >= interval:
+            try:
+                sent = self.__keep_alive_ping()
+            except LaserError:
+                ## The failed ping closed the connection.
+                return self.__reconnect()
+            if self.metrics is not None:
+                self.metrics.keep_alive(sent)
+            if sent:
+                idle = 0
+        # A skipped ping means a command is in flight, we look again shortly after it should have finished.
+        return max(interval - idle, interval/100)
+
+    def __keep_alive_ping(self):
+        # If anything is queued or on the wire there is traffic on the link already, so we don't add to it.
+        if not self.scheduler.idle:
+            return False
+        full_response, = self.__result(self.scheduler.submit(["STATUS"],PRIORITY_KEEP_ALIVE))
+        if "ERROR" not in full_response:
+            self.__publish_status(full_response)
+        return True
+
+    def __reconnect(self):
+        """Reopen a lost connection, returns the time (in s) until the next attempt is due."""
+        wait = self.lasercommunication.next_attempt - monotonic()
+        if wait > 0:
+            return wait
+        try:
+            ## Ahead of queued telemetry, the laser turns off if the link isn't restored in time.
+            self.__result(self.scheduler.submit([],PRIORITY_CONTROL))
+        except LaserError:
+            return max(self.lasercommunication.next_attempt - monotonic(),self.keep_alive_interval/100)
+        return self.keep_alive_interval
+
+    def __publish_status(self,status):
+        try:
+            parsed = parse_status(status,self.decode_status)
+        except ValueError:
+            ## A reply we can't decode must cost neither the raw string nor the keep alive thread.
+            parsed = LaserStatus(None,None,None,None,None,status)
+        self.__latest_status = (monotonic(),parsed)
+
+    @property
+    def latest_status(self):
+        """
+        Latest STATUS read from the laser (by the keep alive or by `status`) as a (time.monotonic() timestamp, LaserStatus) tuple,
+        or None if none has been read yet. This does not talk to the laser.
+        """
+        return self.__latest_status
+
+    def read_register(self,name,use_cache=True):
+        """Read one register of LaserProtocol.REGISTERS, converted to its type."""
+        if not REGISTERS[name].readable:
+            raise ValueError(f"{name} can't be read.")
+        return self.__read_many([name],use_cache)[0]
+
+    def write_register(self,name,value):
+        """Write one register of LaserProtocol.REGISTERS, after checking the type, range and admin mode."""
+        return self.__set(REGISTERS[name].encode(value,self.admin_mode))
+
+    def write_registers(self,values):
+        """
+        Write several registers ({register: value}) as one transaction: the registers that already hold their value are
+        skipped, the rest are written in a single batch, and if the laser refuses any of them the others are restored.
+        Returns the changes as {register: (old, new)}. See also transaction().
+        """
+        for name in values:
+            if not REGISTERS[name].readable:
+                raise ValueError(f"{name} can't be read, so it can't be restored and can't be part of a transaction.")
+        return self.__write_changes(values)
+
+    def transaction(self):
+        """
+        Collect writes and apply them with write_registers at the end of the block:
+
+        with laser.transaction() as transaction:
+            transaction.set_mode("Burst",cycles=2,shots=5,total_length=10)
+            transaction.set_triggers("External","Internal")
+        """
+        return LaserTransaction(self)
+
+    def read_registers(self,registers,use_cache=True,priority=PRIORITY_USER,deadline=None):
+        """
+        Read several registers in one round trip, e.g. read_registers(["CGTEMP","SSHOT"]).
+
+        Takes a list of register names (or (name, type) tuples for a custom conversion) and returns the values in the same order.
+        With use_cache=False every register is read from the laser (the fresh values still end up in the cache).
+        priority and deadline are passed to the scheduler, see LaserScheduler.submit.
+        """
+        return self.__read_many(registers,use_cache,priority,deadline)
+
+    def submit(self,commands,priority=PRIORITY_USER,deadline=None):
+        """
+        Queue raw commands without waiting for them, returns a concurrent.futures.Future of the list of responses.
+        Bypasses the cache, see LaserScheduler.submit for priority and deadline.
+        """
+        names = [command_name(command) for command in commands]
+        return self.scheduler.submit(commands,priority,deadline,lambda responses: self.__invalidate_for(names))
+
+    @contextmanager
+    def budget(self,seconds):
+        """
+        Limit everything this thread asks of the laser within the block to seconds in total, queueing included:
+
+        with laser.budget(0.5):
+            laser.set_mode("Scan",shots=2,total_length=4)
+            laser.enable_flash()
+
+        Whatever can't be answered in time raises LaserTimeout, instead of waiting the full timeout for every reply.
+        Budgets nest, an inner budget can only shorten the outer one.
+        """
+        outer = getattr(self.__budget,"end",None)
+        end = monotonic() + seconds
+        self.__budget.end = end if outer is None else min(outer,end)
+        try:
+            yield
+        finally:
+            self.__budget.end = outer
+
+    def refresh(self,*registers):
+        """Forget cached values so the next read goes to the laser. Without arguments the whole cache is dropped."""
+        self.__invalidate(registers if registers else None)
+
+    @property
+    def watcher(self):
+        """The LaserWatcher shared by everyone waiting for or subscribing to changes of this laser, created on first use."""
+        with self.__watcher_lock:
+            if self.__watcher is None:
+                self.__watcher = LaserWatcher(self)
+            return self.__watcher
+
+    def wait_for_state(self,target,timeout=None):
+        """
+        Block until the laser is in state target (a number or a collection of numbers, see state_dict) and return the state.
+        Raises TimeoutError after timeout s. All waiters share the polling of self.watcher.
+        """
+        return self.watcher.wait_for_state(target,timeout)
 
     @property
     def ready_for_flashlamp(self):
-        return True if self.state == 2 else False
-        # Note that we will probably get a better result here if we look at STATUS, but I don't want to spend time parsing it.
+        if not self.decode_status:
+            return self.state == 2
+        # Answered from a single STATUS exchange, which also takes the interlock into account.
+        ready = self.parsed_status.ready_for_flashlamp
+        if ready is None:
+            ## This firmware doesn't report the state in STATUS.
+            return self.state == 2
+        return ready
 
     @property
     def ready_for_qswitch(self):
-        return True if self.state == 5 else False
-        # Note that we will probably get a better result here if we look at STATUS, but I don't want to spend time parsing it.
+        if not self.decode_status:
+            return self.state == 5
+        ready = self.parsed_status.ready_for_qswitch
+        if ready is None:
+            return self.state == 5
+        return ready
 
     def to_dict(self):
         """Return a description of the object as a dictionary."""
-        _dict = dict()
-
-        _dict["cooling_temp"] = self.cooling_temp
-        _dict["powersupply_version"] = self.powersupply_version
-        _dict["laserbrain_version"] = self.laserbrain_version
-        _dict["flashlamp_voltage"] = self.flashlamp_voltage
-        _dict["flashlamp_pulse_width"] = self.flashlamp_pulse_width
-        _dict["flashlamp_trigger"] = self.flashlamp_trigger
-        _dict["qswitch_trigger"] = self.qswitch_trigger
-        _dict["mode"] = self.mode
-        if self.mode == "Burst":
-            _dict["cycles"] = self.__get_QSPAR1()
-            _dict["total_length"] = self.__get_QSPAR2()
-            _dict["shots"]  = self.__get_QSPAR3()
-        elif self.mode == "F/N Mode":
-            _dict["divider"] = self.__get_QSPAR2()
-        else: #Scan
-            _dict["total_length"] = self.__get_QSPAR2()
-            _dict["shots"] = self.__get_QSPAR3()
-        _dict["qswitch_delay"] = self.qswitch_delay
-        _dict["qswitch_sync_delay"] = self.qswitch_sync_delay
-
-        return _dict
+        # Everything is read in a single pipelined batch, so a snapshot costs about one round trip.
+        return snapshot_to_dict(self.__read_many(SNAPSHOT_REGISTERS))
 
     def settings_from_dict(self,_dict,admin=False):
-        """Set settings from dict, will not set the "admin" settings unless specified."""
+        """
+        Set settings from dict, will not set the "admin" settings unless specified.
 
-        # Only non-admin thing is the qswitch mode.
+        The current configuration is read once and only the registers that differ are written, in a single batch
+        (both triggers share the TRIG register and are written together). Returns the changes as {register: (old, new)}.
+        """
 
-        if "qswitch_trigger" in _dict:
-            self.qswitch_trigger = _dict["qswitch_trigger"]
+        # Only non-admin thing is the qswitch mode.
+        target = dict()
 
-        if "flashlamp_trigger" in _dict:
-            self.flashlamp_trigger = _dict["flashlamp_trigger"]
+        if "flashlamp_trigger" in _dict and "qswitch_trigger" in _dict:
+            target["TRIG"] = trigger_value(_dict["flashlamp_trigger"],_dict["qswitch_trigger"])
+        elif "flashlamp_trigger" in _dict or "qswitch_trigger" in _dict:
+            ## The other trigger keeps its current setting.
+            current = self.read_register("TRIG",use_cache=False)
+            target["TRIG"] = trigger_value(_dict.get("flashlamp_trigger",trigger_name(current[0])),
+                                           _dict.get("qswitch_trigger",trigger_name(current[1])))
 
         if "mode" in _dict:
-            if _dict["mode"] == "Burst":
-                try:
-                    self.set_mode("Burst", {"cycles": int(_dict["cycles"]), 
-                                            "total_length": int(_dict["total_length"]),
-                                            "shots": int(_dict["shots"])})
-                except:
-                    raise ValueError("Error setting mode to Burst, missing parameters. (Required cycles, total_length, shots.)")
-
-            elif _dict["mode"] == "Scan":
-                try:
-                    self.set_mode("Scan", {"total_length": int(_dict["total_length"]),
-                                            "shots": int(_dict["shots"])})
-                except:
-                    raise ValueError("Error setting mode to Scan, missing parameters. (Required total_length, shots.)")
-
-            elif _dict["mode"] == "F/N Mode":
-                try:
-                    self.set_mode("F/N Mode", {"divider": int(_dict["divider"])})
-                except:
-                    raise ValueError("Error setting mode to F/N Mode, missing parameters. (Required divider.)")
+            target.update(zip(MODE_REGISTERS,qspar_from_mode(_dict["mode"],mode_kwargs_from_dict(_dict))))
+
+        changes = self.__write_changes(target)
 
         if admin:
             raise Exception("This feature has not yet been implemented.")
 
+        return changes
+
 
     def get_cooling_temp(self):
-        return self.__get_CGTEMP()
+        return self.read_register("CGTEMP")
         
-    def get_state(self,code=True,string=False):
+    def get_state(self,code=True,string=False,from_status=False):
+        """
+        Returns the state as a number, a string or both.
+        With from_status the state is taken from STATUS, so latest_status is refreshed in the same exchange.
+        """
+        out = self.parsed_status.state if from_status else None
+        if out is None:
+            out = self.read_register("STATE")
+
         if code and string:
-            out = self.__get_STATE()
             return (out,state_dict[out])
         elif string:
-            return self.__get_STATE(string=True)
+            return state_dict[out]
         else:
-            return self.__get_STATE()
+            return out
 
     def enable_flash(self):
-        return self.__FL_RUN()
+        return self.__set("RUN")
         
     def disable_flash(self):
-        return self.__FL_STOP()
+        return self.__set("STOP")
         
     def enable_qsw(self):
-        return self.__QS_RUN()
+        return self.__set("QSW 1")
         
     def disable_qsw(self):
-        return self.__QS_STOP()
-
-    @property
-    def qsw(self):
-        """Status of the qswitch."""
-        msg = self.__get("QSW")
-        msg = msg.split("QSW = ")[1]
-        return bool(int(msg))
-
-    @property
-    def cooling_temp(self):
-        """Returns the temprature of the cooling water."""
-        return self.__get_CGTEMP()
-    @property
-    def powersupply_version(self):
-        """Returns the version of the powersupply."""
-        return self.__get_PSVER()
-
-    @property
-    def laserbrain_version(self):
-        """Return the version of the laser firmware board(?)"""
-        return self.__get_LVERS()
+        return self.__set("QSW 0")
 
     @property
     def state(self):
@@ -171,71 +403,18 @@ class LaserSettings:
         return self.get_state(code=False,string=True)
 
 
-    @property
-    def flashlamp_voltage(self):
-        """Flash Lamp voltage in V"""
-        return self.__get_CAPVSET()
-
-    @flashlamp_voltage.setter
-    def flashlamp_voltage(self,voltage):
-        if isinstance(voltage,int):
-            return self.__set_CAPVSET(voltage)
-        else:
-            raise ValueError("Value must be an integer.")
-   
-    @property
-    def flashlamp_pulse_width(self):
-        """Flash Lamp Pulse Width in us"""
-        return self.__get_LPW()
-
-    @flashlamp_pulse_width.setter
-    def flashlamp_pulse_width(self,pulse_width):
-        if isinstance(pulse_width,int):
-            return self.__set_LPW(pulse_width)
-        else:
-            raise ValueError("Value must be an integer.")
-   
-    @property
-    def flashlamp_shots(self):
-        """Number of shots of the flashlamp, system-tracked."""
-        return self.__get_SSHOT()
-
-    ### We choose not to implement USHOT (User Shot Tracker) right now, although it could be useful to track the number of shots in a given experiment. I welcome contributions to the project. ;-)
-
     @property
     def flashlamp_trigger(self):
         """Flashlamp trigger mode."""
-        trig = self.__get_TRIG()[0]
-        if trig == "I":
-            return "Internal"
-        else:
-            return "External"
+        return trigger_name(self.read_register("TRIG")[0])
 
     @property
     def qswitch_trigger(self):
         """QSwitch trigger mode."""
-        trig = self.__get_TRIG()[1]
-        if trig == "I":
-            return "Internal"
-        else:
-            return "External"
+        return trigger_name(self.read_register("TRIG")[1])
 
     def set_both_triggers(self,flashlamp_trig,qswitch_trig):
-        if flashlamp_trig == "Internal":
-            fl_int = True
-        elif flashlamp_trig == "External":
-            fl_int = False
-        else:
-            ValueError('Value must be "Internal" or "External".')
-
-        if qswitch_trig == "Internal":
-            qs_int = True
-        elif qswitch_trig == "External":
-            qs_int = False
-        else:
-            ValueError('Value must be "Internal" or "External".')
-        
-        return self.__set_TRIG(fl_int,qs_int)
+        return self.__set(trigger_command(flashlamp_trig,qswitch_trig))
 
     @flashlamp_trigger.setter
     def flashlamp_trigger(self,trig):
@@ -273,16 +452,7 @@ class LaserSettings:
         - In Scan mode otherwise
         """
 
-        qs1 = self.__get_QSPAR1()
-        qs2 = self.__get_QSPAR2()
-        qs3 = self.__get_QSPAR3()
-
-        if qs1 != 0:
-            return "Burst"
-        elif qs3 == 1:
-            return "F/N Mode"
-        else:
-            return "Scan"
+        return mode_from_qspar(*self.__read_many(MODE_REGISTERS))
 
     def set_mode(self,mode,**mode_kwargs):
         """
@@ -303,376 +473,223 @@ class LaserSettings:
         F/N:
         - divider
         """
-        if mode == "Burst":
-            if len(mode_kwargs) != 3:
-                raise ValueError("Setting mode to Burst requires 3 options. ('cycles','shots','total_length')")
-            if "cycles" not in mode_kwargs:
-                raise ValueError("Must set number of cycles ('cycles') in Burst mode.")
-            if "shots" not in mode_kwargs:
-                raise ValueError("Must set number of shots ('shots') in Burst mode.")
-            if "total_length" not in mode_kwargs:
-                raise ValueError("Must set total length of cycle ('total_length') in Burst mode.")
-            
-            cycles       = mode_kwargs["cycles"]
-            shots        = mode_kwargs["shots"]
-            total_length = mode_kwargs["total_length"]
-
-            if not isinstance(cycles,int):
-                raise ValueError("Value must be integer. ('cycles')")
-            if not isinstance(shots,int):
-                raise ValueError("Value must be integer. ('shots')")
-            if not isinstance(total_length,int):
-                raise ValueError("Value must be integer. ('total_length')")
-            
-            idle_shots = total_length-shots
-
-            if idle_shots < 0:
-                raise ValueError("Value of 'total_length' must be >= 'shots'.")
-
-            self.__set_QSPAR1(cycles)
-            self.__set_QSPAR2(total_length)
-            self.__set_QSPAR3(shots)
-
-        elif mode == "F/N Mode":
-            if len(mode_kwargs) != 1:
-                raise ValueError("Setting mode to F/N requires 1 option. ('divider')")
-            if "divider" not in mode_kwargs:
-                raise ValueError("Must set number of shots ('divider') in F/N mode.")
-            
-            divider      = mode_kwargs["divider"]
-
-            if not isinstance(divider,int):
-                raise ValueError("Value must be integer. ('shots')")
-
-            if divider < 1:
-                raise ValueError("Value of 'divider' must be >= '1'.")
-
-            self.__set_QSPAR1(0)
-            self.__set_QSPAR2(divider)
-            self.__set_QSPAR3(1)
-
-        elif mode == "Scan":
-            if len(mode_kwargs) != 2:
-                raise ValueError("Setting mode to Burst requires 2 options. ('shots','total_length')")
-            if "shots" not in mode_kwargs:
-                raise ValueError("Must set number of shots ('shots') in Burst mode.")
-            if "total_length" not in mode_kwargs:
-                raise ValueError("Must set total length of cycle ('total_length') in Burst mode.")
-            
-            shots        = mode_kwargs["shots"]
-            total_length = mode_kwargs["total_length"]
-
-            if not isinstance(shots,int):
-                raise ValueError("Value must be integer. ('shots')")
-            if not isinstance(total_length,int):
-                raise ValueError("Value must be integer. ('total_length')")
-            
-            idle_shots = total_length-shots
-
-            if idle_shots < 0:
-                raise ValueError("Value of 'total_length' must be >= 'shots'.")
-
-            self.__set_QSPAR1(0)
-            self.__set_QSPAR2(total_length)
-            self.__set_QSPAR3(shots)
-            pass
-        else:
-            raise ValueError('Value of "mode" must be "Burst", "F/N Mode" or "Scan".')
-   
+        # Registers that already hold the right value are not written again.
+        return self.__write_changes(dict(zip(MODE_REGISTERS,qspar_from_mode(mode,mode_kwargs))))
+
     @property
     def status(self):
         """Returns the status string."""
-        return self.__get_STATUS()
+        full_response = self.__get("STATUS")
+        if "ERROR" in full_response:
+            raise command_error("STATUS",full_response)
+        self.__publish_status(full_response)
+        return full_response
+
+    @property
+    def parsed_status(self):
+        """Reads STATUS and returns it decoded as a LaserStatus (state, interlock, shutter, flashlamp, qswitch)."""
+        self.status
+        return self.__latest_status[1]
 
     def transfer_control_to_QTouch(self):
         self.__set("SSWITCH 1")
         del self
 
-    @property
-    def qswitch_delay(self):
-        """Q-Switch delay in ns"""
-        return self.__get_QDLY()
-
-    @qswitch_delay.setter
-    def qswitch_delay(self,delay):
-        if isinstance(delay,int):
-            if delay < 255 and delay >= 0:
-                return self.__set_QDLY(delay)
-            else:
-                raise ValueError("Value must be between 0 and 255.")
-        else:
-            raise ValueError("Value must be an integer.")
-
-    @property
-    def qswitch_sync_delay(self):
-        """Q-Switch sync output delay in ns"""
-        return self.__get_QDLYO()
-
-    @qswitch_sync_delay.setter
-    def qswitch_sync_delay(self,delay):
-        if isinstance(delay,int):
-            if delay < -500 and delay > 500:
-                return self.__set_QDLYO(delay)
-            else:
-                raise ValueError("Value must be between -500 and 500.")
-        else:
-            raise ValueError("Value must be an integer.")
     ## Communication commands.
     def __get(self,command):
+        return self.__get_many([command])[0]
+        
+    def __get_many(self,commands,use_cache=True,priority=PRIORITY_USER,deadline=None):
+        """Send several queries in one pipelined batch, returns the raw responses in order. Cached values are not queried."""
+        connected = self.lasercommunication.connected
         try:
-            with self.mutex:
-                msg = self.lasercommunication.send_and_recv(command)
+            return self.__get_many_once(commands,use_cache,priority,deadline)
+        except LaserDisconnected:
+            ## The laser closes a connection that was idle too long, which only shows when the next command fails.
+            ## Queries can safely be sent again, so they get one more try on a fresh connection.
+            if not connected:
+                raise
+            return self.__get_many_once(commands,use_cache,priority,deadline)
+
+    def __get_many_once(self,commands,use_cache=True,priority=PRIORITY_USER,deadline=None):
+        now = monotonic()
+        if use_cache:
+            responses = [self.__cached(command,now) for command in commands]
+        else:
+            responses = [None]*len(commands)
+        missing = [command for command, response in zip(commands,responses) if response is None]
+        if not missing:
+            return responses
+
+        end = getattr(self.__budget,"end",None)
+        if end is not None and (deadline is None or end < deadline):
+            deadline = end
+
+        ## Single flight: a query that is already queued or on the wire is not sent again, we wait for its answer instead.
+        ## Only requests that are at least as urgent and have no deadline are joined, so we never inherit a telemetry timeout.
+        waiting = dict()
+        with self.__inflight_lock:
+            for command in missing:
+                if command in waiting:
+                    continue
+                entry = self.__inflight.get(command)
+                if entry is not None and entry[2] <= priority and entry[3] is None:
+                    waiting[command] = entry
+            send = [command for command in dict.fromkeys(missing) if command not in waiting]
+
+            if send:
+                def store(msgs):
+                    ## Runs on the scheduler thread right after the exchange, so a write can't slip in before the answer is stored.
+                    for command, msg in zip(send,msgs):
+                        if self.cache and self.cache_ttl.get(command,0) > 0 and "ERROR" not in msg:
+                            self.__cache[command] = (now,msg)
+
+                future = self.scheduler.submit(send,priority,deadline,store,end)
+                for index, command in enumerate(send):
+                    waiting[command] = self.__inflight[command] = (future,index,priority,deadline)
+                future.add_done_callback(lambda future: self.__landed(future,send))
+
+        answers = {command: self.__result(future,end)[index] for command, (future, index, _, _) in waiting.items()}
+
+        return [answers[command] if response is None else response for command, response in zip(commands,responses)]
+
+    def __result(self,future,end=None):
+        """Wait for a batch of the scheduler, at most until end (a time.monotonic()) if given."""
+        try:
+            return future.result(None if end is None else max(end - monotonic(),0))
+        except LaserError:
+            raise
+        except FutureTimeout:
+            ## Our batch is dropped by the scheduler when its deadline passes, a joined one is left to its owner.
+            raise LaserTimeout("The budget ran out while waiting for the laser.") from None
+        except CancelledError:
+            raise LaserDisconnected("The command was cancelled, the connection is being closed.") from None
+
+    def __landed(self,future,commands):
+        """A batch of queries is answered (or failed), later readers have to send their own."""
+        with self.__inflight_lock:
+            for command in commands:
+                entry = self.__inflight.get(command)
+                if entry is not None and entry[0] is future:
+                    del self.__inflight[command]
+
+    def __cached(self,command,now):
+        """Returns the cached response to a query if it is still valid, None otherwise."""
+        connections = getattr(self.lasercommunication,"connections",0)
+        if connections != self.__cache_connection:
+            ## A new connection may mean a restarted laser, nothing read on the old one can be trusted.
+            self.__cache.clear()
+            self.__cache_connection = connections
+        entry = self.__cache.get(command)
+        if entry is not None and now - entry[0] < self.cache_ttl.get(command,0):
+            return entry[1]
+        return None
+
+    def __invalidate(self,registers):
+        if registers is None:
+            self.__cache.clear()
+        else:
+            for register in registers:
+                self.__cache.pop(register,None)
+
+    def __invalidate_for(self,names):
+        ## Even a failed write may have changed something, so always forget what the command affects.
+        for name in names:
+            self.__invalidate(CACHE_INVALIDATES.get(name,(name,)))
+
+    def __read_many(self,registers,use_cache=True,priority=PRIORITY_USER,deadline=None):
+        """
+        Read several registers in one round trip.
+
+        Takes a list of names (or (name, type) tuples) and returns the converted values in the same order.
+        """
+        responses = self.__get_many([register_name(register) for register in registers],use_cache,priority,deadline)
+
+        return decode_registers(registers,responses)
 
-            return msg
-        except:
-            raise OSError ## Polish this
-        
     def __set(self,command):
+        return self.__set_many([command])
+
+    def __set_many(self,commands):
+        """Send several writes/commands in one pipelined batch, raises LaserCommandError if any of them failed."""
+        for command, response in zip(commands,self.__send_many(commands)):
+            if "ERROR" in response:
+                raise command_error(command,response)
+        return 0
+
+    def __send_many(self,commands):
+        """Send several writes/commands in one pipelined batch and return the responses, without checking them."""
+        names = [command_name(command) for command in commands]
+        priority = PRIORITY_CONTROL if CONTROL_COMMANDS.intersection(names) else PRIORITY_USER
+
+        end = getattr(self.__budget,"end",None)
+        future = self.scheduler.submit(commands,priority,end,lambda responses: self.__invalidate_for(names),end)
         try:
-            with self.mutex:
-                response = self.lasercommunication.send_and_recv(command)
-
-            if "ERROR" not in response:
-                return 0
-            else:
-                raise IOError ## Polish this
-        except:
-            raise IOError ## Polish this
-    
-    
-    ## System commands
-    def __get_STATUS(self):
-        full_response = self.__get("STATUS")
-        if "ERROR" in full_response:
-            raise IOError ## Flesh this out later
-        return full_response
+            responses = self.__result(future,end)
+        except LaserError:
+            ## The callback only runs after a complete exchange, but some of the commands may have arrived.
+            self.__invalidate_for(names)
+            raise
+
+        if priority == PRIORITY_CONTROL and self.__watcher is not None:
+            ## The state is about to change, so anyone waiting for it should see that quickly.
+            self.__watcher.expect_change()
+        return responses
+
+    def __write_changes(self,target):
+        """
+        Write the registers of target ({register: value}) whose value differs from the laser's, as a transaction: all writes
+        go out in a single batch, so nothing else reaches the laser in between, and if any of them fails the ones that
+        were applied are written back to their old values. Returns the changes as {register: (old, new)}.
+        """
+        ## Read from the laser: a cached value may be stale (changed on the front panel, or the laser restarted), and
+        ## skipping a write because of it would leave the laser in a configuration nobody asked for.
+        names = list(target)
+        current = dict(zip(names,self.__read_many(names,use_cache=False)))
+        changes, commands, undo = plan_writes(current,target,self.admin_mode)
+        if not changes:
+            return changes
 
-    ## System commands
-    def __get_PSVER(self):
-        full_response = self.__get("PSVERS")
-        if "ERROR" in full_response:
-            raise IOError ## Flesh this out later
-        version       = float(full_response.split("PSVERS = ")[1])
-        return version
-        
-    def __get_LVERS(self):
-        full_response = self.__get("LVERS")
-        if "ERROR" in full_response:
-            raise IOError ## Flesh this out later
-        version       = float(full_response.split("LVERS = ")[1])
-        return version
-        
-    def __get_UIVERS(self):
-        full_response = self.__get("UIVERS")
-        if "ERROR" in full_response:
-            raise IOError ## Flesh this out later
-        version       = float(full_response.split("UIVERS = ")[1])
-        return version
-        
-    def __get_CGTEMP(self):
-        full_response = self.__get("CGTEMP")
-        if "ERROR" in full_response:
-            raise IOError ## Flesh this out later
-        temp       = float(full_response.split("CGTEMP = ")[1])
-        return temp
-        
-    def __get_CHKSERIAL(self):
-        full_response = self.__get("CHKSERIAL")
-        if "ERROR" in full_response:
-            raise IOError ## Flesh this out later
-        check       = int(full_response.split("CHKSERIAL = ")[1])
-        return check
-        
-    def __set_CHKSERIAL(self,value):
-        response = self.__set(f"CHKSERIAL {value}")
-        if response != 0:
-            raise IOError ## Flesh this out later
-        return response
-        
-    def __set_ECHO(self,value):
-        if self.admin_mode:
-            response = self.__set(f"ECHO {value}")
-            if response != 0:
-                raise IOError ## Flesh this out later
-            return response
-        else:
-            raise RunetimeError("Trying to access a protected function while LaserSettings is not in admin mode.")
-        
-    ## State Command
-    def __get_STATE(self,as_string = False):
-        full_response = self.__get("STATE")
-        if "ERROR" in full_response:
-            raise IOError ## Flesh this out later
-        state       = int(full_response.split("STATE = ")[1])
-        if as_string:
-            return state_dict[state]
-        else:
-            return state
-            
-    ## Flashlamp commands
-    def __get_CAPVSET(self):
-        full_response = self.__get("CAPVSET")
-        if "ERROR" in full_response:
-            raise Exception ## Flesh this out later
-        value       = int(full_response.split("CAPVSET = ")[1])
-        return value
-        
-    def __set_CAPVSET(self,value):
-        if self.admin_mode:
-            response = self.__set(f"CAPVSET = {value}")
-            if response != 0:
-                raise IOError ## Flesh this out later
-            return response
-        else:
-            raise RuntimeError("Trying to access a protected function while LaserSettings is not in admin mode.")
-           
-    def __get_LPW(self):
-        full_response = self.__get("LPW")
-        if "ERROR" in full_response:
-            raise Exception ## Flesh this out later
-        value       = int(full_response.split("LPW = ")[1])
-        return value
-        
-    def __set_LPW(self,value):
-        if self.admin_mode:
-            response = self.__set(f"LPW = {value}")
-            if response != 0:
-                raise IOError ## Flesh this out later
-            return full_response
-        else:
-            raise RuntimeError("Trying to access a protected function while LaserSettings is not in admin mode.")
-            
-    def __get_SSHOT(self):
-        full_response = self.__get("SSHOT")
-        if "ERROR" in full_response:
-            raise Exception ## Flesh this out later
-        check       = int(full_response.split("SSHOT = ")[1])
-        return check
-        
-    def __get_USHOT(self):
-        full_response = self.__get("USHOT")
-        if "ERROR" in full_response:
-            raise Exception ## Flesh this out later
-        value       = int(full_response.split("USHOT = ")[1])
-        return value
-        
-    def __reset_USHOT(self):
-        if self.admin_mode:
-            response = self.__set(f"USHOT 0")
-            if response != 0:
-                raise IOError ## Flesh this out later
-            return response
-        else:
-            raise RuntimeError("Trying to access a protected function while LaserSettings is not in admin mode.")
-    def __get_TRIG(self):
-        full_response = self.__get("TRIG")
-        if "ERROR" in full_response:
-            raise Exception
-        return full_response.split("TRIG = ")[1]
+        try:
+            responses = self.__send_many(commands)
+        except (LaserTimeout,LaserDisconnected) as e:
+            ## No way to tell which writes arrived, so all of them are undone.
+            self.__roll_back(undo,e)
+            raise
+
+        refused = [(command, response) for command, response in zip(commands,responses) if "ERROR" in response]
+        if refused:
+            error = command_error(*refused[0])
+            self.__roll_back([restore for restore, response in zip(undo,responses) if "ERROR" not in response],error)
+            raise error
+        return changes
+
+    def __roll_back(self,undo,error):
+        """Write the old values back after a failed transaction, raises LaserError if that fails as well."""
+        if not undo:
+            return
+        ## The budget of the transaction is probably spent, but leaving the laser half configured is worse than a late answer.
+        end = getattr(self.__budget,"end",None)
+        self.__budget.end = None
+        try:
+            self.__set_many(undo)
+        except LaserError as e:
+            raise rollback_error(error,e) from error
+        finally:
+            self.__budget.end = end
 
-    def __set_TRIG(self,flash_internal = True, q_internal=True):
-        message = "TRIG "
-        if flash_internal:
-            message+="I"
-        else:
-            message+="E"
-        if q_internal:
-            message+="I"
-        else:
-            message+="E"
-        response = self.__set(message)
-        if response != 0:
-            raise IOError ## Flesh this out later
-        return response
-  
-    def __FL_RUN(self):
-        response = self.__set(f"RUN")
-        if response != 0:
-            raise IOError ## Flesh this out later
-        return response
-        
-    def __FL_STOP(self):
-        response = self.__set(f"STOP")
-        if response != 0:
-            raise IOError ## Flesh this out later
-        return response
-        
-    def __get_QSPAR1(self):
-        full_response = self.__get("QSPAR1")
-        if "ERROR" in full_response:
-            raise IOError ## Flesh this out later
-        check       = int(full_response.split("QSPAR1 = ")[1])
-        return check
-        
-    def __set_QSPAR1(self,value):
-        response = self.__set(f"QSPAR1 {value}")
-        if response != 0:
-            raise IOError ## Flesh this out later
-        return response
-        
-    def __get_QSPAR2(self):
-        full_response = self.__get("QSPAR2")
-        if "ERROR" in full_response:
-            raise IOError ## Flesh this out later
-        check       = int(full_response.split("QSPAR2 = ")[1])
-        return check
-        
-    def __set_QSPAR2(self,value):
-        response = self.__set(f"QSPAR2 {value}")
-        if response != 0:
-            raise IOError ## Flesh this out later
-        return response
-        
-    def __get_QSPAR3(self):
-        full_response = self.__get("QSPAR3")
-        if "ERROR" in full_response:
-            raise IOError ## Flesh this out later
-        check       = int(full_response.split("QSPAR3 = ")[1])
-        return check
-        
-    def __set_QSPAR3(self,value):
-        response = self.__set(f"QSPAR3 {value}")
-        if response != 0:
-            raise IOError ## Flesh this out later
-        return response
-        
-    def __get_QDLY(self):
-        full_response = self.__get("QDLY")
-        if "ERROR" in full_response:
-            raise Exception ## Flesh this out later
-        value       = int(full_response.split("QDLY = ")[1])
-        return value
-        
-    def __set_QDLY(self,value):
-        if self.admin_mode:
-            response = self.__set(f"QDLY {value}")
-            if response != 0:
-                raise IOError ## Flesh this out later
-            return response
-        else:
-            raise RuntimeError("Trying to access a protected function while LaserSettings is not in admin mode.")
-         
-    def __get_QDLYO(self):
-        full_response = self.__get("QDLYO")
-        if "ERROR" in full_response:
-            raise IOError ## Flesh this out later
-        check       = int(full_response.split("QDLYO = ")[1])
-        return check
-        
-    def __set_QDLYO(self,value):
-        response = self.__set(f"QDLYO {value}")
-        if response != 0:
-            raise IOError ## Flesh this out later
-        return response
-        
-    def __QS_RUN(self):
-        response = self.__set(f"QSW 1")
-        if response != 0:
-            raise IOError ## Flesh this out later
-        return response
-        
-    def __QS_STOP(self):
-        response = self.__set(f"QSW 0")
-        if response != 0:
-            raise IOError ## Flesh this out later
-        return response
+
+def register_property(register):
+    """Property reading (and if writable, writing) a register of the table."""
+    def get(self):
+        return self.read_register(register.name)
+
+    def set(self,value):
+        self.write_register(register.name,value)
+
+    return property(get,set if register.writable else None,doc=register.doc)
+
+## Accessors of the registers in the table, e.g. flashlamp_voltage for CAPVSET.
+for register in REGISTERS.values():
+    if register.attribute is not None and not hasattr(LaserSettings,register.attribute):
+        setattr(LaserSettings,register.attribute,register_property(register))
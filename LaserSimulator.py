@@ -0,0 +1,351 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import asyncio
+import argparse
+import math
+import random
+from threading import Thread, Event
+from time import monotonic
+
+from .LaserProtocol import command_name
+
+# A stand-in for a Q-Smart laser that speaks the same line protocol, for testing and benchmarking without hardware.
+# Queries are answered with "NAME = value" followed by a status line, writes and commands with a single "OK" or "ERROR".
+# Like the real laser it turns itself off when a connection stays silent for too long.
+
+## Second line sent after every query, the status code of the laser.
+STATUS_LINE = "0"
+
+class SimulatedLaser:
+    """
+    Register model of the laser, shared by all connections to a simulator.
+
+    State transitions: warm up (1) -> ready (2) -> RUN -> 3 -> 4 -> flashing (5) -> QSW 1 -> 6 -> 7 -> 8 -> NLO ready (9).
+    STOP brings the laser back to 2, QSW 0 back to 5. Every step takes transition_time seconds.
+    """
+
+    def __init__(self,warmup_time=0.,transition_time=0.05,rep_rate=10.):
+        self.transition_time = transition_time
+        self.rep_rate = rep_rate
+
+        self.created = monotonic()
+        self.warmup_time = warmup_time
+        self.run_since = None
+        self.qsw_since = None
+        self.shots_base = 0
+        self.ushots_base = 0
+
+        self.registers = {"PSVERS": "1.60",
+                          "LVERS": "2.10",
+                          "UIVERS": "1.05",
+                          "CHKSERIAL": "0",
+                          "CAPVSET": "1200",
+                          "LPW": "180",
+                          "TRIG": "II",
+                          "QSPAR1": "0",
+                          "QSPAR2": "1",
+                          "QSPAR3": "1",
+                          "QDLY": "150",
+                          "QDLYO": "0"}
+
+    ## Live values
+    def state(self,now=None):
+        now = monotonic() if now is None else now
+        if now - self.created < self.warmup_time:
+            return 1
+        if self.run_since is None:
+            return 2
+        if self.qsw_since is None:
+            return min(3 + int((now - self.run_since)/self.transition_time),5) if self.transition_time > 0 else 5
+        return min(6 + int((now - self.qsw_since)/self.transition_time),9) if self.transition_time > 0 else 9
+
+    def __flashing_shots(self,now):
+        if self.run_since is None:
+            return 0
+        return int((now - self.run_since)*self.rep_rate)
+
+    def shots(self,now):
+        return self.shots_base + self.__flashing_shots(now)
+
+    def user_shots(self,now):
+        return self.ushots_base + self.__flashing_shots(now)
+
+    def cooling_temp(self,now):
+        flashing = 1.5 if self.run_since is not None else 0.
+        return 24. + flashing + 0.1*math.sin(now/30.)
+
+    def status(self,now):
+        state = self.state(now)
+        return f"STATE:{state} ILK:1 SHUT:{int(state >= 4)} FL:{int(self.run_since is not None)} QS:{int(self.qsw_since is not None)}"
+
+    def read(self,name,now):
+        """Value of a register as a string, None if there is no such register."""
+        if name == "STATE":
+            return str(self.state(now))
+        if name == "STATUS":
+            return self.status(now)
+        if name == "SSHOT":
+            return str(self.shots(now))
+        if name == "USHOT":
+            return str(self.user_shots(now))
+        if name == "CGTEMP":
+            return f"{self.cooling_temp(now):.2f}"
+        if name == "QSW":
+            return str(int(self.qsw_since is not None))
+        return self.registers.get(name)
+
+    def __stop_flashing(self,now):
+        if self.run_since is not None:
+            self.shots_base += self.__flashing_shots(now)
+            self.ushots_base += self.__flashing_shots(now)
+        self.run_since = None
+        self.qsw_since = None
+
+    def shut_off(self,now=None):
+        """What the laser does when its connection is not kept alive."""
+        self.__stop_flashing(monotonic() if now is None else now)
+
+    def write(self,name,value,now):
+        """Execute a command or register write, returns True if the laser accepts it."""
+        if name == "RUN":
+            if self.state(now) != 2:
+                return False
+            self.run_since = now
+            return True
+        if name == "STOP":
+            self.__stop_flashing(now)
+            return True
+        if name == "QSW":
+            if value == "1":
+                if self.state(now) < 5:
+                    return False
+                if self.qsw_since is None:
+                    self.qsw_since = now
+                return True
+            if value == "0":
+                self.qsw_since = None
+                return True
+            return False
+        if name == "USHOT":
+            if value != "0":
+                return False
+            self.ushots_base = -self.__flashing_shots(now)
+            return True
+        if name in ("SSWITCH","ECHO"):
+            return True
+        if name == "TRIG":
+            if len(value) != 2 or any(trig not in "IE" for trig in value):
+                return False
+            self.registers["TRIG"] = value
+            return True
+        if name in ("CAPVSET","LPW","QSPAR1","QSPAR2","QSPAR3","QDLY","QDLYO","CHKSERIAL"):
+            try:
+                number = int(value)
+            except ValueError:
+                return False
+            if name == "QDLY" and not 0 <= number < 255:
+                return False
+            if name == "QDLYO" and not -500 <= number <= 500:
+                return False
+            self.registers[name] = str(number)
+            return True
+        return False
+
+    def respond(self,command,now=None):
+        """The reply of the laser to one command line, without the trailing line break(s)."""
+        now = monotonic() if now is None else now
+        name = command_name(command)
+        value = command[len(name):].replace("="," ").strip()
+
+        if not value and name not in ("RUN","STOP"):
+            reading = self.read(name,now)
+            if reading is None:
+                return "ERROR"
+            return f"{name} = {reading}\n{STATUS_LINE}"
+
+        return "OK" if self.write(name,value,now) else "ERROR"
+
+class LaserSimulator:
+    """
+    TCP server simulating a Q-Smart laser, serving any number of concurrent connections on one shared SimulatedLaser.
+
+    latency: added round trip time per command in s, jitter: standard deviation added on top of that.
+    command_latency: per-command overrides of latency, e.g. {"STATUS": 0.02}.
+    processing_time: time the laser spends on each command, commands on one connection are processed one after the other.
+    split_packets: send every reply in chunks of chunk_size bytes, split_delay apart.
+    error_rate, drop_rate, disconnect_rate: probability that a command is answered with ERROR, not answered at all,
+    or that the connection is closed instead of answering.
+    idle_shutdown: seconds without any command after which the laser shuts off and closes the connection (None to disable).
+    """
+
+    def __init__(self,host="127.0.0.1",port=0,laser=None,latency=0.,jitter=0.,command_latency=None,processing_time=0.,
+                 split_packets=False,chunk_size=4,split_delay=0.,
+                 error_rate=0.,drop_rate=0.,disconnect_rate=0.,idle_shutdown=10.,seed=None):
+        self.host = host
+        self.port = port
+        self.laser = SimulatedLaser() if laser is None else laser
+
+        self.latency = latency
+        self.jitter = jitter
+        self.command_latency = dict() if command_latency is None else dict(command_latency)
+        self.processing_time = processing_time
+        self.split_packets = split_packets
+        self.chunk_size = chunk_size
+        self.split_delay = split_delay
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.disconnect_rate = disconnect_rate
+        self.idle_shutdown = idle_shutdown
+        self.random = random.Random(seed)
+
+        ## Number of commands received and connections accepted, for tests and benchmarks.
+        self.commands = 0
+        self.connections = 0
+
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.__started = Event()
+        self.__writers = set()
+        self.__handlers = set()
+
+    ## Running the server
+    def start(self):
+        """Start serving in a background thread, the actual port is in self.port afterwards."""
+        self.thread = Thread(target=self.__run,daemon=True)
+        self.thread.start()
+        self.__started.wait()
+        return self
+
+    def stop(self):
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.__shutdown(),self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop = None
+
+    async def __shutdown(self):
+        """Close the server and all open connections."""
+        self.server.close()
+        for writer in list(self.__writers):
+            writer.close()
+        await asyncio.gather(*self.__handlers,return_exceptions=True)
+
+    def __run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle_connection,self.host,self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.__started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    async def serve_forever(self):
+        """Serve from an already running event loop."""
+        self.server = await asyncio.start_server(self.handle_connection,self.host,self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        async with self.server:
+            await self.server.serve_forever()
+
+    ## Connections
+    def __delay(self,name):
+        latency = self.command_latency.get(name,self.latency)
+        if self.jitter:
+            latency += self.random.gauss(0.,self.jitter)
+        return max(latency,0.)
+
+    async def handle_connection(self,reader,writer):
+        self.connections += 1
+        self.__writers.add(writer)
+        self.__handlers.add(asyncio.current_task())
+        ## Replies are delivered in order by a separate task, so pipelined commands overlap their latency like on a real link.
+        outbox = asyncio.Queue()
+        sender = asyncio.get_running_loop().create_task(self.__send_replies(outbox,writer))
+        busy_until = monotonic()
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(),self.idle_shutdown)
+                except asyncio.TimeoutError:
+                    self.laser.shut_off()
+                    break
+                if not line:
+                    break
+                command = line.decode("ascii").strip()
+                if not command:
+                    continue
+                self.commands += 1
+
+                now = monotonic()
+                busy_until = max(busy_until,now) + self.processing_time
+
+                draw = self.random.random()
+                if draw < self.disconnect_rate:
+                    break
+                draw -= self.disconnect_rate
+                if draw < self.drop_rate:
+                    continue
+                draw -= self.drop_rate
+                if draw < self.error_rate:
+                    reply = "ERROR"
+                else:
+                    reply = self.laser.respond(command,busy_until)
+
+                await outbox.put((busy_until + self.__delay(command_name(command)),(reply+"\n").encode("ascii")))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            await outbox.put(None)
+            try:
+                await sender
+            except ConnectionError:
+                pass
+            writer.close()
+            self.__writers.discard(writer)
+            self.__handlers.discard(asyncio.current_task())
+
+    async def __send_replies(self,outbox,writer):
+        deliver_after = 0.
+        while True:
+            item = await outbox.get()
+            if item is None:
+                return
+            deliver_at, reply = item
+            ## Replies never overtake each other, even if the jitter would make a later one arrive earlier.
+            deliver_after = max(deliver_after,deliver_at)
+            delay = deliver_after - monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if self.split_packets:
+                for start in range(0,len(reply),self.chunk_size):
+                    writer.write(reply[start:start+self.chunk_size])
+                    await writer.drain()
+                    if self.split_delay:
+                        await asyncio.sleep(self.split_delay)
+            else:
+                writer.write(reply)
+                await writer.drain()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a Q-Smart laser on a TCP port.")
+    parser.add_argument("--host",default="127.0.0.1")
+    parser.add_argument("--port",type=int,default=10001)
+    parser.add_argument("--latency",type=float,default=0.,help="Added round trip time per command in s.")
+    parser.add_argument("--jitter",type=float,default=0.,help="Standard deviation of the latency in s.")
+    parser.add_argument("--processing-time",type=float,default=0.)
+    parser.add_argument("--split-packets",action="store_true")
+    parser.add_argument("--error-rate",type=float,default=0.)
+    parser.add_argument("--drop-rate",type=float,default=0.)
+    parser.add_argument("--disconnect-rate",type=float,default=0.)
+    parser.add_argument("--idle-shutdown",type=float,default=10.)
+    parser.add_argument("--warmup-time",type=float,default=0.)
+    args = parser.parse_args()
+
+    simulator = LaserSimulator(args.host,args.port,SimulatedLaser(warmup_time=args.warmup_time),
+                               latency=args.latency,jitter=args.jitter,processing_time=args.processing_time,
+                               split_packets=args.split_packets,error_rate=args.error_rate,drop_rate=args.drop_rate,
+                               disconnect_rate=args.disconnect_rate,idle_shutdown=args.idle_shutdown)
+    asyncio.run(simulator.serve_forever())
@@ -0,0 +1,170 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import mmap
+import os
+import struct
+import tempfile
+import traceback
+from collections import namedtuple
+from threading import Thread, Event
+from time import monotonic, time
+
+from .LaserScheduler import PRIORITY_TELEMETRY
+
+# Latest state of the laser in a small memory-mapped file, for any number of local processes that want to look at it
+# many times per second. One publisher polls the laser and writes the values, readers copy them straight out of the
+# mapping: no syscalls, no network traffic, and the load on the laser doesn't grow with the number of readers.
+#
+# Layout (little endian): magic (8 bytes), layout version (uint32), body size (uint32), sequence counter (uint64), body.
+# The counter makes it a seqlock: the publisher makes it odd before and even again after writing the body, a reader
+# copies the body and retries if the counter was odd or changed meanwhile. The counter is 0 until the first publish.
+
+MAGIC = b"QSSNAP\x00\x00"
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = HEADER.size
+BODY_OFFSET = SEQUENCE_OFFSET + SEQUENCE.size
+
+## Registers that are published, in the order of the body after the two timestamps.
+SNAPSHOT_FIELDS = ["STATE","CGTEMP","SSHOT","QSW","TRIG","QSPAR1","QSPAR2","QSPAR3"]
+BODY = struct.Struct("<ddqdq?2s5xqqq")
+
+def default_path(name="qsmart"):
+    """A path in /dev/shm (memory backed) where available, the temporary directory otherwise."""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory,name + ".snapshot")
+
+class Snapshot(namedtuple("Snapshot",["sequence","published","published_wall","state","cgtemp","sshot","qsw","trig",
+                                      "qspar1","qspar2","qspar3"])):
+    """
+    One consistent set of values. published is the time.monotonic() of the poll (comparable between processes on the
+    same machine), published_wall the time.time().
+    """
+    __slots__ = ()
+
+    @property
+    def age(self):
+        """Seconds since the values were read from the laser."""
+        return monotonic() - self.published
+
+class SnapshotPublisher:
+    """
+    Polls the registers of SNAPSHOT_FIELDS every interval s and publishes them at path.
+
+    Reads go through the cache of the LaserSettings, so configuration registers (TRIG, QSPAR) are only read again after
+    they are written, and CGTEMP at most once per second.
+    """
+
+    def __init__(self,laser,path=None,interval=0.1):
+        self.laser = laser
+        self.path = default_path() if path is None else path
+        self.interval = interval
+        self.sequence = 0
+
+        size = BODY_OFFSET + BODY.size
+        fd = os.open(self.path,os.O_RDWR | os.O_CREAT,0o644)
+        try:
+            os.ftruncate(fd,size)
+            self.map = mmap.mmap(fd,size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.map,0,MAGIC,VERSION,BODY.size)
+        SEQUENCE.pack_into(self.map,SEQUENCE_OFFSET,0)
+
+        self.__stop = Event()
+        self.thread = None
+
+    def publish(self,state,cgtemp,sshot,qsw,trig,qspar1,qspar2,qspar3,published=None):
+        """Write one set of values, e.g. from another source than the poller."""
+        published = monotonic() if published is None else published
+        SEQUENCE.pack_into(self.map,SEQUENCE_OFFSET,self.sequence + 1)
+        BODY.pack_into(self.map,BODY_OFFSET,published,time(),state,cgtemp,sshot,qsw,trig.encode("ascii"),qspar1,qspar2,qspar3)
+        self.sequence += 2
+        SEQUENCE.pack_into(self.map,SEQUENCE_OFFSET,self.sequence)
+
+    def poll_once(self):
+        values = self.laser.read_registers(SNAPSHOT_FIELDS,priority=PRIORITY_TELEMETRY)
+        self.publish(*values)
+
+    def start(self):
+        self.__stop.clear()
+        self.thread = Thread(target=self.poll_loop,daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.__stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        """Stop polling and remove the segment."""
+        self.stop()
+        self.map.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def poll_loop(self):
+        next_poll = monotonic()
+        failure = None
+        while not self.__stop.is_set():
+            try:
+                self.poll_once()
+                failure = None
+            except (OSError,ValueError,struct.error) as e:
+                ## Readers see the age of the last good values grow. A failure is reported when it starts (or changes),
+                ## not on every poll while the laser is away.
+                if repr(e) != failure:
+                    traceback.print_exc()
+                failure = repr(e)
+            next_poll = max(next_poll + self.interval,monotonic())
+            self.__stop.wait(next_poll - monotonic())
+
+class SnapshotReader:
+    """
+    Reads the segment of a SnapshotPublisher, in any process.
+
+    timeout: longest time (in s) read waits for a publish in progress, a publisher that died halfway through one never finishes it.
+    """
+
+    def __init__(self,path=None,timeout=0.01):
+        self.path = default_path() if path is None else path
+        self.timeout = timeout
+        with open(self.path,"rb") as file:
+            self.map = mmap.mmap(file.fileno(),0,access=mmap.ACCESS_READ)
+        magic, version, size = HEADER.unpack_from(self.map,0)
+        if magic != MAGIC or version != VERSION or size != BODY.size:
+            self.map.close()
+            raise ValueError(f"{self.path} is not a compatible laser snapshot.")
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def read(self):
+        """The latest Snapshot, None if nothing has been published yet. Raises TimeoutError if it stays inconsistent."""
+        give_up = None
+        while True:
+            sequence = SEQUENCE.unpack_from(self.map,SEQUENCE_OFFSET)[0]
+            if not sequence & 1:
+                body = BODY.unpack_from(self.map,BODY_OFFSET)
+                if SEQUENCE.unpack_from(self.map,SEQUENCE_OFFSET)[0] == sequence:
+                    break
+            ## The publisher is writing right now, that takes microseconds.
+            now = monotonic()
+            if give_up is None:
+                give_up = now + self.timeout
+            elif now > give_up:
+                raise TimeoutError(f"The snapshot in {self.path} stayed half written for {self.timeout} s, "
+                                   "the publisher probably stopped while writing it.")
+        if sequence == 0:
+            return None
+        published, published_wall, state, cgtemp, sshot, qsw, trig, qspar1, qspar2, qspar3 = body
+        return Snapshot(sequence,published,published_wall,state,cgtemp,sshot,qsw,trig.decode("ascii"),qspar1,qspar2,qspar3)
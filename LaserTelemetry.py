@@ -0,0 +1,174 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import numpy as np
+from threading import Thread, Lock, Event
+from time import monotonic, time
+
+from .LaserScheduler import PRIORITY_TELEMETRY
+
+# Telemetry: poll a set of registers at their own rate and keep the samples in fixed-size ring buffers.
+# Memory use is set by the buffer size only, so a poller can run for weeks. Readers get copies of the window they ask for,
+# never of the whole buffer, and can query while the poller keeps writing.
+# For a complete history on disk, pass a LaserTelemetryLog.TelemetryLog as log.
+
+## Registers that can be polled and the dtype of their samples, values are decoded as in LaserProtocol.REGISTERS.
+## The position in this table is the register id in telemetry logs, so new registers go at the end.
+TELEMETRY_REGISTERS = {"CGTEMP": np.float64,
+                       "STATE": np.int64,
+                       "SSHOT": np.int64,
+                       "USHOT": np.int64,
+                       "QSW": np.int64,
+                       "TRIG": "S2",
+                       "QSPAR1": np.int64,
+                       "QSPAR2": np.int64,
+                       "QSPAR3": np.int64,
+                       "QDLY": np.int64,
+                       "QDLYO": np.int64,
+                       "CAPVSET": np.int64,
+                       "LPW": np.int64}
+
+## Configuration registers only change when they are written, so they are read through the cache (which the write
+## invalidates) and a sample is only stored when the value changed.
+CONFIG_REGISTERS = frozenset(("TRIG","QSPAR1","QSPAR2","QSPAR3","QDLY","QDLYO","CAPVSET","LPW"))
+
+class RingBuffer:
+    """Fixed-size buffer of (time.monotonic() timestamp, value) samples, overwriting the oldest sample when full."""
+
+    def __init__(self,size,dtype=np.float64):
+        self.size = size
+        self.times = np.zeros(size,dtype=np.float64)
+        self.values = np.zeros(size,dtype=dtype)
+        ## Total number of samples ever appended, the next sample goes to index count % size.
+        self.count = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return min(self.count,self.size)
+
+    def append(self,timestamp,value):
+        with self.lock:
+            index = self.count % self.size
+            self.times[index] = timestamp
+            self.values[index] = value
+            self.count += 1
+
+    def __segments(self):
+        """The stored samples as (at most) two chronological slices of the arrays."""
+        if self.count <= self.size:
+            return [slice(0,self.count)]
+        head = self.count % self.size
+        return [slice(head,self.size),slice(0,head)]
+
+    def last(self,n):
+        """Copies of the timestamps and values of the last n samples."""
+        with self.lock:
+            n = min(n,len(self))
+            start = self.count - n
+            indices = np.arange(start,self.count) % self.size
+            return self.times[indices], self.values[indices]
+
+    def since(self,timestamp):
+        """Copies of the timestamps and values of all samples taken at or after timestamp."""
+        with self.lock:
+            times = []
+            values = []
+            for segment in self.__segments():
+                segment_times = self.times[segment]
+                start = np.searchsorted(segment_times,timestamp)
+                times.append(segment_times[start:])
+                values.append(self.values[segment][start:])
+            return np.concatenate(times), np.concatenate(values)
+
+class LaserTelemetry:
+    """
+    Polls registers of a LaserSettings object in a background thread.
+
+    rates: dictionary of register name to poll rate in Hz, e.g. {"CGTEMP": 1, "STATE": 10, "SSHOT": 10}.
+    size: number of samples kept per register.
+    log: a TelemetryLog every sample is appended to as well, with a time.time() timestamp.
+
+    Registers that are due at the same time are read in a single round trip (the configuration registers in a second,
+    which the cache usually answers without asking the laser).
+    """
+
+    def __init__(self,laser,rates={"CGTEMP": 1., "STATE": 10., "SSHOT": 10.},size=65536,log=None):
+        for register in rates:
+            if register not in TELEMETRY_REGISTERS:
+                raise ValueError(f"Can't poll {register}, supported are {', '.join(TELEMETRY_REGISTERS)}.")
+
+        self.laser = laser
+        self.rates = dict(rates)
+        self.buffers = {register: RingBuffer(size,TELEMETRY_REGISTERS[register]) for register in rates}
+        self.log = log
+        ## Last value stored of each configuration register.
+        self.__config = dict()
+
+        self.__stop = Event()
+        self.thread = None
+
+    def start(self):
+        self.__stop.clear()
+        self.thread = Thread(target=self.poll_loop,daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def poll_loop(self):
+        next_poll = dict.fromkeys(self.rates,monotonic())
+        while not self.__stop.is_set():
+            now = monotonic()
+            due = [register for register, when in next_poll.items() if when <= now]
+            if due:
+                ## A sample that can't be taken before the next one is due is worthless, so the poll gives up then.
+                deadline = now + min(1/self.rates[register] for register in due)
+                live = [register for register in due if register not in CONFIG_REGISTERS]
+                config = [register for register in due if register in CONFIG_REGISTERS]
+                try:
+                    values = self.laser.read_registers(live,use_cache=False,priority=PRIORITY_TELEMETRY,deadline=deadline) if live else []
+                    if config:
+                        values += self.laser.read_registers(config,priority=PRIORITY_TELEMETRY,deadline=deadline)
+                except OSError:
+                    ## Missed (or failed) sample, we simply try again at the next poll.
+                    values = None
+                timestamp = monotonic()
+                wall_time = time()
+                for register in due:
+                    ## Stay on the original grid, but don't try to catch up on polls we missed.
+                    next_poll[register] = max(next_poll[register] + 1/self.rates[register],timestamp)
+                if values is not None:
+                    for register, value in zip(live+config,values):
+                        if register in CONFIG_REGISTERS:
+                            if self.__config.get(register) == value:
+                                continue
+                            self.__config[register] = value
+                        self.buffers[register].append(timestamp,value)
+                        if self.log is not None:
+                            self.log.append(register,wall_time,value)
+            self.__stop.wait(max(min(next_poll.values()) - monotonic(),0))
+
+    ## Queries
+    def last(self,register,n):
+        """Timestamps and values of the last n samples of a register."""
+        return self.buffers[register].last(n)
+
+    def window(self,register,seconds):
+        """Timestamps and values of a register sampled in the last `seconds` seconds."""
+        return self.buffers[register].since(monotonic()-seconds)
+
+    def stats(self,register,seconds):
+        """Mean, minimum and maximum of a register over the last `seconds` seconds (None if there are no samples)."""
+        times, values = self.window(register,seconds)
+        if len(values) == 0:
+            return None
+        return {"mean": float(np.mean(values)), "min": values.min().item(), "max": values.max().item(), "samples": len(values)}
+
+    def shot_rate(self,seconds,register="SSHOT"):
+        """Shots per second over the last `seconds` seconds, from the change in the shot counter (None if not enough samples)."""
+        times, values = self.window(register,seconds)
+        if len(values) < 2 or times[-1] == times[0]:
+            return None
+        return float(values[-1]-values[0])/(times[-1]-times[0])
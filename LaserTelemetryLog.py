@@ -0,0 +1,231 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import mmap
+import os
+import queue
+import numpy as np
+from threading import Thread, Lock
+
+from .LaserTelemetry import TELEMETRY_REGISTERS
+
+# Telemetry history on disk, for runs of weeks. Samples are collected in memory per register and written in chunks by a
+# background thread, so appending a sample is a couple of array stores and never waits for the disk.
+#
+# Two append-only files:
+#   path      magic, then chunks: the timestamps (float64, time.time()) of n samples of one register, followed by the n
+#             values in the register's dtype (see LaserTelemetry.TELEMETRY_REGISTERS), padded to a multiple of 8 bytes.
+#   path.idx  magic, then one INDEX record per chunk: register id, number of samples, first and last timestamp, offset.
+# A chunk is written before its index record, so a reader (even while the log is written, or after a crash) never sees
+# a chunk that isn't complete. Readers map both files and take the samples straight out of the mapping as NumPy arrays.
+
+DATA_MAGIC = b"QSTLOG1\n"
+INDEX_MAGIC = b"QSTIDX1\n"
+INDEX = np.dtype([("register","<u2"),("pad","V2"),("count","<u4"),("first","<f8"),("last","<f8"),("offset","<u8")])
+
+## Register id in the files: the position in TELEMETRY_REGISTERS.
+REGISTER_IDS = {register: index for index, register in enumerate(TELEMETRY_REGISTERS)}
+REGISTER_NAMES = list(TELEMETRY_REGISTERS)
+DTYPES = [np.dtype(dtype) for dtype in TELEMETRY_REGISTERS.values()]
+
+def _padding(size):
+    return -size % 8
+
+class TelemetryLog:
+    """
+    Appends samples to a log at path, e.g. as LaserTelemetry(laser,rates,log=TelemetryLog("run.qstlog")).
+
+    chunk_size: samples per register collected before a chunk is written.
+    flush_interval: partial chunks are written at least this often (in s), so a crash loses little and readers keep up.
+    An existing log is appended to.
+    """
+
+    def __init__(self,path,chunk_size=4096,flush_interval=10.):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+
+        self.data = self.__open(path,DATA_MAGIC)
+        self.index = self.__open(path + ".idx",INDEX_MAGIC)
+        ## Drop a chunk without index record that a crash may have left behind, it would be unreachable anyway.
+        self.__drop_unindexed()
+
+        self.__lock = Lock()
+        ## Register id -> (timestamps, values, number of samples in them).
+        self.__buffers = dict()
+        self.__queue = queue.Queue()
+        self.writer = Thread(target=self.__write_loop,daemon=True)
+        self.writer.start()
+
+    @staticmethod
+    def __open(path,magic):
+        file = open(path,"ab+")
+        if file.tell() == 0:
+            file.write(magic)
+        else:
+            file.seek(0)
+            if file.read(len(magic)) != magic:
+                file.close()
+                raise ValueError(f"{path} is not a QSmartControl telemetry log.")
+            file.seek(0,os.SEEK_END)
+        return file
+
+    def __drop_unindexed(self):
+        records = (self.index.tell() - len(INDEX_MAGIC))//INDEX.itemsize
+        self.index.truncate(len(INDEX_MAGIC) + records*INDEX.itemsize)
+        end = len(DATA_MAGIC)
+        if records:
+            self.index.seek(len(INDEX_MAGIC) + (records - 1)*INDEX.itemsize)
+            last = np.frombuffer(self.index.read(INDEX.itemsize),INDEX)[0]
+            size = int(last["count"])*(8 + DTYPES[last["register"]].itemsize)
+            end = int(last["offset"]) + size + _padding(size)
+        self.index.seek(0,os.SEEK_END)
+        self.data.truncate(end)
+        self.data.seek(0,os.SEEK_END)
+
+    def append(self,register,timestamp,value):
+        """Add one sample, timestamp is a time.time(). Cheap enough to call from a polling loop."""
+        register = REGISTER_IDS[register]
+        with self.__lock:
+            buffer = self.__buffers.get(register)
+            if buffer is None:
+                buffer = [np.empty(self.chunk_size,np.float64),np.empty(self.chunk_size,DTYPES[register]),0]
+                self.__buffers[register] = buffer
+            count = buffer[2]
+            buffer[0][count] = timestamp
+            buffer[1][count] = value
+            buffer[2] = count + 1
+            if count + 1 == self.chunk_size:
+                ## The full arrays are handed to the writer, new samples go into fresh ones.
+                del self.__buffers[register]
+                self.__queue.put((register,buffer[0],buffer[1]))
+
+    def __hand_over_partial(self):
+        with self.__lock:
+            for register, (times, values, count) in self.__buffers.items():
+                if count:
+                    self.__queue.put((register,times[:count].copy(),values[:count].copy()))
+            self.__buffers.clear()
+
+    def flush(self):
+        """Write everything appended so far and wait until it is on disk."""
+        self.__hand_over_partial()
+        self.__queue.join()
+
+    def close(self):
+        self.flush()
+        self.__queue.put(None)
+        self.writer.join()
+        self.data.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def __write_loop(self):
+        while True:
+            try:
+                item = self.__queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self.__hand_over_partial()
+                continue
+            try:
+                if item is None:
+                    return
+                self.__write_chunk(*item)
+            finally:
+                self.__queue.task_done()
+
+    def __write_chunk(self,register,times,values):
+        offset = self.data.tell()
+        size = times.nbytes + values.nbytes
+        self.data.write(times.tobytes())
+        self.data.write(values.tobytes())
+        self.data.write(bytes(_padding(size)))
+        self.data.flush()
+
+        record = np.zeros(1,INDEX)
+        record["register"] = register
+        record["count"] = len(times)
+        record["first"] = times[0]
+        record["last"] = times[-1]
+        record["offset"] = offset
+        self.index.write(record.tobytes())
+        self.index.flush()
+
+class TelemetryLogReader:
+    """
+    Reads a telemetry log through mmap, also while it is being written (new chunks show up on the next read).
+
+    with TelemetryLogReader("run.qstlog") as log:
+        times, temps = log.read("CGTEMP",start=time.time() - 86400)
+    """
+
+    def __init__(self,path):
+        self.path = path
+        self.data = None
+        self.index = None
+        self.__map()
+        if self.data[:len(DATA_MAGIC)] != DATA_MAGIC or self.index[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a QSmartControl telemetry log.")
+
+    def __map(self):
+        """(Re)map the files if they grew since the last read."""
+        ## The index first: a chunk is on disk before its index record, so the data mapping then covers every record.
+        for name, path in (("index",self.path + ".idx"),("data",self.path)):
+            current = getattr(self,name)
+            if current is None or os.path.getsize(path) > len(current):
+                with open(path,"rb") as file:
+                    setattr(self,name,mmap.mmap(file.fileno(),0,access=mmap.ACCESS_READ))
+                ## A mapping still in use by an array returned earlier is closed when that array goes away.
+
+    def close(self):
+        self.data = None
+        self.index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def chunks(self):
+        """The index as a NumPy structured array (register, count, first, last, offset), one row per chunk."""
+        self.__map()
+        count = (len(self.index) - len(INDEX_MAGIC))//INDEX.itemsize
+        return np.frombuffer(self.index,INDEX,count,len(INDEX_MAGIC))
+
+    @property
+    def registers(self):
+        """Names of the registers with samples in the log."""
+        return [REGISTER_NAMES[register] for register in np.unique(self.chunks()["register"])]
+
+    def read(self,register,start=None,end=None):
+        """
+        Timestamps (time.time()) and values of register sampled in [start, end], either bound may be None.
+        Only the chunks overlapping the range are touched, the arrays are copied straight out of the mapping.
+        """
+        register_id = REGISTER_IDS[register]
+        dtype = DTYPES[register_id]
+        chunks = self.chunks()
+        selected = chunks["register"] == register_id
+        if start is not None:
+            selected &= chunks["last"] >= start
+        if end is not None:
+            selected &= chunks["first"] <= end
+
+        times = []
+        values = []
+        for count, offset in zip(chunks["count"][selected].tolist(),chunks["offset"][selected].tolist()):
+            chunk_times = np.frombuffer(self.data,np.float64,count,offset)
+            chunk_values = np.frombuffer(self.data,dtype,count,offset + 8*count)
+            first = 0 if start is None else np.searchsorted(chunk_times,start,"left")
+            last = count if end is None else np.searchsorted(chunk_times,end,"right")
+            times.append(chunk_times[first:last])
+            values.append(chunk_values[first:last])
+        if not times:
+            return np.empty(0,np.float64), np.empty(0,dtype)
+        return np.concatenate(times), np.concatenate(values)
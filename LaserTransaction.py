@@ -0,0 +1,47 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+from .LaserProtocol import REGISTERS, MODE_REGISTERS, trigger_value, qspar_from_mode
+
+# Transactions: a group of register writes that reaches the laser as one pipelined batch, so no other command can come
+# in between, and that is undone if the laser refuses any part of it. A mode switch then can't leave the laser with the
+# QSPAR registers of two different modes. The work is done by LaserSettings.write_registers, this only collects the values.
+
+class LaserTransaction:
+    """
+    Writes collected in a with block (or until commit), see LaserSettings.transaction.
+    Every method checks its arguments right away, so a mistake raises before anything is sent.
+    """
+
+    def __init__(self,laser):
+        self.laser = laser
+        self.target = dict()
+        ## {register: (old, new)} after the commit.
+        self.changes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is None:
+            self.commit()
+
+    def write(self,register,value):
+        """Write any register of LaserProtocol.REGISTERS, later writes of the same register replace earlier ones."""
+        REGISTERS[register].encode(value,self.laser.admin_mode)
+        self.target[register] = value
+        return self
+
+    def set_mode(self,mode,**mode_kwargs):
+        """See LaserSettings.set_mode."""
+        self.target.update(zip(MODE_REGISTERS,qspar_from_mode(mode,mode_kwargs)))
+        return self
+
+    def set_triggers(self,flashlamp_trig,qswitch_trig):
+        self.target["TRIG"] = trigger_value(flashlamp_trig,qswitch_trig)
+        return self
+
+    def commit(self):
+        """Apply the writes, returns the changes as {register: (old, new)}."""
+        self.changes = self.laser.write_registers(self.target)
+        self.target = dict()
+        return self.changes
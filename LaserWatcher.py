@@ -0,0 +1,222 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import asyncio
+import traceback
+from collections import namedtuple
+from threading import Thread, Condition
+from time import monotonic
+
+from .LaserProtocol import TRANSIENT_STATES
+from .LaserScheduler import PRIORITY_TELEMETRY
+
+# Waiting for the laser: one poller per laser reads STATE and QSW (and CGTEMP when someone watches the temperature) and
+# hands every change to all waiters and subscribers, so any number of them cost a single stream of queries.
+# The poller only runs while someone is listening, and adapts its rate: fast while the laser is in a transient state or has
+# just changed, backing off towards the slow rate while nothing happens (e.g. during a warm up of several minutes).
+
+class LaserEvent(namedtuple("LaserEvent",["kind","old","new","time"])):
+    """
+    A change seen by the poller. kind is "state", "qsw" or "cgtemp" (a temperature threshold was crossed),
+    old and new are the values before and after, time is the time.monotonic() of the poll that saw it.
+    """
+    __slots__ = ()
+
+class Subscription:
+    """Returned by LaserWatcher.subscribe, call unsubscribe() to stop receiving events."""
+
+    def __init__(self,watcher,callback,kinds,thresholds):
+        self.watcher = watcher
+        self.callback = callback
+        self.kinds = kinds
+        self.thresholds = tuple(thresholds)
+
+    def unsubscribe(self):
+        self.watcher.unsubscribe(self)
+
+    def events_for(self,changes,old_temp,new_temp,time):
+        """Events of one poll this subscriber wants."""
+        events = [event for event in changes if self.kinds is None or event.kind in self.kinds]
+        if old_temp is not None and new_temp is not None:
+            for threshold in self.thresholds:
+                if (old_temp < threshold) != (new_temp < threshold):
+                    events.append(LaserEvent("cgtemp",old_temp,new_temp,time))
+                    break
+        return events
+
+class LaserWatcher:
+    """
+    Shared poller of a LaserSettings, usually reached through laser.watcher / laser.wait_for_state.
+
+    fast, slow: shortest and longest time between polls in s. backoff: factor the interval grows by per quiet poll.
+    settle: polls stay fast for this many s after a change.
+    """
+
+    def __init__(self,laser,fast=0.05,slow=1.,backoff=1.5,settle=2.):
+        self.laser = laser
+        self.fast = fast
+        self.slow = slow
+        self.backoff = backoff
+        self.settle = settle
+
+        ## Latest values and the time.monotonic() they were read, None before the first poll.
+        self.state = None
+        self.qsw = None
+        self.cgtemp = None
+        self.sampled = None
+        self.interval = fast
+
+        self.__condition = Condition()
+        self.__subscriptions = []
+        self.__waiters = 0
+        self.__poll_now = False
+        self.__last_change = monotonic()
+        self.__running = True
+        self.__thread = None
+
+    def __start(self):
+        ## Called with the condition held.
+        if self.__thread is None:
+            self.__thread = Thread(target=self.poll_loop,daemon=True)
+            self.__thread.start()
+        self.__condition.notify_all()
+
+    def stop(self):
+        """Stop polling, waiters still blocked in wait_for get a RuntimeError."""
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def expect_change(self):
+        """Poll fast from now on, e.g. because a RUN or QSW command was just sent (LaserSettings does this itself)."""
+        with self.__condition:
+            self.__last_change = monotonic()
+            self.interval = self.fast
+            if self.__subscriptions or self.__waiters:
+                self.__poll_now = True
+                self.__condition.notify_all()
+
+    ## Listening
+    def subscribe(self,callback,kinds=("state","qsw"),thresholds=()):
+        """
+        Call callback(LaserEvent) on every change of the given kinds (None for all), on the poller thread.
+        thresholds: CGTEMP values (degC), an event of kind "cgtemp" is sent whenever the temperature crosses one.
+        """
+        subscription = Subscription(self,callback,None if kinds is None else frozenset(kinds),thresholds)
+        with self.__condition:
+            self.__subscriptions.append(subscription)
+            self.__start()
+        return subscription
+
+    def unsubscribe(self,subscription):
+        with self.__condition:
+            if subscription in self.__subscriptions:
+                self.__subscriptions.remove(subscription)
+
+    async def events(self,kinds=("state","qsw"),thresholds=()):
+        """Async iterator over the events of subscribe, e.g. `async for event in laser.watcher.events(): ...`."""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        subscription = self.subscribe(lambda event: loop.call_soon_threadsafe(queue.put_nowait,event),kinds,thresholds)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            subscription.unsubscribe()
+
+    def wait_for(self,predicate,timeout=None):
+        """
+        Wait until predicate(watcher) is true for a poll newer than this call, returns the watcher.
+        Raises TimeoutError if that doesn't happen within timeout s, RuntimeError if the watcher is (or gets) stopped.
+        """
+        called = monotonic()
+        deadline = None if timeout is None else called + timeout
+        with self.__condition:
+            if not self.__running:
+                raise RuntimeError("The watcher is stopped.")
+            self.__waiters += 1
+            ## A waiter wants a fresh answer, not to sit out a slow interval.
+            if self.sampled is None or called - self.sampled > self.fast:
+                self.__poll_now = True
+            self.__start()
+            try:
+                while self.sampled is None or (self.__poll_now and self.sampled < called) or not predicate(self):
+                    if not self.__running:
+                        ## Nobody will poll anymore, the condition can't become true.
+                        raise RuntimeError("The watcher was stopped while waiting.")
+                    remaining = None if deadline is None else deadline - monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"Condition not met within {timeout} s, the laser is in state {self.state}.")
+                    self.__condition.wait(remaining)
+            finally:
+                self.__waiters -= 1
+        return self
+
+    def wait_for_state(self,target,timeout=None):
+        """Wait until the laser is in state target (a number or a collection of numbers), returns the state."""
+        targets = {target} if isinstance(target,int) else set(target)
+        return self.wait_for(lambda watcher: watcher.state in targets,timeout).state
+
+    def wait_for_qsw(self,on=True,timeout=None):
+        """Wait until the Q-switch is on (or off)."""
+        return self.wait_for(lambda watcher: watcher.qsw == on,timeout).qsw
+
+    ## Polling
+    def poll_loop(self):
+        while True:
+            with self.__condition:
+                while self.__running and not self.__subscriptions and not self.__waiters:
+                    self.__condition.wait()
+                if not self.__running:
+                    return
+                temperature = any(subscription.thresholds for subscription in self.__subscriptions)
+
+            registers = ["STATE","QSW","CGTEMP"] if temperature else ["STATE","QSW"]
+            try:
+                values = self.laser.read_registers(registers,use_cache=False,priority=PRIORITY_TELEMETRY)
+            except OSError:
+                values = None
+            now = monotonic()
+
+            with self.__condition:
+                if values is None:
+                    self.interval = self.slow
+                    subscriptions = ()
+                else:
+                    changes = []
+                    state, qsw = values[0], values[1]
+                    if self.sampled is not None and state != self.state:
+                        changes.append(LaserEvent("state",self.state,state,now))
+                    if self.sampled is not None and qsw != self.qsw:
+                        changes.append(LaserEvent("qsw",self.qsw,qsw,now))
+                    old_temp = self.cgtemp
+                    new_temp = values[2] if temperature else None
+                    self.state, self.qsw = state, qsw
+                    if temperature:
+                        self.cgtemp = new_temp
+                    self.sampled = now
+                    self.__poll_now = False
+                    self.__condition.notify_all()
+
+                    if changes:
+                        self.__last_change = now
+                    if state in TRANSIENT_STATES or now - self.__last_change < self.settle:
+                        self.interval = self.fast
+                    else:
+                        self.interval = min(self.interval*self.backoff,self.slow)
+                    subscriptions = list(self.__subscriptions)
+
+            for subscription in subscriptions:
+                for event in subscription.events_for(changes,old_temp,new_temp,now):
+                    try:
+                        subscription.callback(event)
+                    except Exception:
+                        ## A broken subscriber must not stop the poller for everyone else.
+                        traceback.print_exc()
+
+            with self.__condition:
+                ## A failed poll leaves __poll_now set for the waiters, but retrying at once would only spin on a dead link.
+                if self.__running and (values is None or not self.__poll_now):
+                    self.__condition.wait(self.interval)
@@ -0,0 +1,26 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+import pytest
+
+# The modules import each other relatively, so the repository is registered as the package QSmartControl
+# (as it is imported when cloned into a directory of that name), whatever the checkout is called.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "QSmartControl" not in sys.modules:
+    package = importlib.util.module_from_spec(importlib.machinery.ModuleSpec("QSmartControl",None,is_package=True))
+    package.__path__ = [ROOT]
+    sys.modules["QSmartControl"] = package
+
+from QSmartControl.LaserSimulator import LaserSimulator
+
+@pytest.fixture
+def simulator():
+    simulator = LaserSimulator().start()
+    yield simulator
+    simulator.stop()
@@ -0,0 +1,51 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import asyncio
+
+from QSmartControl.AsyncLaserSettings import AsyncLaserSettings
+from QSmartControl.LaserSimulator import LaserSimulator, SimulatedLaser
+
+def run(simulator,function,**kwargs):
+    """Run function(laser) on a connected AsyncLaserSettings in a fresh event loop, returns its result."""
+    async def main():
+        async with AsyncLaserSettings(ip="127.0.0.1",port=simulator.port,**kwargs) as laser:
+            return await function(laser)
+    return asyncio.run(main())
+
+def test_smoke(simulator):
+    async def read(laser):
+        return await laser.get_state(), await laser.get_state_str(), await laser.to_dict(), await laser.get_parsed_status()
+
+    state, name, settings, status = run(simulator,read)
+    assert (state,name) == (2,"Laser ready for RUN command")
+    assert settings["mode"] == "F/N Mode"
+    assert status.state == 2
+
+class RefusingStatusLaser(SimulatedLaser):
+    """Answers ERROR to STATUS."""
+
+    def status(self,now):
+        return None
+
+def test_keep_alive_survives_error_replies():
+    simulator = LaserSimulator(laser=RefusingStatusLaser()).start()
+    async def idle(laser):
+        await asyncio.sleep(0.3)
+        return laser.keep_alive_task.done(), simulator.commands
+    try:
+        done, pings = run(simulator,idle,keep_alive=0.05)
+        assert not done
+        assert pings >= 3
+    finally:
+        simulator.stop()
+
+def test_settings_from_dict_diff(simulator):
+    async def apply(laser):
+        unchanged = await laser.settings_from_dict(await laser.to_dict())
+        changed = await laser.settings_from_dict({"qswitch_trigger": "External", "mode": "Scan", "shots": 2, "total_length": 4})
+        return unchanged, changed, await laser.to_dict()
+
+    unchanged, changed, after = run(simulator,apply)
+    assert unchanged == {}
+    assert changed == {"TRIG": ("II","IE"), "QSPAR2": (1,4), "QSPAR3": (1,2)}
+    assert (after["flashlamp_trigger"],after["qswitch_trigger"],after["mode"]) == ("Internal","External","Scan")
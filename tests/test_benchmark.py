@@ -0,0 +1,26 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+from QSmartControl.LaserBenchmark import compare, percentile, alternating, run_benchmarks
+
+def test_percentile():
+    assert percentile([3,1,2,4],0.5) == 3
+    assert percentile(range(100),0.99) == 99
+
+def test_alternating():
+    seen = []
+    call = alternating(seen.append,"a","b")
+    for i in range(3):
+        call()
+    assert seen == ["a","b","a"]
+
+def test_compare():
+    baseline = {"rtt": 0.001, "read_p50": 0.002, "read_p99": 0.003, "queries_qps": 1000.}
+    assert compare({"rtt": 0.002, "read_p50": 0.0022, "read_p99": 0.03, "queries_qps": 900.},baseline,0.2) == []
+    regressions = compare({"read_p50": 0.003, "read_p99": 0.003, "queries_qps": 700.},baseline,0.2)
+    assert [regression.split(":")[0] for regression in regressions] == ["read_p50","queries_qps"]
+
+def test_run_benchmarks():
+    results = run_benchmarks(0.,repeat=5,duration=0.1)
+    assert results["rtt"] == 0.
+    assert all(value > 0 for name, value in results.items() if name.endswith(("_p50","_qps")))
+    assert compare(results,results,0.) == []
@@ -0,0 +1,136 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import socket
+import time
+
+import pytest
+
+from QSmartControl.LaserCommunication import LaserCommunication, RttEstimator, RECONNECT_DELAY
+from QSmartControl.LaserProtocol import frame_end, is_single_line, SNAPSHOT_REGISTERS, LaserDisconnected, LaserTimeout
+from QSmartControl.LaserSettings import LaserSettings
+from QSmartControl.LaserSimulator import LaserSimulator
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1",0))
+        return sock.getsockname()[1]
+
+## Framing
+def test_frame_end():
+    buffer = bytearray(b"STATE = 2\n0\nOK\nERROR\nCGTEMP = 24")
+    first = frame_end(buffer)
+    assert buffer[:first] == b"STATE = 2\n0\n"
+    second = frame_end(buffer,first)
+    assert buffer[first:second] == b"OK\n"
+    third = frame_end(buffer,second)
+    assert buffer[second:third] == b"ERROR\n"
+    ## The last reply is incomplete.
+    assert frame_end(buffer,third) == -1
+    buffer += b"\n"
+    assert frame_end(buffer,third) == -1
+    buffer += b"0\n"
+    assert frame_end(buffer,third) == len(buffer)
+
+def test_single_line():
+    assert is_single_line(b"OK\n")
+    assert is_single_line(b"ERROR 3\n")
+    assert not is_single_line(b"STATE = 2\n")
+
+## Pipelining
+@pytest.mark.parametrize("split_packets",[False,True])
+def test_pipelined_batch(split_packets):
+    simulator = LaserSimulator(split_packets=split_packets,chunk_size=3).start()
+    try:
+        communication = LaserCommunication("127.0.0.1",simulator.port,1)
+        batch = ["STATE","NOSUCH","CAPVSET","QSPAR1 0","LPW","TRIG"]
+        responses = communication.send_and_recv_many(batch)
+        assert responses == [communication.send_and_recv(command) for command in batch]
+        assert responses == ["STATE = 2","ERROR","CAPVSET = 1200","OK","LPW = 180","TRIG = II"]
+        assert communication.send_and_recv_many(["STATE"],include_status=True) == ["STATE = 2\n0\n"]
+        communication.close()
+    finally:
+        simulator.stop()
+
+def test_to_dict_is_one_batch(simulator):
+    with LaserSettings(ip="127.0.0.1",port=simulator.port,start_keep_alive=False,metrics=True) as laser:
+        laser.to_dict()
+        ## Connecting takes one batch (STATE), the snapshot one more.
+        assert laser.metrics.to_dict()["queue_wait"][1]["count"] == 1
+        assert {name: metrics["count"] for name, metrics in laser.metrics.to_dict()["commands"].items()} == \
+               dict(dict.fromkeys(SNAPSHOT_REGISTERS,1),STATE=1)
+
+## Reconnect and backoff
+def test_backoff():
+    communication = LaserCommunication("127.0.0.1",free_port(),1,lazy=True,max_backoff=4*RECONNECT_DELAY)
+    with pytest.raises(LaserDisconnected):
+        communication.connect()
+    first = communication.next_attempt - time.monotonic()
+    assert 0 < first <= RECONNECT_DELAY
+
+    ## While backing off, commands fail right away without a connection attempt.
+    with pytest.raises(LaserDisconnected,match="next attempt"):
+        communication.send_and_recv("STATE")
+
+    delays = []
+    for attempt in range(4):
+        time.sleep(max(communication.next_attempt - time.monotonic(),0))
+        with pytest.raises(LaserDisconnected):
+            communication.connect()
+        delays.append(communication.next_attempt - time.monotonic())
+    assert delays[0] > first
+    assert max(delays) <= 4*RECONNECT_DELAY
+    assert communication.connections == 0
+
+def test_reconnect_after_restart(simulator):
+    communication = LaserCommunication("127.0.0.1",simulator.port,1)
+    assert communication.send_and_recv("STATE") == "STATE = 2"
+    simulator.stop()
+    with pytest.raises(LaserDisconnected):
+        communication.send_and_recv("STATE")
+    assert not communication.connected
+
+    restarted = LaserSimulator(port=simulator.port,laser=simulator.laser).start()
+    try:
+        time.sleep(max(communication.next_attempt - time.monotonic(),0))
+        assert communication.send_and_recv("STATE") == "STATE = 2"
+        assert communication.connections == 2
+        assert communication.next_attempt == 0.
+    finally:
+        communication.close()
+        restarted.stop()
+
+## Round trip time
+def test_rtt_estimator():
+    fixed = RttEstimator(3.,0.05,warmup=2)
+    adaptive = RttEstimator(3.,0.05,warmup=2,adaptive=True)
+    for estimator in (fixed,adaptive):
+        estimator.add(0.01)
+        assert estimator.timeout == 3.
+        estimator.add(0.01)
+    assert (fixed.timeout,adaptive.srtt) == (3.,0.01)
+    ## srtt + 4*rttvar is below the minimum.
+    assert adaptive.timeout == 0.05
+    adaptive.timed_out()
+    assert adaptive.timeout == 0.1
+    for i in range(10):
+        adaptive.timed_out()
+    assert adaptive.timeout == 3.
+
+def test_adaptive_timeout():
+    simulator = LaserSimulator(command_latency={"RUN": 0.4, "LPW": 0.4}).start()
+    try:
+        with LaserSettings(ip="127.0.0.1",port=simulator.port,timeout=2,cache=False,start_keep_alive=False,
+                           adaptive_timeout=True,min_timeout=0.05,idle_shutdown=5.) as laser:
+            for i in range(10):
+                laser.state
+            assert laser.link["timeout"] == 0.05
+            assert laser.keep_alive_interval == pytest.approx(5. - 1. - 2*0.05)
+            ## Switching gets the full timeout, a query that slow is taken for a lost reply.
+            laser.enable_flash()
+            start = time.monotonic()
+            with pytest.raises(LaserTimeout):
+                laser.flashlamp_pulse_width
+            assert time.monotonic() - start < 0.4
+            assert laser.link["timeout"] > 0.05
+    finally:
+        simulator.stop()
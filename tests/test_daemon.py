@@ -0,0 +1,44 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import os
+import stat
+from threading import Thread
+
+import pytest
+
+from QSmartControl.LaserDaemon import LaserDaemon, LaserClient
+from QSmartControl.LaserSettings import LaserSettings
+
+@pytest.fixture
+def daemon(simulator,tmp_path):
+    laser = LaserSettings(True,"127.0.0.1",simulator.port,timeout=1,start_keep_alive=False)
+    ## Nobody may write admin registers.
+    daemon = LaserDaemon(laser,str(tmp_path/"qsmart.sock"),admin_uids=())
+    server = Thread(target=daemon.serve_forever,daemon=True)
+    server.start()
+    yield daemon
+    daemon.shutdown()
+    server.join(1)
+    laser.close()
+
+def test_socket_permissions(daemon):
+    assert stat.S_IMODE(os.stat(daemon.path).st_mode) == 0o660
+
+def test_client(simulator,daemon):
+    with LaserClient(daemon.path,timeout=1) as client:
+        assert client.state == 2
+        assert client.get_state(True,True) == (2,"Laser ready for RUN command")
+        assert client.cooling_temp > 0
+        assert client.set_mode("Scan",shots=2,total_length=4) == {"QSPAR2": [1,4], "QSPAR3": [1,2]}
+        assert client.mode == "Scan"
+        client.qswitch_trigger = "External"
+        assert simulator.laser.registers["TRIG"] == "IE"
+        assert client.parsed_status.state == 2
+
+        with pytest.raises(AttributeError):
+            client.request({"get": "lasercommunication"})
+        with pytest.raises(ValueError):
+            client.set_mode("Burst",cycles=2)
+        with pytest.raises(RuntimeError):
+            client.flashlamp_voltage = 1100
+        assert simulator.laser.registers["CAPVSET"] == "1200"
@@ -0,0 +1,40 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import time
+
+from QSmartControl.LaserFleet import LaserFleet, endpoint_name
+from QSmartControl.LaserSimulator import LaserSimulator
+
+def test_endpoint_name():
+    assert endpoint_name("10.0.0.1") == "10.0.0.1:10001"
+    assert endpoint_name("10.0.0.1:2000") == endpoint_name(("10.0.0.1",2000)) == "10.0.0.1:2000"
+
+def test_broadcast():
+    simulators = [LaserSimulator().start() for i in range(3)]
+    try:
+        names = [f"127.0.0.1:{simulator.port}" for simulator in simulators]
+        with LaserFleet(names + ["127.0.0.1:1"],timeout=1) as fleet:
+            assert sorted(fleet.lasers) == sorted(names)
+            assert list(fleet.connection_errors) == ["127.0.0.1:1"]
+
+            results, errors = fleet.set_mode("Scan",shots=2,total_length=4)
+            assert errors == {}
+            assert all(simulator.laser.registers["QSPAR3"] == "2" for simulator in simulators)
+            results, errors = fleet.to_dict()
+            assert [results[name]["mode"] for name in names] == ["Scan"]*3
+    finally:
+        for simulator in simulators:
+            simulator.stop()
+
+def test_keep_alive_during_long_broadcast():
+    simulator = LaserSimulator(idle_shutdown=0.5).start()
+    try:
+        with LaserFleet([("127.0.0.1",simulator.port)],timeout=1,keep_alive=0.1) as fleet:
+            ## Holds the only worker of the executor for longer than the laser tolerates an idle link.
+            results, errors = fleet.run(lambda laser: time.sleep(1.5))
+            assert errors == {}
+            ## Give a ping that was held back the time to find the connection closed and reconnect.
+            time.sleep(0.3)
+            assert simulator.connections == 1
+    finally:
+        simulator.stop()
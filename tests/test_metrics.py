@@ -0,0 +1,42 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import socket
+
+from QSmartControl.LaserMetrics import Histogram, LaserMetrics
+from QSmartControl.LaserSettings import LaserSettings
+
+def test_histogram():
+    histogram = Histogram((0.001,0.01))
+    assert histogram.quantile(0.5) is None
+    for value in (0.0005,0.005,0.005,0.5):
+        histogram.observe(value)
+    assert histogram.cumulative() == [(0.001,1),(0.01,3),(float("inf"),4)]
+    assert histogram.quantile(0.5) == 0.01
+    assert histogram.quantile(1.) == float("inf")
+
+def test_counters():
+    metrics = LaserMetrics()
+    seen = []
+    metrics.add_hook(after=lambda commands, responses, latencies, error: seen.append(commands))
+    metrics.after(["STATE","QDLY 300"],["STATE = 2\n0","ERROR"],[0.001,0.002],None,15,18)
+    metrics.after(["STATE"],[],[],socket.timeout(),6,0)
+    exported = metrics.to_dict()
+    assert exported["commands"]["QDLY"]["errors"] == 1
+    assert exported["commands"]["STATE"]["count"] == 1
+    assert (exported["timeouts"],exported["bytes_sent"],exported["bytes_received"]) == (1,21,18)
+    assert seen == [["STATE","QDLY 300"],["STATE"]]
+
+def test_laser_metrics(simulator):
+    with LaserSettings(ip="127.0.0.1",port=simulator.port,timeout=1,start_keep_alive=False,metrics=True,adaptive_timeout=True) as laser:
+        laser.state
+        exported = laser.metrics.to_dict()
+        ## One when connecting, one for the read.
+        assert exported["commands"]["STATE"]["count"] == 2
+        gauges = {gauge["name"]: gauge for gauge in exported["gauges"]}
+        assert gauges["rtt_seconds"]["labels"] == {"laser": f"127.0.0.1:{simulator.port}"}
+        assert gauges["rtt_seconds"]["value"] > 0
+
+        text = laser.metrics.to_prometheus(labels={"site": "lab"})
+        assert 'qsmart_commands_total{site="lab",command="STATE"} 2' in text
+        assert "# TYPE qsmart_rtt_seconds gauge" in text
+        assert f'qsmart_keep_alive_interval_seconds{{site="lab",laser="127.0.0.1:{simulator.port}"}} 3' in text
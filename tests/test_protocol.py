@@ -0,0 +1,45 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import pytest
+
+from QSmartControl.LaserProtocol import REGISTERS, LaserCommandError, LaserError, LaserStatus, parse_status
+from QSmartControl.LaserSettings import LaserSettings
+
+## Register table
+def test_encode():
+    assert REGISTERS["QSPAR1"].encode(3) == "QSPAR1 3"
+    assert REGISTERS["CAPVSET"].encode(1100,True) == "CAPVSET = 1100"
+    assert REGISTERS["LPW"].encode(170,True) == "LPW = 170"
+    with pytest.raises(ValueError):
+        REGISTERS["QDLY"].encode(300,True)
+    with pytest.raises(ValueError):
+        REGISTERS["QSPAR1"].encode(1.5)
+    with pytest.raises(ValueError):
+        REGISTERS["STATE"].encode(2)
+    with pytest.raises(RuntimeError):
+        REGISTERS["CAPVSET"].encode(1100)
+
+def test_decode():
+    assert REGISTERS["CGTEMP"].decode("CGTEMP = 24.5") == 24.5
+    assert REGISTERS["QSW"].decode("QSW = 1") is True
+    assert REGISTERS["TRIG"].decode("TRIG = IE ") == "IE"
+    with pytest.raises(LaserCommandError):
+        REGISTERS["CAPVSET"].decode("ERROR")
+    with pytest.raises(LaserError):
+        REGISTERS["CAPVSET"].decode("LPW = 180")
+
+def test_accessors():
+    assert LaserSettings.flashlamp_voltage.__doc__ == "Flash Lamp voltage in V"
+    assert LaserSettings.cooling_temp.fset is None
+
+## STATUS
+def test_parse_status():
+    assert parse_status("STATUS = STATE:5 ILK:1 SHUT:OPEN FL:1 QS:0") == \
+        LaserStatus(5,True,True,True,False,"STATUS = STATE:5 ILK:1 SHUT:OPEN FL:1 QS:0")
+    ## Unknown values and fields are None, not an error.
+    assert parse_status("STATUS = ST:RDY SHUT:0") == LaserStatus(None,None,False,None,None,"STATUS = ST:RDY SHUT:0")
+    assert parse_status("STATUS = 0x5F") == LaserStatus(None,None,None,None,None,"STATUS = 0x5F")
+    assert parse_status("STATUS = 0x5F",numeric=True) == LaserStatus(5,True,True,True,True,"STATUS = 0x5F")
+    assert parse_status("STATUS = 082",numeric=True).state == 5
+    with pytest.raises(LaserCommandError):
+        parse_status("ERROR")
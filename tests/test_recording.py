@@ -0,0 +1,42 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import pytest
+
+from QSmartControl.LaserProtocol import LaserError
+from QSmartControl.LaserRecording import SessionLog, ReplayCommunication
+from QSmartControl.LaserSettings import LaserSettings
+
+def session(laser):
+    return laser.to_dict(), laser.set_mode("Scan",shots=2,total_length=4), laser.status
+
+def test_record_and_replay(simulator,tmp_path):
+    path = str(tmp_path/"session.qsrec")
+    with LaserSettings(ip="127.0.0.1",port=simulator.port,start_keep_alive=False,record=path) as laser:
+        recorded = session(laser)
+
+    with SessionLog(path) as log:
+        exchanges = list(log.exchanges())
+    assert exchanges[0][1] == "STATE"
+    assert all(received >= sent for sent, command, received, response in exchanges)
+
+    replay = ReplayCommunication(path)
+    with LaserSettings(communication=replay,start_keep_alive=False,metrics=True) as laser:
+        assert session(laser) == recorded
+        ## Read by to_dict, read again (uncached) and written by set_mode.
+        assert laser.metrics.to_dict()["commands"]["QSPAR2"]["count"] == 3
+    assert replay.remaining == 0
+
+def test_strict_replay_mismatch(simulator,tmp_path):
+    path = str(tmp_path/"session.qsrec")
+    with LaserSettings(ip="127.0.0.1",port=simulator.port,start_keep_alive=False,record=path) as laser:
+        laser.flashlamp_voltage
+
+    with LaserSettings(communication=ReplayCommunication(path),start_keep_alive=False) as laser:
+        with pytest.raises(LaserError,match="recording has"):
+            laser.flashlamp_pulse_width
+
+    ## Not strict: every command gets the next recorded reply to the same command.
+    with LaserSettings(communication=ReplayCommunication(path,strict=False),start_keep_alive=False) as laser:
+        assert laser.flashlamp_voltage == 1200
+        with pytest.raises(LaserError,match="no \\(more\\) recorded"):
+            laser.flashlamp_pulse_width
@@ -0,0 +1,91 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import time
+from threading import Thread, Event
+
+import pytest
+
+from QSmartControl.LaserScheduler import LaserScheduler, DeadlineExceeded, PRIORITY_CONTROL, PRIORITY_USER, PRIORITY_TELEMETRY, PRIORITY_KEEP_ALIVE
+
+class Recorder:
+    """
+    Stand-in for LaserCommunication that answers OK and remembers the batches in the order they were sent.
+    A BLOCK command holds the exchange until release is set.
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.blocked = Event()
+        self.release = Event()
+
+    def send_and_recv_many(self,commands,include_status=False,deadline=None):
+        self.batches.append(commands)
+        if "BLOCK" in commands:
+            self.blocked.set()
+            self.release.wait()
+        return ["OK"]*len(commands)
+
+def held(scheduler):
+    """Block the worker inside an exchange, so everything submitted meanwhile queues up. Returns its future."""
+    blocker = scheduler.submit(["BLOCK"])
+    scheduler.lasercommunication.blocked.wait()
+    return blocker
+
+@pytest.fixture
+def scheduler():
+    scheduler = LaserScheduler(Recorder())
+    yield scheduler
+    scheduler.stop()
+
+def test_priority_order(scheduler):
+    blocker = held(scheduler)
+    futures = [scheduler.submit([name],priority) for name, priority in
+               [("PING",PRIORITY_KEEP_ALIVE),("POLL1",PRIORITY_TELEMETRY),("READ1",PRIORITY_USER),
+                ("RUN",PRIORITY_CONTROL),("READ2",PRIORITY_USER),("POLL2",PRIORITY_TELEMETRY)]]
+    scheduler.lasercommunication.release.set()
+
+    assert [future.result(1) for future in futures] == [["OK"]]*6
+    assert blocker.result(1) == ["OK"]
+    ## By priority, and in submission order within a priority.
+    assert scheduler.lasercommunication.batches == [["BLOCK"],["RUN"],["READ1"],["READ2"],["POLL1"],["POLL2"],["PING"]]
+
+def test_deadline(scheduler):
+    held(scheduler)
+    expired = scheduler.submit(["LATE"],PRIORITY_TELEMETRY,deadline=time.monotonic() + 0.01)
+    in_time = scheduler.submit(["SOON"],PRIORITY_TELEMETRY,deadline=time.monotonic() + 10)
+    time.sleep(0.05)
+    scheduler.lasercommunication.release.set()
+
+    with pytest.raises(DeadlineExceeded):
+        expired.result(1)
+    assert in_time.result(1) == ["OK"]
+    ## The expired batch was dropped unsent.
+    assert ["LATE"] not in scheduler.lasercommunication.batches
+
+def test_callback_and_cancel(scheduler):
+    held(scheduler)
+    seen = []
+    answered = scheduler.submit(["A","B"],callback=seen.append)
+    cancelled = scheduler.submit(["C"])
+    assert cancelled.cancel()
+    scheduler.lasercommunication.release.set()
+
+    assert answered.result(1) == ["OK","OK"]
+    assert seen == [["OK","OK"]]
+    assert ["C"] not in scheduler.lasercommunication.batches
+
+def test_stop_cancels_queued():
+    scheduler = LaserScheduler(Recorder())
+    blocker = held(scheduler)
+    queued = scheduler.submit(["Q"])
+    stopping = Thread(target=scheduler.stop)
+    stopping.start()
+    while not queued.cancelled():
+        time.sleep(0.001)
+    ## The exchange on the wire is completed.
+    scheduler.lasercommunication.release.set()
+    stopping.join(1)
+    assert blocker.result(1) == ["OK"]
+    assert scheduler.lasercommunication.batches == [["BLOCK"]]
+    with pytest.raises(RuntimeError):
+        scheduler.submit(["AFTER"])
@@ -0,0 +1,64 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+from concurrent.futures import Future
+
+import pytest
+
+from QSmartControl.LaserProtocol import LaserCommandError, LaserDisconnected
+from QSmartControl.LaserSequence import LaserSequence, ABORT_COMMANDS, report
+from QSmartControl.LaserSettings import LaserSettings
+
+@pytest.fixture
+def laser(simulator):
+    laser = LaserSettings(ip="127.0.0.1",port=simulator.port,timeout=1,start_keep_alive=False)
+    yield laser
+    laser.close()
+
+def test_run(simulator,laser):
+    sequence = LaserSequence(laser)
+    sequence.set_mode(0,"Burst",cycles=2,total_length=10,shots=5).enable_flash(0)
+    sequence.enable_qsw(0.2).disable_qsw(0.3).disable_flash(0.3)
+    results = sequence.run()
+
+    assert [result.name for result in results] == ["set_mode Burst","enable_flash","enable_qsw","disable_qsw","disable_flash"]
+    assert all(result.error is None for result in results)
+    ## Steps at the same time go out in one batch.
+    assert results[0].sent == results[1].sent
+    assert all(abs(result.lateness) < 0.05 for result in results)
+    assert simulator.laser.registers["QSPAR1"] == "2"
+    assert laser.state == 2
+    assert "enable_qsw" in report(results)
+
+def test_refused_step_aborts(laser):
+    with pytest.raises(ValueError):
+        LaserSequence(laser).set_mode(0,"Burst",cycles=2)
+    ## QSW 1 is refused before the flashlamp runs.
+    results = LaserSequence(laser).enable_qsw(0).enable_flash(0.1).run()
+    assert isinstance(results[0].error,LaserCommandError)
+    assert (results[1].name,results[1].responses,results[1].error) == ("abort",["OK","OK"],None)
+    assert (results[2].name,results[2].sent) == ("enable_flash",None)
+
+class DisconnectingLaser:
+    """Stand-in for LaserSettings that refuses every step and is gone by the time of the abort."""
+    admin_mode = False
+
+    def __init__(self):
+        self.batches = []
+
+    def submit(self,commands,priority=None,deadline=None):
+        self.batches.append(list(commands))
+        future = Future()
+        if tuple(commands) == ABORT_COMMANDS:
+            future.set_exception(LaserDisconnected("connection lost"))
+        else:
+            future.set_result(["ERROR"]*len(commands))
+        return future
+
+def test_failed_abort():
+    laser = DisconnectingLaser()
+    results = LaserSequence(laser).enable_flash(0).run()
+    assert laser.batches == [["RUN"],list(ABORT_COMMANDS)]
+    assert isinstance(results[0].error,LaserCommandError)
+    assert results[1].name == "abort"
+    assert isinstance(results[1].error,LaserDisconnected)
+    assert results[1].completed is None
@@ -0,0 +1,177 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from QSmartControl.LaserProtocol import LaserCommandError, LaserTimeout, rollback_error
+from QSmartControl.LaserSettings import LaserSettings
+from QSmartControl.LaserSimulator import LaserSimulator, SimulatedLaser
+
+@pytest.fixture
+def laser(simulator):
+    laser = LaserSettings(True,"127.0.0.1",simulator.port,timeout=1,start_keep_alive=False)
+    yield laser
+    laser.close()
+
+def queries(simulator,function):
+    """Number of commands the simulator received while running function."""
+    before = simulator.commands
+    function()
+    return simulator.commands - before
+
+## Cache
+def test_cache_and_invalidation(simulator,laser):
+    assert laser.flashlamp_voltage == 1200
+    assert queries(simulator,lambda: laser.flashlamp_voltage) == 0
+    ## Our own write invalidates the register, the next read goes to the laser.
+    laser.flashlamp_voltage = 1100
+    assert queries(simulator,lambda: laser.flashlamp_voltage) == 1
+    assert laser.flashlamp_voltage == 1100
+    laser.refresh("CAPVSET")
+    assert queries(simulator,lambda: laser.flashlamp_voltage) == 1
+    ## Live values expire by themselves.
+    assert queries(simulator,lambda: laser.state) == 1
+    time.sleep(laser.cache_ttl["STATE"])
+    assert queries(simulator,lambda: laser.state) == 1
+
+def test_cache_dropped_on_reconnect(simulator,laser):
+    assert laser.flashlamp_voltage == 1200
+    simulator.laser.respond("CAPVSET 1000")
+    assert laser.flashlamp_voltage == 1200
+    laser.lasercommunication.close()
+    laser.lasercommunication.connect()
+    assert laser.flashlamp_voltage == 1000
+
+def test_stale_cache_write(simulator,laser):
+    """A change made behind our back (front panel, another client) must not make us skip a write."""
+    assert laser.set_mode("Scan",shots=5,total_length=10) == {"QSPAR2": (1,10), "QSPAR3": (1,5)}
+    assert laser.mode == "Scan"
+    simulator.laser.respond("QSPAR2 20")
+    assert laser.set_mode("Scan",shots=5,total_length=10) == {"QSPAR2": (20,10)}
+    assert simulator.laser.registers["QSPAR2"] == "10"
+    assert laser.settings_from_dict(laser.to_dict()) == {}
+
+## Single flight
+def test_concurrent_reads_coalesced():
+    simulator = LaserSimulator(latency=0.05).start()
+    try:
+        with LaserSettings(ip="127.0.0.1",port=simulator.port,cache=False,start_keep_alive=False) as laser:
+            before = simulator.commands
+            with ThreadPoolExecutor(20) as executor:
+                states = list(executor.map(lambda i: laser.state,range(20)))
+            assert states == [2]*20
+            ## The first query goes out alone, everyone arriving while it is on the wire shares it or the next one.
+            assert simulator.commands - before <= 3
+    finally:
+        simulator.stop()
+
+## Keep alive and lifecycle
+def test_lazy_connection(simulator):
+    with LaserSettings(ip="127.0.0.1",port=simulator.port,lazy=True) as laser:
+        time.sleep(0.05)
+        assert simulator.connections == 0
+        assert laser.state == 2
+        assert simulator.connections == 1
+
+def test_join_keep_alive_thread_keeps_laser_usable(simulator):
+    laser = LaserSettings(ip="127.0.0.1",port=simulator.port)
+    laser.join_keep_alive_thread()
+    assert laser.keep_alive_thread is None
+    assert laser.state == 2
+    laser.close()
+    with pytest.raises(RuntimeError):
+        laser.scheduler.submit(["STATE"])
+
+def test_keep_alive_harvests_status(simulator):
+    with LaserSettings(ip="127.0.0.1",port=simulator.port,keep_alive=0.05,metrics=True) as laser:
+        assert laser.latest_status is None
+        time.sleep(0.2)
+        assert laser.latest_status[1].state == 2
+        assert laser.metrics.keep_alive_pings >= 2
+
+class WordStatusLaser(SimulatedLaser):
+    """Reports its state as a word, which the STATUS parser doesn't know."""
+
+    def status(self,now):
+        return "ST:RDY SHUT:0"
+
+def test_unknown_status_variant():
+    simulator = LaserSimulator(laser=WordStatusLaser()).start()
+    try:
+        with LaserSettings(ip="127.0.0.1",port=simulator.port,timeout=1,keep_alive=0.05) as laser:
+            assert laser.status == "STATUS = ST:RDY SHUT:0"
+            assert laser.parsed_status.state is None
+            assert laser.parsed_status.shutter is False
+            time.sleep(0.3)
+            assert laser.keep_alive_thread.is_alive()
+            assert laser.latest_status[1].raw == "STATUS = ST:RDY SHUT:0"
+    finally:
+        simulator.stop()
+
+## Transactions
+class RefusingLaser(SimulatedLaser):
+    """Refuses every write of one register."""
+
+    def __init__(self,refused):
+        super().__init__()
+        self.refused = refused
+
+    def write(self,name,value,now):
+        if name == self.refused:
+            return False
+        return super().write(name,value,now)
+
+def test_rollback_on_refused_write():
+    simulator = LaserSimulator(laser=RefusingLaser("QSPAR3")).start()
+    try:
+        with LaserSettings(ip="127.0.0.1",port=simulator.port,timeout=1,start_keep_alive=False) as laser:
+            with pytest.raises(LaserCommandError) as error:
+                laser.set_mode("Burst",cycles=2,total_length=10,shots=5)
+            assert error.value.command == "QSPAR3 5"
+            ## The writes that were accepted are undone.
+            registers = simulator.laser.registers
+            assert (registers["QSPAR1"],registers["QSPAR2"],registers["QSPAR3"]) == ("0","1","1")
+            assert laser.mode == "F/N Mode"
+
+            with pytest.raises(LaserCommandError):
+                laser.write_registers({"TRIG": "EE", "QSPAR3": 3})
+            assert registers["TRIG"] == "II"
+    finally:
+        simulator.stop()
+
+def test_transaction_builder(simulator,laser):
+    with laser.transaction() as transaction:
+        transaction.set_mode("Burst",cycles=2,total_length=10,shots=5)
+        transaction.set_triggers("External","Internal")
+    registers = simulator.laser.registers
+    assert (registers["QSPAR1"],registers["QSPAR2"],registers["QSPAR3"],registers["TRIG"]) == ("2","10","5","EI")
+    assert transaction.changes == {"QSPAR1": (0,2), "QSPAR2": (1,10), "QSPAR3": (1,5), "TRIG": ("II","EI")}
+
+def test_read_retried_after_idle_close():
+    simulator = LaserSimulator(idle_shutdown=0.2).start()
+    try:
+        with LaserSettings(ip="127.0.0.1",port=simulator.port,timeout=1,cache=False,start_keep_alive=False) as laser:
+            time.sleep(0.4)
+            ## The laser closed the idle connection, the read goes out again on a new one.
+            assert laser.state == 2
+            assert simulator.connections == 2
+    finally:
+        simulator.stop()
+
+def test_budget(simulator):
+    simulator.latency = 0.2
+    with LaserSettings(ip="127.0.0.1",port=simulator.port,cache=False,start_keep_alive=False) as laser:
+        start = time.monotonic()
+        with pytest.raises(LaserTimeout):
+            with laser.budget(0.05):
+                laser.state
+        assert time.monotonic() - start < 0.15
+
+def test_rollback_error_class():
+    error = rollback_error(LaserCommandError("refused","QSPAR3 5","ERROR"),LaserTimeout("no reply"))
+    assert type(error) is LaserTimeout
+    assert "no reply" in str(error)
+    error = rollback_error(LaserTimeout("no reply"),LaserCommandError("refused","QSPAR1 0","ERROR"))
+    assert type(error) is LaserCommandError and error.command == "QSPAR1 0"
@@ -0,0 +1,53 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import socket
+
+from QSmartControl.LaserSimulator import LaserSimulator, SimulatedLaser
+
+def exchange(port,data,size):
+    """Send raw bytes and read size bytes of replies."""
+    with socket.create_connection(("127.0.0.1",port),1) as sock:
+        sock.sendall(data)
+        received = b""
+        while len(received) < size:
+            received += sock.recv(4096)
+        return received
+
+def test_state_machine():
+    laser = SimulatedLaser(transition_time=0.1)
+    start = laser.created
+    assert laser.respond("STATE",start) == "STATE = 2\n0"
+    assert laser.respond("QSW 1",start) == "ERROR"
+    assert laser.respond("RUN",start) == "OK"
+    assert laser.respond("STATE",start + 0.15) == "STATE = 4\n0"
+    assert laser.respond("STATE",start + 1) == "STATE = 5\n0"
+    assert laser.respond("QSW 1",start + 1) == "OK"
+    assert laser.respond("STATE",start + 2) == "STATE = 9\n0"
+    assert laser.respond("STOP",start + 2) == "OK"
+    assert laser.respond("STATE",start + 2) == "STATE = 2\n0"
+
+def test_warmup():
+    laser = SimulatedLaser(warmup_time=10.)
+    assert laser.respond("STATE",laser.created + 1) == "STATE = 1\n0"
+    assert laser.respond("RUN",laser.created + 1) == "ERROR"
+
+def test_registers():
+    laser = SimulatedLaser()
+    assert laser.respond("CAPVSET = 1100") == "OK"
+    assert laser.respond("CAPVSET") == "CAPVSET = 1100\n0"
+    assert laser.respond("QDLY 300") == "ERROR"
+    assert laser.respond("TRIG EX") == "ERROR"
+    assert laser.respond("NOSUCH") == "ERROR"
+
+def test_server(simulator):
+    expected = b"STATE = 2\n0\nLPW = 180\n0\nOK\n"
+    assert exchange(simulator.port,b"STATE\nLPW\nQSPAR1 0\n",len(expected)) == expected
+    assert simulator.commands == 3
+    assert simulator.connections == 1
+
+def test_error_injection():
+    simulator = LaserSimulator(error_rate=1.,seed=0).start()
+    try:
+        assert exchange(simulator.port,b"QSPAR1 0\n",6) == b"ERROR\n"
+    finally:
+        simulator.stop()
@@ -0,0 +1,40 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import time
+
+import pytest
+
+from QSmartControl.LaserSettings import LaserSettings
+from QSmartControl.LaserSnapshot import SnapshotPublisher, SnapshotReader, SEQUENCE, SEQUENCE_OFFSET
+
+def test_publish_and_read(simulator,tmp_path):
+    path = str(tmp_path/"laser.snapshot")
+    with LaserSettings(ip="127.0.0.1",port=simulator.port,timeout=1,start_keep_alive=False) as laser:
+        publisher = SnapshotPublisher(laser,path,interval=0.02)
+        with SnapshotReader(path) as reader:
+            assert reader.read() is None
+            publisher.start()
+            time.sleep(0.1)
+            snapshot = reader.read()
+            assert (snapshot.state,snapshot.qsw,snapshot.trig,snapshot.qspar1,snapshot.qspar2,snapshot.qspar3) == (2,0,"II",0,1,1)
+            assert snapshot.sequence % 2 == 0 and snapshot.sequence >= 4
+            assert snapshot.age < 0.1
+        publisher.close()
+
+def test_reader_timeout(tmp_path):
+    path = str(tmp_path/"laser.snapshot")
+    publisher = SnapshotPublisher(None,path)
+    publisher.publish(5,24.5,1000,1,"IE",2,10,5)
+    with SnapshotReader(path,timeout=0.01) as reader:
+        assert reader.read().cgtemp == 24.5
+        ## A publisher that died halfway through a publish leaves the sequence odd.
+        SEQUENCE.pack_into(publisher.map,SEQUENCE_OFFSET,publisher.sequence + 1)
+        with pytest.raises(TimeoutError):
+            reader.read()
+    publisher.close()
+
+def test_incompatible_file(tmp_path):
+    path = tmp_path/"other.snapshot"
+    path.write_bytes(b"\x00"*64)
+    with pytest.raises(ValueError):
+        SnapshotReader(str(path))
@@ -0,0 +1,38 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import time
+
+import numpy as np
+import pytest
+
+from QSmartControl.LaserSettings import LaserSettings
+from QSmartControl.LaserTelemetry import LaserTelemetry, RingBuffer
+
+def test_ring_buffer():
+    buffer = RingBuffer(4,np.int64)
+    for i in range(6):
+        buffer.append(float(i),i*10)
+    assert len(buffer) == 4
+    times, values = buffer.last(3)
+    assert np.array_equal(values,[30,40,50])
+    times, values = buffer.since(2.5)
+    assert np.array_equal(times,[3.,4.,5.])
+    ## Older samples were overwritten.
+    assert np.array_equal(buffer.since(0.)[1],[20,30,40,50])
+
+def test_poller(simulator):
+    with pytest.raises(ValueError):
+        LaserTelemetry(None,{"NOSUCH": 1.})
+    with LaserSettings(ip="127.0.0.1",port=simulator.port,timeout=1,start_keep_alive=False) as laser:
+        laser.enable_flash()
+        telemetry = LaserTelemetry(laser,{"STATE": 50., "SSHOT": 50., "TRIG": 50.},size=1024)
+        telemetry.start()
+        time.sleep(0.5)
+        telemetry.stop()
+
+        assert len(telemetry.buffers["STATE"]) >= 10
+        assert telemetry.stats("STATE",10)["max"] == 5
+        ## A configuration register is only stored when it changes.
+        assert len(telemetry.buffers["TRIG"]) == 1
+        assert telemetry.last("TRIG",1)[1][0] == b"II"
+        assert telemetry.shot_rate(10) > 0
@@ -0,0 +1,48 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import os
+
+import numpy as np
+
+from QSmartControl.LaserTelemetryLog import TelemetryLog, TelemetryLogReader, INDEX
+
+def write(path,start,count,chunk_size=16):
+    with TelemetryLog(path,chunk_size=chunk_size) as log:
+        for i in range(start,start + count):
+            log.append("CGTEMP",float(i),20. + i/100)
+            log.append("STATE",float(i),i % 10)
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path/"run.qstlog")
+    write(path,0,100)
+    with TelemetryLogReader(path) as reader:
+        assert sorted(reader.registers) == ["CGTEMP","STATE"]
+        times, values = reader.read("STATE")
+        assert np.array_equal(times,np.arange(100.))
+        assert np.array_equal(values,np.arange(100) % 10)
+        times, values = reader.read("CGTEMP",start=10.5,end=20.)
+        assert np.array_equal(times,np.arange(11.,21.))
+
+def test_crash_recovery(tmp_path):
+    path = str(tmp_path/"run.qstlog")
+    write(path,0,50)
+    data_size = os.path.getsize(path)
+    index_size = os.path.getsize(path + ".idx")
+
+    ## A crash while writing: a chunk without its index record, and half an index record.
+    with open(path,"ab") as file:
+        file.write(b"\x01"*100)
+    with open(path + ".idx","ab") as file:
+        file.write(b"\x02"*(INDEX.itemsize//2))
+
+    ## Reopening drops both, so new chunks follow the last complete one.
+    write(path,50,50)
+    assert os.path.getsize(path + ".idx") > index_size
+    assert (os.path.getsize(path + ".idx") - index_size) % INDEX.itemsize == 0
+    with TelemetryLogReader(path) as reader:
+        chunks = reader.chunks()
+        ## The first chunk of the second run starts where the garbage was.
+        assert int(chunks["offset"][chunks["first"] >= 50].min()) == data_size
+        times, values = reader.read("STATE")
+        assert np.array_equal(times,np.arange(100.))
+        assert np.array_equal(values,np.arange(100) % 10)
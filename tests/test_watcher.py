@@ -0,0 +1,65 @@
+# QSmartControl, Copyright Jasper Smits, 2022, released under MIT License
+
+import time
+from threading import Thread
+
+import pytest
+
+from QSmartControl.LaserProtocol import LaserDisconnected
+from QSmartControl.LaserSettings import LaserSettings
+from QSmartControl.LaserWatcher import LaserWatcher
+
+@pytest.fixture
+def laser(simulator):
+    laser = LaserSettings(ip="127.0.0.1",port=simulator.port,timeout=1,start_keep_alive=False)
+    yield laser
+    laser.close()
+
+def test_wait_for_state(laser):
+    assert laser.wait_for_state(2,timeout=1) == 2
+    laser.enable_flash()
+    assert laser.wait_for_state(5,timeout=2) == 5
+    with pytest.raises(TimeoutError):
+        laser.wait_for_state(9,timeout=0.2)
+
+def test_subscribe(laser):
+    events = []
+    subscription = laser.watcher.subscribe(events.append)
+    laser.wait_for_state(2,timeout=1)
+    laser.enable_flash()
+    laser.wait_for_state(5,timeout=2)
+    subscription.unsubscribe()
+    assert [event.kind for event in events] == ["state"]*len(events)
+    assert events[0].old == 2 and events[-1].new == 5
+
+def test_stop_wakes_waiters(laser):
+    errors = []
+    def wait():
+        try:
+            laser.wait_for_state(9)
+        except RuntimeError as error:
+            errors.append(error)
+    waiter = Thread(target=wait)
+    waiter.start()
+    time.sleep(0.1)
+    laser.watcher.stop()
+    waiter.join(1)
+    assert len(errors) == 1
+
+class UnreachableLaser:
+    """Stand-in for LaserSettings whose link is down, counts the polls."""
+
+    def __init__(self):
+        self.polls = 0
+
+    def read_registers(self,registers,use_cache=True,priority=None,deadline=None):
+        self.polls += 1
+        raise LaserDisconnected("not connected")
+
+def test_no_spinning_on_failed_polls():
+    laser = UnreachableLaser()
+    watcher = LaserWatcher(laser,slow=0.1)
+    with pytest.raises(TimeoutError):
+        watcher.wait_for_state(2,timeout=0.5)
+    watcher.stop()
+    assert laser.polls <= 7